@@ -0,0 +1,66 @@
+"""Measures the memory and time per request, response and connection object.
+
+Usage: python benchmarks/allocations.py
+"""
+
+from pathlib import Path
+import gc
+import socket
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from py_http_server.common import HeaderContainer
+from py_http_server.http.request import HTTPRequest
+from py_http_server.http.response import HTTPResponse
+from py_http_server.networking import ConnectionInfo
+from py_http_server.networking.connection_socket import ConnectionSocket
+
+
+def request_and_response() -> tuple[HTTPRequest, HTTPResponse]:
+    request = HTTPRequest("GET", "/index.html", "", HeaderContainer(), "HTTP/1.1", b"")
+    # Attributes read by a typical middleware chain
+    for _ in range(5):
+        request.method, request.path, request.headers, request.query, request.version
+    response = HTTPResponse(200, HeaderContainer(), None)
+    for _ in range(5):
+        response.status_code, response.headers, response.body
+    response.status_code = 304
+    return request, response
+
+
+def retained_bytes(count: int) -> float:
+    gc.collect()
+    tracemalloc.start()
+    kept = [request_and_response() for _ in range(count)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return current / count
+
+
+def main():
+    print(f"retained bytes per request+response: {retained_bytes(10000):.0f}")
+
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        client = socket.create_connection(server.getsockname())
+        accepted, address = server.accept()
+
+        def connection():
+            sock = ConnectionSocket(accepted, remote_address=address)
+            ConnectionInfo(sock.remote_address, sock.remote_address, sock.has_ssl)
+
+        for label, function in (
+            ("construct + attribute access", request_and_response),
+            ("remote_address + ConnectionInfo per connection", connection),
+        ):
+            seconds = min(timeit.repeat(function, number=100000, repeat=5)) / 100000
+            print(f"{label}: {seconds * 1e6:.2f} us")
+
+        accepted.close()
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Compares RouteTrie lookups with a loop over compiled regexes.
+
+Usage: python benchmarks/route_trie.py [route count]
+"""
+
+from pathlib import Path
+import re
+import sys
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from py_http_server.routers._internal.route_trie import RouteTrie
+
+
+def build(count: int) -> tuple[RouteTrie, list[tuple[re.Pattern, str]]]:
+    trie = RouteTrie()
+    regexes = []
+    for i in range(count):
+        name = f"route{i}"
+        trie.add(f"/api/v{i % 10}/res{i}/{{id:int}}/items/{{item}}", ["GET"], name)
+        regexes.append(
+            (
+                re.compile(
+                    rf"/api/v{i % 10}/res{i}/(?P<id>-?[0-9]+)/items/(?P<item>[^/]+)"
+                ),
+                name,
+            )
+        )
+    return trie, regexes
+
+
+def regex_match(regexes: list[tuple[re.Pattern, str]], path: str):
+    for regex, name in regexes:
+        if match := regex.fullmatch(path):
+            return name, {"id": int(match["id"]), "item": match["item"]}
+    return None
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    trie, regexes = build(count)
+    single, _ = build(1)
+
+    # The last route is the worst case of the regex loop
+    path = f"/api/v{(count - 1) % 10}/res{count - 1}/42/items/abc"
+    assert trie.match(path, "GET")[0] == regex_match(regexes, path)[0]
+
+    for label, function, number in (
+        (f"trie, {count} routes", lambda: trie.match(path, "GET"), 100000),
+        (
+            "trie, 1 route",
+            lambda: single.match("/api/v0/res0/42/items/abc", "GET"),
+            100000,
+        ),
+        (f"regex loop, {count} routes", lambda: regex_match(regexes, path), 100),
+    ):
+        seconds = min(timeit.repeat(function, number=number, repeat=5)) / number
+        print(f"{label}: {seconds * 1e6:.1f} us/lookup")
+
+
+if __name__ == "__main__":
+    main()
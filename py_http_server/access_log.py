@@ -0,0 +1,313 @@
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, TextIO
+from .metrics import REGISTRY
+from . import log
+import datetime
+import json
+import logging
+import queue
+import random
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+
+LOG = log.getLogger("access_log")
+
+# Line formats of the access log
+FORMATS = ["common", "combined", "json"]
+
+
+class AccessLogFormatter(logging.Formatter):
+    """Formats access log records, which carry the request fields as args."""
+
+    def __init__(self, format: str = "combined"):
+        """Inits AccessLogFormatter.
+
+        Args:
+        format -- "common" (CLF), "combined" (CLF with referer and user agent) or "json".
+        """
+        super().__init__()
+        if format not in FORMATS:
+            raise ValueError(f'Unknown access log format "{format}"')
+        self.__format = format
+        # The current second and its timestamp, formatted once per second
+        self.__time = (0, "")
+
+    def __timestamp(self, created: float) -> str:
+        second = int(created)
+        if self.__time[0] != second:
+            value = datetime.datetime.fromtimestamp(second).astimezone()
+            if self.__format == "json":
+                self.__time = (second, value.isoformat())
+            else:
+                self.__time = (second, value.strftime("%d/%b/%Y:%H:%M:%S %z"))
+        return self.__time[1]
+
+    def format(self, record: logging.LogRecord) -> str:
+        remote, method, path, query, version, status, size, referer, agent, duration = (
+            record.args  # type: ignore
+        )
+        target = urllib.parse.quote(path) + query
+
+        if self.__format == "json":
+            return json.dumps(
+                {
+                    "time": self.__timestamp(record.created),
+                    "remote": remote,
+                    "method": method,
+                    "target": target,
+                    "version": version,
+                    "status": status,
+                    "size": size,
+                    "referer": referer,
+                    "user_agent": agent,
+                    "duration_ms": round(duration * 1000, 3),
+                }
+            )
+
+        # Quotes and backslashes are escaped so fields can be parsed back
+        line = (
+            f"{remote} - - [{self.__timestamp(record.created)}] "
+            f'"{self.__escape(f"{method} {target} {version}")}" {status} {size}'
+        )
+        if self.__format == "combined":
+            line += (
+                f' "{self.__escape(referer or "-")}" "{self.__escape(agent or "-")}"'
+            )
+        return line
+
+    @staticmethod
+    def __escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class _AccessFileHandler(logging.StreamHandler):
+    # Writes to a buffered file that can be reopened, flushes at most every flush_interval seconds
+
+    def __init__(self, path: Optional[str], buffer_size: int, flush_interval: float):
+        self.__path = path
+        self.__buffer_size = buffer_size
+        self.__flush_interval = flush_interval
+        self.__next_flush = 0.0
+        super().__init__(self.__open())
+
+    def __open(self) -> TextIO:
+        if self.__path is None:
+            return sys.stderr
+        return open(self.__path, "a", buffering=self.__buffer_size, encoding="utf-8")
+
+    def flush(self, force: bool = False):
+        # Called by emit() after every record, most calls leave the lines buffered
+        now = time.monotonic()
+        if force or now >= self.__next_flush:
+            self.__next_flush = now + self.__flush_interval
+            super().flush()
+
+    def reopen(self):
+        # Logrotate moves the file away and expects a new one to be created
+        if self.__path is None:
+            return
+        self.acquire()
+        try:
+            old = self.setStream(self.__open())
+            if old:
+                old.close()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            self.flush(True)
+            if self.__path is not None and self.stream:
+                self.stream.close()
+        finally:
+            self.release()
+        super().close()
+
+
+class _DroppingQueueHandler(QueueHandler):
+    # Never blocks a request thread, records are dropped if the queue is full
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Records are formatted by the listener thread, args are already plain values
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _AccessQueueListener(QueueListener):
+    # Wakes up periodically to flush buffered lines and reopen the file on request
+
+    def __init__(
+        self, records: queue.Queue, handler: _AccessFileHandler, interval: float
+    ):
+        super().__init__(records, handler)
+        self.__handler = handler
+        self.__interval = interval
+        self.reopen_requested = False
+
+    def __reopen_if_requested(self):
+        if self.reopen_requested:
+            self.reopen_requested = False
+            self.__handler.flush(True)
+            self.__handler.reopen()
+            LOG.info("Reopened access log")
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        # Waits with a timeout so idle periods flush the buffer
+        while True:
+            try:
+                return self.queue.get(block, self.__interval)
+            except queue.Empty:
+                self.__reopen_if_requested()
+                self.__handler.flush(True)
+
+    def handle(self, record: logging.LogRecord):
+        self.__reopen_if_requested()
+        self.__handler.handle(record)
+
+
+class AccessLog:
+    """Writes a line per request without blocking the request threads.
+
+    Records are put on a bounded queue by a QueueHandler and formatted and
+    written by a QueueListener thread. Lines are buffered and flushed every
+    flush_interval seconds, and records are dropped instead of blocking if
+    the queue is full. SIGHUP reopens the file for logrotate.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        format: str = "combined",
+        sample_rate: float = 1.0,
+        buffer_size: int = 65536,
+        queue_size: int = 10000,
+        flush_interval: float = 1.0,
+        reopen_on_sighup: bool = True,
+    ):
+        """Inits AccessLog.
+
+        Args:
+        path -- File to append to, stderr if None.
+        format -- "common", "combined" or "json".
+        sample_rate -- Fraction of requests logged, responses with status 500 and above are always logged.
+        buffer_size -- Size of the file buffer in bytes.
+        queue_size -- Maximum number of records waiting to be written.
+        flush_interval -- Maximum seconds lines stay buffered.
+        reopen_on_sighup -- Reopen the file on SIGHUP, only possible from the main thread.
+        """
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError("sample_rate must be between 0 and 1")
+
+        self.__sample_rate = sample_rate
+        self.__sampled_out = 0
+
+        self.__file_handler = _AccessFileHandler(path, buffer_size, flush_interval)
+        self.__file_handler.setFormatter(AccessLogFormatter(format))
+
+        records: queue.Queue = queue.Queue(queue_size)
+        self.__queue_handler = _DroppingQueueHandler(records)
+        self.__listener = _AccessQueueListener(
+            records, self.__file_handler, flush_interval
+        )
+        self.__listener.start()
+        REGISTRY.add_stats("access_log", self, ["queued"])
+
+        self.__prev_sighup = None
+        if (
+            reopen_on_sighup
+            and hasattr(signal, "SIGHUP")
+            and threading.current_thread() is threading.main_thread()
+        ):
+            self.__prev_sighup = signal.signal(signal.SIGHUP, self.__on_sighup)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "dropped": self.__queue_handler.dropped,
+            "sampled_out": self.__sampled_out,
+            "queued": self.__listener.queue.qsize(),
+        }
+
+    def __on_sighup(self, signum, frame):
+        # Only sets a flag, the file is reopened by the listener thread
+        self.__listener.reopen_requested = True
+        if callable(self.__prev_sighup):
+            self.__prev_sighup(signum, frame)
+
+    def reopen(self):
+        """Reopens the file on the listener thread within flush_interval seconds."""
+        self.__listener.reopen_requested = True
+
+    def log(
+        self,
+        remote: str,
+        method: str,
+        path: str,
+        query: str,
+        version: str,
+        status: int,
+        size: int,
+        referer: Optional[str],
+        user_agent: Optional[str],
+        duration: float,
+    ):
+        """Queues a request, cheap enough to be called from request threads.
+
+        Args:
+        remote -- IP address of the client.
+        method, path, query, version -- Fields of the request line, path is quoted when formatted.
+        status -- Status code of the response.
+        size -- Bytes sent for the response, headers included.
+        referer, user_agent -- Request headers, None if missing.
+        duration -- Seconds from the parsed request to the sent response.
+        """
+        if status < 500 and self.__sample_rate < 1.0:
+            if random.random() >= self.__sample_rate:
+                self.__sampled_out += 1
+                return
+
+        record = logging.LogRecord(
+            "access",
+            logging.INFO,
+            __file__,
+            0,
+            "",
+            (
+                remote,
+                method,
+                path,
+                query,
+                version,
+                status,
+                size,
+                referer,
+                user_agent,
+                duration,
+            ),
+            None,
+        )
+        self.__queue_handler.handle(record)
+
+    def close(self):
+        """Writes the queued records and closes the file."""
+        self.__listener.stop()
+        self.__file_handler.close()
+        if self.__prev_sighup is not None:
+            try:
+                signal.signal(signal.SIGHUP, self.__prev_sighup)
+            except ValueError:
+                # Not on the main thread
+                pass
@@ -66,3 +66,10 @@ STATUS_CODES = {
     505: "HTTP Version Not Supported",
     511: "Network Authentication Required",
 }
+
+# File name suffixes of precompressed variants, in order of preference
+PRECOMPRESSED_SUFFIXES = {
+    "br": ".br",
+    "zstd": ".zst",
+    "gzip": ".gz",
+}
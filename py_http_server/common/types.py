@@ -6,104 +6,242 @@ if TYPE_CHECKING:
     from ..http.response import HTTPResponse
     from collections.abc import Iterator
 
-from collections import OrderedDict
 from collections.abc import Callable, Mapping, MutableMapping
 from abc import ABC, abstractmethod
+import sys
 
+# Interned lowercase header names by name, bounded so that clients can't grow it without limit
+_LOWER_NAMES: dict[str, str] = {}
+_LOWER_NAMES_MAXSIZE = 4096
 
-class CaseInsensitiveDict[V_T](MutableMapping[str, V_T]):
-    """LICENSE NOTICE:
-    The CaseInsensitiveDict class is part of the Requests library and is distributed under the Apache License 2.0.
-    For licensing details, refer to `requests.LICENSE` and `requests.NOTICE`.
-    Note that this code has been modified from its original version.
-    """
-
-    """A case-insensitive ``dict``-like object.
 
-    Implements all methods and operations of
-    ``MutableMapping`` as well as dict's ``copy``. Also
-    provides ``lower_items``.
+def _lower_name(name: str) -> str:
+    try:
+        return _LOWER_NAMES[name]
+    except KeyError:
+        lower = sys.intern(name.lower())
+        if len(_LOWER_NAMES) < _LOWER_NAMES_MAXSIZE:
+            _LOWER_NAMES[name] = lower
+        return lower
 
-    All keys are expected to be strings. The structure remembers the
-    case of the last key to be set, and ``iter(instance)``,
-    ``keys()``, ``items()``, ``iterkeys()``, and ``iteritems()``
-    will contain case-sensitive keys. However, querying and contains
-    testing is case insensitive::
 
-        cid = CaseInsensitiveDict()
-        cid['Accept'] = 'application/json'
-        cid['aCCEPT'] == 'application/json'  # True
-        list(cid) == ['Accept']  # True
+class HeaderContainer(MutableMapping[str, str]):
+    """A case-insensitive mapping of header fields that keeps repeated fields.
 
-    For example, ``headers['content-encoding']`` will return the
-    value of a ``'Content-Encoding'`` response header, regardless
-    of how the header name was originally stored.
+    Fields are kept in parallel lists in the order they were added, which
+    is faster than a dict for the few fields of a HTTP message. Mapping
+    operations see each field name once: reading returns the values of a
+    repeated field joined with ", " (RFC9110 section 5.3), writing replaces
+    all of them. Use add(), get_all() and multi_items() for fields such as
+    Set-Cookie that can't be combined. The case of the last name set is
+    remembered.
 
-    If the constructor, ``.update``, or equality comparison
-    operations are given keys that have equal ``.lower()``s, the
-    behavior is undefined.
+    encode() keeps the serialized fields and copies share them, so fields
+    of static sets such as the default headers of a HTTPResponseFactory
+    are only encoded once. Changing an encoded field drops them.
     """
 
-    def __init__(self, data=None, /, **kwargs):
-        self.__store: OrderedDict[str, tuple[str, V_T]] = OrderedDict()
-        if data is not None:
-            self.update(data)
-        if kwargs:
-            self.update(kwargs)
-
-    def __setitem__(self, key: str, value: V_T):
-        # Uses lowercase key for lookup and stores the cased key
-        self.__store[key.lower()] = (key, value)
+    __slots__ = (
+        "__lower",
+        "__names",
+        "__values",
+        "__repeated",
+        "__encoded",
+        "__encoded_count",
+    )
 
-    def __getitem__(self, key: str) -> V_T:
-        # Uses lowercase key for lookup
-        return self.__store[key.lower()][1]
+    def __init__(self, data=None, /, **kwargs):
+        self.__lower: list[str] = []
+        self.__names: list[str] = []
+        self.__values: list[str] = []
+        # True if a field may be repeated, lets lookups skip counting
+        self.__repeated = False
+        # Serialized header lines of the first __encoded_count fields
+        self.__encoded = b""
+        self.__encoded_count = 0
+        if isinstance(data, HeaderContainer):
+            self.__lower = data.__lower.copy()
+            self.__names = data.__names.copy()
+            self.__values = data.__values.copy()
+            self.__repeated = data.__repeated
+            self.__encoded = data.__encoded
+            self.__encoded_count = data.__encoded_count
+        elif data is not None:
+            # Mappings that keep repeated fields may yield them separately
+            items = data.items() if isinstance(data, Mapping) else data
+            for key, value in items:
+                self.add(key, value)
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def __getitem__(self, key: str) -> str:
+        lower = _LOWER_NAMES.get(key) or _lower_name(key)
+        try:
+            index = self.__lower.index(lower)
+        except ValueError:
+            raise KeyError(key) from None
+
+        if not self.__repeated or self.__lower.count(lower) == 1:
+            return self.__values[index]
+        return ", ".join(self.get_all(key))
+
+    def __setitem__(self, key: str, value: str):
+        lower = _LOWER_NAMES.get(key) or _lower_name(key)
+        try:
+            index = self.__lower.index(lower)
+        except ValueError:
+            self.__lower.append(lower)
+            self.__names.append(key)
+            self.__values.append(value)
+            return
+
+        self.__names[index] = key
+        self.__values[index] = value
+        if index < self.__encoded_count:
+            self.__encoded, self.__encoded_count = b"", 0
+        if self.__repeated and self.__lower.count(lower) > 1:
+            self.__remove(lower, index + 1)
 
     def __delitem__(self, key: str):
-        # Uses lowercase key for lookup
-        del self.__store[key.lower()]
+        lower = _LOWER_NAMES.get(key) or _lower_name(key)
+        if lower not in self.__lower:
+            raise KeyError(key)
+        if self.__repeated:
+            self.__remove(lower, 0)
+            return
+        index = self.__lower.index(lower)
+        del self.__lower[index], self.__names[index], self.__values[index]
+        if index < self.__encoded_count:
+            self.__encoded, self.__encoded_count = b"", 0
+
+    def __remove(self, lower: str, start: int):
+        # Removes the fields named lower from index start
+        if start < self.__encoded_count:
+            self.__encoded, self.__encoded_count = b"", 0
+        keep = [i for i, x in enumerate(self.__lower) if i < start or x != lower]
+        self.__lower = [self.__lower[i] for i in keep]
+        self.__names = [self.__names[i] for i in keep]
+        self.__values = [self.__values[i] for i in keep]
+
+    def __contains__(self, key) -> bool:
+        return (
+            isinstance(key, str)
+            and (_LOWER_NAMES.get(key) or _lower_name(key)) in self.__lower
+        )
 
     def __iter__(self) -> "Iterator[str]":
-        # Returns cased keys
-        return (k for k, _ in self.__store.values())
+        # Returns cased keys, repeated fields once
+        if not self.__repeated:
+            return iter(self.__names.copy())
+        return iter([self.__names[self.__lower.index(x)] for x in self.__unique()])
 
     def __len__(self) -> int:
-        return len(self.__store)
-
-    def lower_items(self) -> "Iterator[tuple[str, V_T]]":
+        return len(set(self.__lower)) if self.__repeated else len(self.__lower)
+
+    def __unique(self) -> list[str]:
+        return list(dict.fromkeys(self.__lower))
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key: str, default: str) -> str:
+        lower = _LOWER_NAMES.get(key) or _lower_name(key)
+        if lower in self.__lower:
+            return self[key]
+        self.__lower.append(lower)
+        self.__names.append(key)
+        self.__values.append(default)
+        return default
+
+    def get_all(self, key: str) -> list[str]:
+        """Returns the values of all fields named key in order."""
+        lower = _lower_name(key)
+        return [v for x, v in zip(self.__lower, self.__values) if x == lower]
+
+    def add(self, key: str, value: str):
+        """Adds a field, keeping existing fields of the same name."""
+        lower = _LOWER_NAMES.get(key) or _lower_name(key)
+        if lower in self.__lower:
+            self.__repeated = True
+        self.__lower.append(lower)
+        self.__names.append(key)
+        self.__values.append(value)
+
+    def multi_items(self) -> "Iterator[tuple[str, str]]":
+        """Like items(), but returns each field separately, e.g. to serialize them."""
+        return zip(self.__names.copy(), self.__values.copy())
+
+    def lower_items(self) -> "Iterator[tuple[str, str]]":
         # Like items(), but with lowercase keys.
-        return ((k, v[1]) for k, v in self.__store.items())
+        return ((x, self[x]) for x in self.__unique())
+
+    def encode(self) -> bytes:
+        """Returns the fields serialized as header lines, each field separately.
+        Only the fields added since the last call are encoded.
+        """
+        count = len(self.__names)
+        if self.__encoded_count < count:
+            start = self.__encoded_count
+            lines = "".join(
+                f"{name}: {value}\r\n"
+                for name, value in zip(self.__names[start:], self.__values[start:])
+            )
+            # Headers are always ASCII encoded
+            self.__encoded += lines.encode("ascii")
+            self.__encoded_count = count
+        return self.__encoded
+
+    def update(self, other=(), /, **kwargs):
+        # Replaces fields in place, repeated fields of other are kept
+        if isinstance(other, HeaderContainer):
+            for lower in other.__unique():
+                values = other.get_all(lower)
+                name = other.__names[other.__lower.index(lower)]
+                self[name] = values[0]
+                for value in values[1:]:
+                    self.add(name, value)
+        elif isinstance(other, Mapping):
+            for key in other:
+                self[key] = other[key]
+        else:
+            for key, value in other:
+                self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
 
     def __eq__(self, other):
         # Compares lowercase keys and values
         if not isinstance(other, Mapping):
             return NotImplemented
 
-        if not isinstance(other, CaseInsensitiveDict):
-            other = CaseInsensitiveDict(other)
+        if not isinstance(other, HeaderContainer):
+            other = HeaderContainer(other)
 
         return dict(self.lower_items()) == dict(other.lower_items())
 
-    def __or__(self, other) -> "CaseInsensitiveDict[V_T]":
+    def __or__(self, other) -> "HeaderContainer":
         if not isinstance(other, Mapping):
             return NotImplemented
 
-        new = CaseInsensitiveDict(self)
+        new = HeaderContainer(self)
         new.update(other)
         return new
 
-    def __ior__(self, other) -> "CaseInsensitiveDict[V_T]":
+    def __ior__(self, other) -> "HeaderContainer":
         if not isinstance(other, Mapping):
             return NotImplemented
 
         self.update(other)
         return self
 
-    def copy(self) -> "CaseInsensitiveDict[V_T]":
-        return CaseInsensitiveDict(self)
+    def copy(self) -> "HeaderContainer":
+        return HeaderContainer(self)
 
     def __repr__(self) -> str:
-        return f"CaseInsensitiveDict({repr(dict(self.items()))})"
+        return f"HeaderContainer({repr(list(self.multi_items()))})"
 
 
 class RequestHandlerABC(ABC):
@@ -114,5 +252,3 @@ class RequestHandlerABC(ABC):
 
 
 RequestHandler = Callable[["ConnectionInfo", "HTTPRequest"], "HTTPResponse"]
-
-HeaderContainer = CaseInsensitiveDict[str]
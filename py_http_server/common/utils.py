@@ -2,6 +2,8 @@ from .constants import HEADER_DATE_FORMAT
 from datetime import datetime, timezone
 from typing import Optional
 from pathlib import Path
+import os
+import time
 
 
 # Parse HTTP header date format
@@ -17,7 +19,52 @@ def to_http_date(value: datetime) -> str:
     return value.strftime(HEADER_DATE_FORMAT)
 
 
+# The current second and its HTTP date, shared by all threads
+_current_http_date = (0, "")
+
+
+# Current time in HTTP header date format, formatted once per second
+def http_date_now() -> str:
+    global _current_http_date
+    now = int(time.time())
+    cached = _current_http_date
+    if cached[0] != now:
+        cached = (now, to_http_date(datetime.fromtimestamp(now, timezone.utc)))
+        _current_http_date = cached
+    return cached[1]
+
+
 # Generate weak ETag
-def file_etag(path: Path) -> str:
-    stat = path.stat()
+def file_etag(path: Path, stat: Optional[os.stat_result] = None) -> str:
+    stat = stat or path.stat()
     return f'W/"{stat.st_size}-{stat.st_mtime_ns}"'
+
+
+# Parse Accept-Encoding into the set of acceptable codings, honors "q=0"
+def accepted_encodings(value: str) -> set[str]:
+    result = set()
+    for item in value.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        name, _, qvalue = params.strip().partition("=")
+        if name.strip().lower() == "q":
+            try:
+                if float(qvalue) <= 0:
+                    continue
+            except ValueError:
+                continue
+        result.add(coding)
+    return result
+
+
+# Parse Cache-Control directives, names are lowercased and valueless directives map to None
+def parse_cache_control(value: str) -> dict[str, Optional[str]]:
+    result = {}
+    for item in value.split(","):
+        name, eq, val = item.partition("=")
+        name = name.strip().lower()
+        if name:
+            result[name] = val.strip().strip('"') if eq else None
+    return result
@@ -0,0 +1,58 @@
+from ..networking.connection_socket import ConnectionSocket
+from ..common import HeaderContainer
+from typing import Optional
+
+
+def receive_head(
+    conn: ConnectionSocket,
+    max_header_size: int = 32768,
+    recv_buffer_size: int = 32768,
+) -> tuple[list[str], bytes]:
+    """Receives the start line and header section of a HTTP/1.x message.
+    Returns the lines and the bytes received after the header section.
+    """
+    data = b""
+    while b"\r\n\r\n" not in data:
+        if len(data) > max_header_size:
+            raise ValueError("Header size exceeds maximum allowed length")
+        data += conn.recv(recv_buffer_size)
+    head, _, rest = data.partition(b"\r\n\r\n")
+
+    # The last read may contain a part of the body
+    if len(head) > max_header_size:
+        raise ValueError("Header size exceeds maximum allowed length")
+
+    try:
+        return head.decode(encoding="ascii").split("\r\n"), rest
+    except UnicodeDecodeError as exc:
+        raise ValueError(f"Header is malformed. Exception: {exc}")
+
+
+def parse_header_lines(lines: list[str]) -> HeaderContainer:
+    headers = HeaderContainer()
+    for line in lines:
+        key, _, val = line.partition(":")
+        val = val.strip()
+
+        # Repeated headers are kept, reading them combines them as described in RFC9110 section 5.3
+        headers.add(key, val)
+    return headers
+
+
+def get_content_length(headers: HeaderContainer) -> Optional[int]:
+    """Returns the value of Content-Length, None if it isn't set.
+    Raises ValueError if it's repeated or not a number, the length of the body
+    is unknown then and the message must be rejected (RFC9112 section 6.3).
+    """
+    values = headers.get_all("Content-Length")
+    if not values:
+        return None
+    if len(values) > 1 or not values[0].isdigit():
+        raise ValueError(f"Invalid Content-Length: {', '.join(values)}")
+    return int(values[0])
+
+
+def is_chunked(headers: HeaderContainer) -> bool:
+    return "chunked" in [
+        x.strip().lower() for x in headers.get("Transfer-Encoding", "").split(",")
+    ]
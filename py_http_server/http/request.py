@@ -1,9 +1,15 @@
 from ..networking.connection_socket import ConnectionSocket
 from ..common import HTTP_VERSIONS, HeaderContainer
+from .request_body import RequestBody
+from .parser import receive_head, parse_header_lines, get_content_length, is_chunked
+from typing import Optional, Union
 import urllib.parse
 
 
 class HTTPRequest:
+    # Fields are plain slots, they are read many times per request
+    __slots__ = ("method", "path", "query", "headers", "__version", "__body")
+
     def __init__(
         self,
         method: str,
@@ -11,38 +17,14 @@ class HTTPRequest:
         query: str,
         headers: HeaderContainer,
         version: str,
-        body: bytes,
+        body: Union[bytes, RequestBody],
     ):
         self.method = method
         self.path = path
         self.query = query
-        self.version = version
         self.headers = headers
-        self.body = body
-
-    @property
-    def method(self):
-        return self.__method
-
-    @method.setter
-    def method(self, value: str):
-        self.__method = value
-
-    @property
-    def path(self):
-        return self.__path
-
-    @path.setter
-    def path(self, value: str):
-        self.__path = value
-
-    @property
-    def query(self):
-        return self.__query
-
-    @query.setter
-    def query(self, value: str):
-        self.__query = value
+        self.__version = version.upper()
+        self.__body = body
 
     @property
     def version(self):
@@ -53,28 +35,30 @@ class HTTPRequest:
         self.__version = value.upper()
 
     @property
-    def headers(self):
-        return self.__headers
-
-    @headers.setter
-    def headers(self, value: HeaderContainer):
-        self.__headers = value
-
-    @property
-    def body(self):
+    def body(self) -> bytes:
+        # Streamed bodies are read on first access
+        if isinstance(self.__body, RequestBody):
+            self.__body = self.__body.read_all()
         return self.__body
 
     @body.setter
-    def body(self, value: bytes):
+    def body(self, value: Union[bytes, RequestBody]):
         self.__body = value
 
+    @property
+    def body_stream(self) -> Optional[RequestBody]:
+        """The body if it hasn't been read yet, for handlers that consume it incrementally.
+        None if the body is already buffered in memory.
+        """
+        return self.__body if isinstance(self.__body, RequestBody) else None
+
     def to_url(self, host: str, schema: str):
-        quoted_path = urllib.parse.quote(self.__path)
-        return f"{schema}://{host}{quoted_path}{self.__query}"
+        quoted_path = urllib.parse.quote(self.path)
+        return f"{schema}://{host}{quoted_path}{self.query}"
 
     def __str__(self):
-        quoted_path = urllib.parse.quote(self.__path)
-        return f"{self.__method} {quoted_path}{self.__query} {self.__version}"
+        quoted_path = urllib.parse.quote(self.path)
+        return f"{self.method} {quoted_path}{self.query} {self.__version}"
 
     @staticmethod
     def receive_from(
@@ -83,38 +67,35 @@ class HTTPRequest:
         max_header_size: int = 32768,
         recv_buffer_size: int = 32768,
     ):
-        response = b""
-        while b"\r\n\r\n" not in response:
-            response += conn.recv(recv_buffer_size)
-            if len(response) > max_header_size:
-                raise ValueError("Header size exceeds maximum allowed length")
-        headers_raw, _, body = response.partition(b"\r\n\r\n")
+        header_lines, body = receive_head(conn, max_header_size, recv_buffer_size)
 
         try:
-            header_lines = headers_raw.decode(encoding="ascii").split("\r\n")
             method, path, version = header_lines[0].split(" ")
 
             if version not in HTTP_VERSIONS:
                 raise ValueError("Invalid HTTP version")
 
-            headers = HeaderContainer()
-            for line in header_lines[1:]:
-                key, _, val = line.partition(":")
-                headers[key] = val.strip()
-        except (IndexError, ValueError, UnicodeDecodeError) as exc:
+            headers = parse_header_lines(header_lines[1:])
+            content_length = get_content_length(headers)
+        except (IndexError, ValueError) as exc:
             raise ValueError(f"Request header is malformed. Exception: {exc}")
 
-        content_length = (
-            int(headers["Content-Length"])
-            if headers.get("Content-Length", "").isdigit()
-            else None
-        )
-
-        if content_length:
-            if content_length > max_content_length:
-                raise ValueError("Content-Length is too large")
-            while len(body) < content_length:
-                body += conn.recv(min(recv_buffer_size, content_length - len(body)))
+        chunked = is_chunked(headers)
+
+        # The body is read from the connection when the handler needs it
+        # max_content_length only applies if it's read into memory
+        request_body: Union[bytes, RequestBody] = b""
+        if not chunked and not content_length:
+            # Bytes after the header belong to the next request
+            conn.unrecv(body)
+        else:
+            request_body = RequestBody(
+                conn,
+                body,
+                None if chunked else content_length,
+                max_content_length,
+                recv_buffer_size,
+            )
 
         # Parse percent encoding
         # Warning: This step is necessary to prevent unexpected vulnerabilities
@@ -124,4 +105,4 @@ class HTTPRequest:
         path, qm, query = path.partition("?")
         query = qm + query
 
-        return HTTPRequest(method, path, query, headers, version, body)
+        return HTTPRequest(method, path, query, headers, version, request_body)
@@ -0,0 +1,178 @@
+from collections.abc import Iterator
+from typing import Optional
+from ..networking.connection_socket import ConnectionSocket
+from ..memory import MemoryLimitError
+
+MAX_CHUNK_LINE_SIZE = 4096
+
+
+class RequestBody:
+    """Request body that is read from the connection on demand.
+
+    Supports Content-Length and chunked framing. At most recv_buffer_size
+    bytes are held at once unless the whole body is requested with
+    read_all(), which is limited to max_buffered_size bytes and reserved
+    in the memory account of the connection.
+    """
+
+    def __init__(
+        self,
+        conn: ConnectionSocket,
+        buffer: bytes,
+        length: Optional[int],
+        max_buffered_size: int = 10_000_000,
+        recv_buffer_size: int = 32768,
+    ):
+        """Inits RequestBody.
+
+        Args:
+        conn -- Connection to read the body from.
+        buffer -- Bytes of the body already received with the header.
+        length -- Content-Length of the body, None if it is chunked.
+        max_buffered_size -- Maximum size of the body returned by read_all().
+        recv_buffer_size -- Maximum number of bytes received at once.
+        """
+        self.__conn = conn
+        self.__buffer = buffer
+        self.__length = length
+        self.__max_buffered_size = max_buffered_size
+        self.__recv_buffer_size = recv_buffer_size
+
+        # Bytes left in the body or the current chunk
+        self.__remaining = length or 0
+        self.__chunk_ended = False
+        self.__consumed = length == 0
+        self.__started = False
+
+        if length is not None:
+            # Bytes after the body belong to the next request
+            conn.unrecv(buffer[length:])
+            self.__buffer = buffer[:length]
+
+    @property
+    def length(self) -> Optional[int]:
+        return self.__length
+
+    @property
+    def consumed(self) -> bool:
+        return self.__consumed
+
+    @property
+    def started(self) -> bool:
+        """True if any part of the body has been read."""
+        return self.__started
+
+    def __recv(self):
+        self.__buffer += self.__conn.recv(self.__recv_buffer_size)
+
+    def __read_line(self) -> bytes:
+        while b"\r\n" not in self.__buffer:
+            if len(self.__buffer) > MAX_CHUNK_LINE_SIZE:
+                raise ValueError("Chunk header is too large")
+            self.__recv()
+        line, _, self.__buffer = self.__buffer.partition(b"\r\n")
+        return line
+
+    def __next_chunk(self):
+        # Chunk data is followed by CRLF
+        if self.__chunk_ended and self.__read_line():
+            raise ValueError("Chunk is malformed")
+        self.__chunk_ended = True
+
+        try:
+            self.__remaining = int(self.__read_line().split(b";")[0].strip(), 16)
+        except ValueError:
+            raise ValueError("Chunk size is malformed")
+
+        if self.__remaining == 0:
+            # Skip the trailer section
+            while self.__read_line():
+                pass
+            self.__consumed = True
+
+            # Bytes after the body belong to the next request
+            self.__conn.unrecv(self.__buffer)
+            self.__buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        """Returns up to size bytes of the body, or the rest of it if size is negative.
+        Returns b"" once the body is consumed.
+        """
+        if size < 0:
+            return self.read_all()
+        self.__started = True
+
+        if self.__length is None and self.__remaining == 0 and not self.__consumed:
+            self.__next_chunk()
+        if self.__consumed or size == 0:
+            return b""
+
+        if not self.__buffer:
+            self.__buffer = self.__conn.recv(
+                min(self.__recv_buffer_size, self.__remaining)
+            )
+
+        data = self.__buffer[: min(size, self.__remaining)]
+        self.__buffer = self.__buffer[len(data) :]
+        self.__remaining -= len(data)
+        if self.__length is not None and self.__remaining == 0:
+            self.__consumed = True
+        return data
+
+    def readinto(self, buffer) -> int:
+        """Reads up to len(buffer) bytes of the body into buffer, returns the number of bytes read."""
+        view = memoryview(buffer).cast("B")
+        self.__started = True
+
+        # Receive directly into the buffer if nothing is buffered
+        if (
+            self.__length is not None
+            and view
+            and not self.__buffer
+            and not self.__consumed
+        ):
+            count = self.__conn.recv_into(view, min(len(view), self.__remaining))
+            self.__remaining -= count
+            self.__consumed = self.__remaining == 0
+            return count
+
+        data = self.read(len(view))
+        view[: len(data)] = data
+        return len(data)
+
+    def read_all(self) -> bytes:
+        """Returns the rest of the body. Raises MemoryLimitError if it's larger than
+        max_buffered_size or doesn't fit in the memory account of the connection.
+        """
+        if self.__length is not None and self.__length > self.__max_buffered_size:
+            raise MemoryLimitError("Content-Length is too large", 413)
+
+        # Bodies of known length are reserved at once, chunked ones as they arrive
+        memory = self.__conn.memory
+        if memory and self.__length is not None:
+            memory.reserve("request_body", self.__remaining)
+
+        data = bytearray()
+        while chunk := self.read(self.__recv_buffer_size):
+            data += chunk
+            if len(data) > self.__max_buffered_size:
+                raise MemoryLimitError("Request body is too large", 413)
+            if memory and self.__length is None:
+                memory.reserve("request_body", len(chunk))
+        return bytes(data)
+
+    def discard(self, limit: int) -> bool:
+        """Reads and drops the rest of the body if it's at most limit bytes.
+        Returns True if the body is consumed.
+        """
+        if self.__length is not None and self.__remaining > limit:
+            return False
+
+        discarded = 0
+        while not self.__consumed and discarded <= limit:
+            discarded += len(self.read(self.__recv_buffer_size))
+        return self.__consumed
+
+    def __iter__(self) -> Iterator[bytes]:
+        while chunk := self.read(self.__recv_buffer_size):
+            yield chunk
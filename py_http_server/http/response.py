@@ -1,93 +1,119 @@
 from ..networking.connection_socket import ConnectionSocket
-from ..common import STATUS_CODES, HeaderContainer
-from .response_body import ResponseBody
+from ..common import STATUS_CODES, HTTP_VERSIONS, HeaderContainer
+from .response_body import LazyBody, ResponseBody
+from ..metrics import REGISTRY
 from typing import Any, Optional
 import json
 
+_RESPONSES = REGISTRY.counter("http_responses", "Responses sent", ["code"])
+_RESPONSE_BYTES = REGISTRY.counter(
+    "http_response_bytes", "Bytes sent for responses, headers included"
+)
+
+# Pre-encoded status lines by HTTP version and status code
+STATUS_LINES = {
+    (version, code): f"{version} {code} {reason}\r\n".encode("ascii")
+    for version in HTTP_VERSIONS
+    for code, reason in STATUS_CODES.items()
+}
+
+
+def _status_line(http_version: str, status_code: int) -> bytes:
+    try:
+        return STATUS_LINES[(http_version, status_code)]
+    except KeyError:
+        reason = STATUS_CODES.get(status_code)
+        status_code_str = f"{status_code} {reason}" if reason else str(status_code)
+        return f"{http_version} {status_code_str}\r\n".encode("ascii")
+
 
 class HTTPResponse:
+    # Fields are plain slots, they are read many times per request
+    __slots__ = ("status_code", "headers", "body")
+
     def __init__(
         self,
         status_code: int,
-        headers: HeaderContainer = HeaderContainer(),
+        headers: Optional[HeaderContainer] = None,
         body: Optional[ResponseBody] = None,
     ):
+        """headers: Not copied, a new container is created if None."""
         self.status_code = status_code
-        self.headers = headers
+        self.headers = HeaderContainer() if headers is None else headers
         self.body = body
 
-    @property
-    def status_code(self):
-        return self.__status_code
-
-    @status_code.setter
-    def status_code(self, value: int):
-        self.__status_code = value
-
-    @property
-    def headers(self):
-        return self.__headers
-
-    @headers.setter
-    def headers(self, value: HeaderContainer):
-        self.__headers = value
-
-    @property
-    def body(self):
-        return self.__body
-
-    @body.setter
-    def body(self, value: Optional[ResponseBody]):
-        self.__body = value
-
-    def send_to(self, conn: ConnectionSocket, http_version: str):
-        if self.body:
-            self.__headers = self.body.process_headers(self.__headers)
-        else:
-            self.__headers["Content-Length"] = "0"
-
-        header_lines = "".join(
-            f"{header}: {value}\r\n" for header, value in self.__headers.items()
-        )
-
-        status_code_str = str(self.__status_code)
-        if self.__status_code in STATUS_CODES:
-            status_code_str += f" {STATUS_CODES[self.__status_code]}"
-
-        # Headers are always ASCII encoded
-        response_header = (
-            f"{http_version} {status_code_str}\r\n{header_lines}\r\n".encode("ascii")
+    def send_to(
+        self, conn: ConnectionSocket, http_version: str, include_body: bool = True
+    ):
+        """include_body: If False, only the headers are sent and the body is left untouched.
+        Used for HEAD requests, bodies still add their headers unless they'd have to be built.
+        """
+        bytes_sent = conn.bytes_sent
+        if not self.body:
+            self.headers["Content-Length"] = "0"
+        elif (
+            include_body
+            or not isinstance(self.body, LazyBody)
+            or self.body.materialized
+        ):
+            self.headers = self.body.process_headers(self.headers)
+
+        conn.send(
+            b"".join(
+                (
+                    _status_line(http_version, self.status_code),
+                    self.headers.encode(),
+                    b"\r\n",
+                )
+            )
         )
-        conn.send(response_header)
 
-        if self.body:
+        if self.body and include_body:
             self.body.send_to(conn)
 
         # Optimize time-to-response
         conn.flush()
 
+        _RESPONSES.labels(self.status_code).inc()
+        _RESPONSE_BYTES.inc(conn.bytes_sent - bytes_sent)
+
 
 class HTTPResponseFactory:
     def __init__(
         self,
-        default_headers: HeaderContainer = HeaderContainer(),
+        default_headers: Optional[HeaderContainer] = None,
         default_encoding: str = "utf-8",
     ):
-        self.default_headers = default_headers
+        self.default_headers = (
+            HeaderContainer() if default_headers is None else default_headers
+        )
         self.default_encoding = default_encoding
 
+        # Copies share the encoded default headers
+        self.default_headers.encode()
+
+    def __headers(
+        self,
+        additional_headers: Optional[HeaderContainer],
+        content_type: Optional[str] = None,
+    ) -> HeaderContainer:
+        headers = self.default_headers.copy()
+        if additional_headers:
+            headers.update(additional_headers)
+        if content_type:
+            headers["Content-Type"] = content_type
+        return headers
+
     def json(
         self,
         value: Any,
         status_code: int = 200,
-        additional_headers: HeaderContainer = HeaderContainer(),
+        additional_headers: Optional[HeaderContainer] = None,
         encoding: Optional[str] = None,
     ) -> HTTPResponse:
         encoding = encoding if encoding else self.default_encoding
-        headers = (
-            self.default_headers
-            | additional_headers
-            | {"Content-Type": f"application/json; charset={encoding}"}
+        headers = self.__headers(
+            additional_headers, f"application/json; charset={encoding}"
         )
 
         return HTTPResponse(
@@ -100,15 +126,11 @@ class HTTPResponseFactory:
         self,
         value: str,
         status_code: int = 200,
-        additional_headers: HeaderContainer = HeaderContainer(),
+        additional_headers: Optional[HeaderContainer] = None,
         encoding: Optional[str] = None,
     ) -> HTTPResponse:
         encoding = encoding if encoding else self.default_encoding
-        headers = (
-            self.default_headers
-            | additional_headers
-            | {"Content-Type": f"text/html; charset={encoding}"}
-        )
+        headers = self.__headers(additional_headers, f"text/html; charset={encoding}")
 
         return HTTPResponse(
             status_code,
@@ -119,12 +141,10 @@ class HTTPResponseFactory:
     def status(
         self,
         status_code: int,
-        additional_headers: HeaderContainer = HeaderContainer(),
+        additional_headers: Optional[HeaderContainer] = None,
         encoding: Optional[str] = None,
     ) -> HTTPResponse:
         encoding = encoding if encoding else self.default_encoding
-        headers = self.default_headers | additional_headers
-
         if (
             status_code in STATUS_CODES
             and status_code >= 200
@@ -133,18 +153,19 @@ class HTTPResponseFactory:
             # Set the body to the status code text
             return HTTPResponse(
                 status_code,
-                headers | {"Content-Type": f"text/plain; charset={encoding}"},
+                self.__headers(additional_headers, f"text/plain; charset={encoding}"),
                 ResponseBody.from_bytes(STATUS_CODES[status_code].encode(encoding)),
             )
 
         # Status code is not allowed to have a body or is unknown
-        return HTTPResponse(status_code, headers)
+        return HTTPResponse(status_code, self.__headers(additional_headers))
 
     def redirect(
         self,
         location: str,
         permanent: bool = False,
-        additional_headers: HeaderContainer = HeaderContainer(),
+        additional_headers: Optional[HeaderContainer] = None,
     ) -> HTTPResponse:
-        headers = additional_headers | {"Location": location}
+        headers = HeaderContainer(additional_headers)
+        headers["Location"] = location
         return self.status(301 if permanent else 302, headers)
@@ -1,8 +1,12 @@
 from pathlib import Path
 from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterable, Iterator
 from io import IOBase
+from typing import BinaryIO, Optional
 from ..common import HeaderContainer
 from ..networking.connection_socket import ConnectionSocket
+from ..networking.tunnel_relay import TunnelRelay
+import os
 
 
 class ResponseBody(ABC):
@@ -19,26 +23,37 @@ class ResponseBody(ABC):
     def send_to(self, conn: ConnectionSocket) -> None: ...
 
     @staticmethod
-    def from_file(file_path: Path):
-        return FileBody(file_path)
+    def from_file(file_path: Path, length: Optional[int] = None):
+        return FileBody(file_path, length)
 
     @staticmethod
-    def from_bytes(value: bytes):
-        return BytesBody(value)
+    def from_bytes(value: bytes, memory_kind: str = "response_body"):
+        return BytesBody(value, memory_kind)
 
     @staticmethod
-    def from_stream(stream: IOBase):
-        return StreamingBody(stream)
+    def from_stream(
+        stream: IOBase, length: Optional[int] = None, buffer_size: int = 1048576
+    ):
+        """length: Size of the stream if known, keeps Content-Length instead of chunked encoding."""
+        if length is not None:
+            return PassthroughBody(stream, length, buffer_size)
+        return StreamingBody(stream, buffer_size)
+
+    @staticmethod
+    def from_iterable(iterable: Iterable[bytes]):
+        return IterableBody(iterable)
+
+    @staticmethod
+    def from_factory(
+        factory: Callable[[], "BytesBody | FileBody"], size_hint: Optional[int] = None
+    ):
+        return LazyBody(factory, size_hint)
 
 
-class StreamingBody(ResponseBody):
+class ChunkedBody(ResponseBody):
     LAST_CHUNK = b"0\r\n"
     TRAILER = b"\r\n"
 
-    def __init__(self, stream: IOBase, stream_chunk_size: int = 1048576):
-        self.__stream = stream
-        self.__stream_chunk_size = stream_chunk_size
-
     def process_headers(self, headers: HeaderContainer) -> HeaderContainer:
         return headers | {"Transfer-Encoding": "chunked"}
 
@@ -48,20 +63,89 @@ class StreamingBody(ResponseBody):
     def __make_chunk(self, val: bytes) -> bytes:
         return self.__get_chunk_size(val) + val + b"\r\n"
 
+    @abstractmethod
+    def chunks(self) -> Iterator[bytes]: ...
+
     def send_to(self, conn: ConnectionSocket):
-        while True:
-            chunk = self.__stream.read(self.__stream_chunk_size)
-            if not chunk:
-                break
-            conn.send(self.__make_chunk(chunk))
-        self.__stream.close()
+        for chunk in self.chunks():
+            # Empty chunks would terminate the body early
+            if chunk:
+                conn.send(self.__make_chunk(chunk))
         conn.send(self.LAST_CHUNK + self.TRAILER)
 
 
+class StreamingBody(ChunkedBody):
+    def __init__(self, stream: IOBase, stream_chunk_size: int = 1048576):
+        self.__stream = stream
+        self.__stream_chunk_size = stream_chunk_size
+
+    def chunks(self) -> Iterator[bytes]:
+        try:
+            while True:
+                chunk = self.__stream.read(self.__stream_chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.__stream.close()
+
+
+class PassthroughBody(ResponseBody):
+    """Relays a stream of known length without re-framing it.
+    The stream is read into a single reusable buffer and sent as is.
+    """
+
+    def __init__(self, stream: IOBase, length: int, buffer_size: int = 65536):
+        self.__stream = stream
+        self.__len = length
+        self.__buffer_size = buffer_size
+
+    def __len__(self):
+        return self.__len
+
+    def process_headers(self, headers: HeaderContainer) -> HeaderContainer:
+        return headers | {"Content-Length": str(len(self))}
+
+    def send_to(self, conn: ConnectionSocket):
+        view = memoryview(bytearray(max(1, min(self.__buffer_size, self.__len))))
+        remaining = self.__len
+        try:
+            while remaining:
+                count = self.__stream.readinto(view[: min(len(view), remaining)])
+                if not count:
+                    # Content-Length was already sent, the connection must be closed
+                    raise ConnectionError("Stream ended before the end of the body")
+                conn.sendall(view[:count])
+                remaining -= count
+        finally:
+            self.__stream.close()
+
+
+class IterableBody(ChunkedBody):
+    def __init__(self, iterable: Iterable[bytes]):
+        self.__iterable = iterable
+
+    def chunks(self) -> Iterator[bytes]:
+        return iter(self.__iterable)
+
+
 class FileBody(ResponseBody):
-    def __init__(self, file_path: Path):
+    def __init__(
+        self,
+        file_path: Path,
+        length: Optional[int] = None,
+        file: Optional[BinaryIO] = None,
+    ):
+        """Inits FileBody.
+
+        Args:
+        file_path -- Path of the file.
+        length -- Size of the file if already known, saves a stat call.
+        file -- file_path opened already, used instead of the path, which may be unlinked meanwhile. Closed once it's sent.
+        """
         self.__file_path = file_path
-        self.__len = file_path.stat().st_size
+        self.__file = file
+        self.__len = file_path.stat().st_size if length is None else length
 
     def __len__(self):
         return self.__len
@@ -73,14 +157,21 @@ class FileBody(ResponseBody):
     def process_headers(self, headers: HeaderContainer) -> HeaderContainer:
         return headers | {"Content-Length": str(len(self))}
 
+    def read_bytes(self) -> bytes:
+        if self.__file:
+            return os.pread(self.__file.fileno(), self.__len, 0)
+        return self.__file_path.read_bytes()
+
     def send_to(self, conn: ConnectionSocket):
-        with self.__file_path.open("rb") as f:
+        with self.__file or self.__file_path.open("rb") as f:
             conn.sendfile(f)
 
 
 class BytesBody(ResponseBody):
-    def __init__(self, content: bytes):
+    def __init__(self, content: bytes, memory_kind: str = "response_body"):
+        """memory_kind: Kind the content is accounted as while it's sent, see memory.KINDS."""
         self.content = content
+        self.memory_kind = memory_kind
 
     def __len__(self):
         return len(self.__content)
@@ -96,10 +187,58 @@ class BytesBody(ResponseBody):
     def process_headers(self, headers: HeaderContainer) -> HeaderContainer:
         return headers | {"Content-Length": str(len(self))}
 
+    def read_bytes(self) -> bytes:
+        return self.__content
+
     def send_to(self, conn: ConnectionSocket):
+        # Released by the connection at the end of the request
+        if conn.memory:
+            conn.memory.track(self.memory_kind, len(self.__content))
         conn.send(self.content)
 
 
+class LazyBody(ResponseBody):
+    """Defers building a BytesBody or FileBody until it is needed, which is
+    usually when the response is sent. Responses to HEAD requests and
+    responses that are discarded never call the factory.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], BytesBody | FileBody],
+        size_hint: Optional[int] = None,
+    ):
+        """size_hint: Expected size of the body, lets middlewares decide without materializing it."""
+        self.__factory = factory
+        self.__size_hint = size_hint
+        self.__body: Optional[BytesBody | FileBody] = None
+
+    @property
+    def size_hint(self) -> Optional[int]:
+        return self.__size_hint
+
+    @property
+    def materialized(self) -> bool:
+        return self.__body is not None
+
+    def materialize(self) -> BytesBody | FileBody:
+        if self.__body is None:
+            self.__body = self.__factory()
+        return self.__body
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def read_bytes(self) -> bytes:
+        return self.materialize().read_bytes()
+
+    def process_headers(self, headers: HeaderContainer) -> HeaderContainer:
+        return self.materialize().process_headers(headers)
+
+    def send_to(self, conn: ConnectionSocket):
+        self.materialize().send_to(conn)
+
+
 # To be used for HEAD responses, does not set Content-Length
 class EmptyBody(ResponseBody):
     def send_to(self, conn: ConnectionSocket):
@@ -108,30 +247,15 @@ class EmptyBody(ResponseBody):
 
 # To be used for CONNECT responses, clears headers
 class CONNECTTunnelBody(ResponseBody):
-    def __init__(self, remote: ConnectionSocket, stream_chunk_size: int = 1048576):
+    def __init__(self, remote: ConnectionSocket, relay: TunnelRelay):
+        """relay: Takes over both connections after the response header is sent."""
         self.__remote = remote
-        self.__stream_chunk_size = stream_chunk_size
+        self.__relay = relay
 
     def process_headers(self, headers: HeaderContainer) -> HeaderContainer:
         # CONNECT responses have no headers
         return HeaderContainer()
 
     def send_to(self, conn: ConnectionSocket):
-        with conn.nonblocking(), self.__remote.nonblocking():
-            while True:
-                try:
-                    readables = ConnectionSocket.wait_any_readable(
-                        {conn, self.__remote}
-                    )
-
-                    if conn in readables:
-                        self.__remote.send(conn.recv(self.__stream_chunk_size))
-
-                    if self.__remote in readables:
-                        conn.send(self.__remote.recv(self.__stream_chunk_size))
-                except BlockingIOError:
-                    # This shouldn't happen
-                    pass
-                except ConnectionError:
-                    break
-        self.__remote.close()
+        # The connection is detached, it's no longer used for requests
+        self.__relay.add(conn, self.__remote)
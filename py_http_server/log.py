@@ -29,17 +29,26 @@ class ColoredFormatter(logging.Formatter):
 _console_handler = logging.StreamHandler()
 _console_handler.setFormatter(ColoredFormatter())
 _log_level = logging.DEBUG
+# Loggers are created at import time, before init() sets the level
+_loggers: list[logging.Logger] = []
 
 
 def getLogger(name: str):
     logger = logging.getLogger(name)
     logger.handlers = [_console_handler]
     logger.setLevel(_log_level)
+    _loggers.append(logger)
     return logger
 
 
 def init(log_level=logging.DEBUG):
+    """Sets the level of all loggers, messages below it cost a level check.
+    Use %-style arguments instead of f-strings for messages logged per request.
+    """
+    global _log_level
     _log_level = log_level
+    for logger in _loggers:
+        logger.setLevel(log_level)
 
 
 def shutdown():
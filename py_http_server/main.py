@@ -2,7 +2,9 @@ from typing import Optional
 from .networking.listener import ListenerThread
 from .networking.address import TCPAddress
 from .common import RequestHandler
+from .access_log import AccessLog
 from . import log
+import logging
 import time
 
 LOG = log.getLogger("main")
@@ -14,8 +16,10 @@ def app_main(
     https_listeners: list[TCPAddress] = [],
     https_key_file: Optional[str] = None,
     https_cert_file: Optional[str] = None,
+    log_level: int = logging.DEBUG,
+    access_log: Optional[AccessLog] = None,
 ):
-    log.init()
+    log.init(log_level)
     try:
         if https_listeners and (not https_key_file or not https_cert_file):
             raise ValueError("Cannot create HTTP listeners without key and cert files")
@@ -25,7 +29,9 @@ def app_main(
         # Create HTTP listeners
         for address in http_listeners:
             try:
-                listeners.append(ListenerThread.create(address, handler_chain))
+                listeners.append(
+                    ListenerThread.create(address, handler_chain, access_log)
+                )
                 LOG.info(f"New HTTP listener on {address}")
             except Exception as exc:
                 LOG.exception(
@@ -37,7 +43,11 @@ def app_main(
             try:
                 listeners.append(
                     ListenerThread.create_ssl(
-                        address, handler_chain, https_key_file, https_cert_file
+                        address,
+                        handler_chain,
+                        https_key_file,
+                        https_cert_file,
+                        access_log,
                     )
                 )
                 LOG.info(f"New HTTPS listener on {address}")
@@ -57,6 +67,8 @@ def app_main(
         LOG.info("Exiting...")
         for listener in listeners:
             listener.dispose()
+        if access_log:
+            access_log.close()
     except Exception as exc:
         LOG.fatal("Unrecoverable error", exc_info=exc)
     log.shutdown()
@@ -0,0 +1,163 @@
+from typing import Optional
+from .metrics import REGISTRY
+import threading
+import weakref
+
+# Kinds of the accounted bytes
+KINDS = ("request_body", "response_body", "compression", "tunnel")
+
+# Kinds released by the connection at the end of each request
+REQUEST_KINDS = ("request_body", "response_body", "compression")
+
+
+class MemoryLimitError(ValueError):
+    """Raised when bytes can't be reserved within the limits of a MemoryBudget.
+
+    status_code is 413 if the bytes would never fit and 503 if they don't
+    fit right now.
+    """
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class MemoryAccount:
+    """Bytes held for one connection by kind, counted in its MemoryBudget too.
+
+    Request bodies are reserved, which fails once a limit is reached. Bytes
+    that are already held, e.g. response bodies, are only tracked.
+    """
+
+    __slots__ = ("name", "__budget", "__held", "__weakref__")
+
+    def __init__(self, budget: "MemoryBudget", name: str):
+        self.name = name
+        self.__budget = budget
+        self.__held = dict.fromkeys(KINDS, 0)
+        # Bytes of accounts that are dropped without releasing them are released then
+        weakref.finalize(self, budget.release_kinds, self.__held)
+
+    @property
+    def held(self) -> int:
+        return sum(self.__held.values())
+
+    @property
+    def held_by_kind(self) -> dict[str, int]:
+        return dict(self.__held)
+
+    def reserve(self, kind: str, nbytes: int):
+        """Accounts nbytes that are about to be held, raises MemoryLimitError if they don't fit."""
+        limit = self.__budget.connection_limit
+        if limit is not None and self.held + nbytes > limit:
+            self.__budget.reject()
+            raise MemoryLimitError(
+                f"Connection would hold more than {limit} bytes", 413
+            )
+        self.__budget.reserve(kind, nbytes)
+        self.__held[kind] += nbytes
+
+    def track(self, kind: str, nbytes: int):
+        """Accounts nbytes that are held already, negative values release them."""
+        self.__budget.track(kind, nbytes)
+        self.__held[kind] += nbytes
+
+    def release(self, *kinds: str):
+        """Releases all bytes of kinds, all kinds if none are given."""
+        for kind in kinds or KINDS:
+            if nbytes := self.__held[kind]:
+                self.__held[kind] = 0
+                self.__budget.track(kind, -nbytes)
+
+
+class MemoryBudget:
+    """Accounts the bytes held by connections and enforces memory ceilings.
+
+    Only request bodies are rejected, response bodies, compression and
+    tunnel buffers are counted but never fail.
+    """
+
+    def __init__(
+        self, limit: Optional[int] = None, connection_limit: Optional[int] = None
+    ):
+        """Inits MemoryBudget. Limits can be changed later by setting them.
+
+        Args:
+        limit -- Maximum number of bytes held by all connections, unlimited if None.
+        connection_limit -- Maximum number of bytes held by one connection, unlimited if None.
+        """
+        self.limit = limit
+        self.connection_limit = connection_limit
+
+        self.__lock = threading.Lock()
+        self.__held = dict.fromkeys(KINDS, 0)
+        self.__total = 0
+        self.__peak = 0
+        self.__rejected = 0
+        self.__accounts: weakref.WeakSet[MemoryAccount] = weakref.WeakSet()
+        REGISTRY.add_stats("http_memory", self, ("held", "peak") + KINDS)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            return {
+                "held": self.__total,
+                "peak": self.__peak,
+                "rejected": self.__rejected,
+                **self.__held,
+            }
+
+    def account(self, name: str) -> MemoryAccount:
+        """Returns a new account, e.g. named after the remote address of a connection."""
+        account = MemoryAccount(self, name)
+        self.__accounts.add(account)
+        return account
+
+    def top_accounts(self, count: int = 10) -> list[MemoryAccount]:
+        """Returns the accounts holding the most bytes."""
+        accounts = [x for x in list(self.__accounts) if x.held]
+        return sorted(accounts, key=lambda x: x.held, reverse=True)[:count]
+
+    def reserve(self, kind: str, nbytes: int):
+        """Accounts nbytes, raises MemoryLimitError if they exceed the limit."""
+        with self.__lock:
+            if self.limit is not None:
+                if nbytes > self.limit:
+                    self.__rejected += 1
+                    raise MemoryLimitError(
+                        f"{nbytes} bytes exceed the limit of {self.limit} bytes", 413
+                    )
+                if self.__total + nbytes > self.limit:
+                    self.__rejected += 1
+                    raise MemoryLimitError(
+                        f"{nbytes} bytes exceed the free memory of {self.limit - self.__total} bytes",
+                        503,
+                    )
+            self.__add(kind, nbytes)
+
+    def track(self, kind: str, nbytes: int):
+        """Accounts nbytes without checking the limit, negative values release them."""
+        with self.__lock:
+            self.__add(kind, nbytes)
+
+    def release_kinds(self, held: dict[str, int]):
+        """Releases the bytes of each kind in held."""
+        with self.__lock:
+            for kind, nbytes in held.items():
+                self.__add(kind, -nbytes)
+
+    def reject(self):
+        """Counts a rejection made by an account."""
+        with self.__lock:
+            self.__rejected += 1
+
+    def __add(self, kind: str, nbytes: int):
+        # Must be called while holding the lock
+        self.__held[kind] += nbytes
+        self.__total += nbytes
+        if self.__total > self.__peak:
+            self.__peak = self.__total
+
+
+# Budget of all connections, unlimited until its limits are set
+MEMORY = MemoryBudget()
@@ -0,0 +1,490 @@
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any, Optional
+import bisect
+import functools
+import math
+import re
+import threading
+import time
+import weakref
+
+# Upper bounds of the default histogram buckets in seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_NAME_RE = re.compile(r"[a-zA-Z_:][a-zA-Z0-9_:]*")
+
+# A sample of a collector: name, type, help, labels and value
+Sample = tuple[str, str, str, dict[str, str], float]
+
+
+class _Shard:
+    # Values of one thread, freed with the thread's locals
+    __slots__ = ("values", "__weakref__")
+
+    def __init__(self, size: int):
+        self.values = [0.0] * size
+
+
+class _ShardedValues:
+    """Values that each thread adds to without locking.
+
+    Every thread gets its own list of values through a threading.local, so
+    updates are a local lookup and an addition. Reads sum the lists of all
+    threads. When a thread exits, its values are folded into the totals of
+    exited threads, so short-lived connection threads don't add up.
+    """
+
+    def __init__(self, size: int):
+        self.__size = size
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__live: dict[int, list[float]] = {}
+        self.__retired = [0.0] * size
+
+    def shard(self) -> list[float]:
+        """Returns the values of the calling thread."""
+        try:
+            return self.__local.shard.values
+        except AttributeError:
+            pass
+
+        shard = _Shard(self.__size)
+        with self.__lock:
+            self.__live[id(shard.values)] = shard.values
+        weakref.finalize(shard, self.__retire, shard.values)
+        self.__local.shard = shard
+        return shard.values
+
+    def __retire(self, values: list[float]):
+        with self.__lock:
+            del self.__live[id(values)]
+            for i, value in enumerate(values):
+                self.__retired[i] += value
+
+    def read(self) -> list[float]:
+        """Returns the sums of the values of all threads."""
+        with self.__lock:
+            result = self.__retired.copy()
+            for values in list(self.__live.values()):
+                for i, value in enumerate(values):
+                    result[i] += value
+        return result
+
+    def set(self, index: int, value: float):
+        """Makes the sum of a value equal to value, e.g. for gauges."""
+        with self.__lock:
+            total = self.__retired[index] + sum(
+                values[index] for values in self.__live.values()
+            )
+            self.__retired[index] += value - total
+
+
+class _Metric:
+    TYPE = ""
+
+    def __init__(self, name: str, help: str, label_names: Iterable[str] = ()):
+        if not _NAME_RE.fullmatch(name):
+            raise ValueError(f'Invalid metric name "{name}"')
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.__lock = threading.Lock()
+        self.__children: dict[tuple, Any] = {}
+        # Metrics without labels have a single child
+        self.__default = None if self.label_names else self.labels()
+
+    def _new_child(self) -> Any: ...
+
+    def labels(self, *values) -> Any:
+        """Returns the child of the label values, which are converted with str()."""
+        try:
+            return self.__children[values]
+        except KeyError:
+            pass
+
+        if len(values) != len(self.label_names):
+            raise ValueError(
+                f"{self.name} expects labels {', '.join(self.label_names)}"
+            )
+        with self.__lock:
+            return self.__children.setdefault(values, self._new_child())
+
+    @property
+    def _default(self) -> Any:
+        if self.__default is None:
+            raise ValueError(f"{self.name} has labels, use labels()")
+        return self.__default
+
+    def _children(self) -> list[tuple[dict[str, str], Any]]:
+        with self.__lock:
+            children = list(self.__children.items())
+        return [
+            (dict(zip(self.label_names, map(str, values))), child)
+            for values, child in children
+        ]
+
+    def _samples(self) -> Iterator[tuple[str, dict[str, str], float]]: ...
+
+
+class _CounterChild:
+    __slots__ = ("_values",)
+
+    def __init__(self):
+        self._values = _ShardedValues(1)
+
+    def inc(self, amount: float = 1):
+        self._values.shard()[0] += amount
+
+    def get(self) -> float:
+        return self._values.read()[0]
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. the number of requests."""
+
+    TYPE = "counter"
+
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+    def _samples(self):
+        for labels, child in self._children():
+            yield self.name + "_total", labels, child.get()
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1):
+        self._values.shard()[0] -= amount
+
+    def set(self, value: float):
+        self._values.set(0, value)
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. the number of open connections."""
+
+    TYPE = "gauge"
+
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default.dec(amount)
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def _samples(self):
+        for labels, child in self._children():
+            yield self.name, labels, child.get()
+
+
+class _HistogramChild:
+    __slots__ = ("__bounds", "__values")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.__bounds = bounds
+        # Bucket counts, the +Inf bucket and the sum of the observed values
+        self.__values = _ShardedValues(len(bounds) + 2)
+
+    def observe(self, value: float):
+        values = self.__values.shard()
+        values[bisect.bisect_left(self.__bounds, value)] += 1
+        values[-1] += value
+
+    def time(self) -> "_Timer":
+        """Observes the duration of a with block in seconds."""
+        return _Timer(self)
+
+    def get(self) -> tuple[list[float], float]:
+        """Returns the cumulative bucket counts, the last is +Inf, and the sum."""
+        values = self.__values.read()
+        buckets = list(_accumulate(values[:-1]))
+        return buckets, values[-1]
+
+
+class _Timer:
+    __slots__ = ("__histogram", "__start")
+
+    def __init__(self, histogram: _HistogramChild):
+        self.__histogram = histogram
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.__histogram.observe(time.perf_counter() - self.__start)
+
+
+def _accumulate(values: list[float]) -> Iterator[float]:
+    total = 0.0
+    for value in values:
+        total += value
+        yield total
+
+
+class Histogram(_Metric):
+    """Counts observed values in fixed buckets, e.g. request durations."""
+
+    TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        self.buckets = tuple(sorted(float(x) for x in buckets if x != math.inf))
+        super().__init__(name, help, label_names)
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def time(self) -> _Timer:
+        return self._default.time()
+
+    def _samples(self):
+        for labels, child in self._children():
+            buckets, total = child.get()
+            for bound, count in zip(self.buckets + (math.inf,), buckets):
+                yield self.name + "_bucket", labels | {"le": _format(bound)}, count
+            yield self.name + "_count", labels, buckets[-1]
+            yield self.name + "_sum", labels, total
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry:
+    """Holds metrics and renders them in the Prometheus text format.
+
+    Metrics are created on first use and shared by name, so instrumented
+    components don't need to know each other. Collectors add samples that
+    are computed at render time, e.g. from the stats of a component.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics: dict[str, _Metric] = {}
+        self.__collectors: list[Callable[[], Optional[Iterable[Sample]]]] = []
+
+    def __get_or_create(self, cls: type, name: str, *args) -> Any:
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = cls(name, *args)
+            elif type(metric) is not cls:
+                raise ValueError(f'"{name}" is already a {metric.TYPE}')
+            return metric
+
+    def counter(self, name: str, help: str, label_names: Iterable[str] = ()) -> Counter:
+        """Returns the counter name, creating it if needed. "_total" is added when rendered."""
+        return self.__get_or_create(Counter, name, help, label_names)
+
+    def gauge(self, name: str, help: str, label_names: Iterable[str] = ()) -> Gauge:
+        """Returns the gauge name, creating it if needed."""
+        return self.__get_or_create(Gauge, name, help, label_names)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Returns the histogram name, creating it if needed."""
+        return self.__get_or_create(Histogram, name, help, label_names, buckets)
+
+    def add_collector(self, collector: Callable[[], Optional[Iterable[Sample]]]):
+        """Adds a function that returns samples when rendering.
+        Bound methods are held weakly and removed with their object.
+        """
+        if hasattr(collector, "__self__"):
+            method = weakref.WeakMethod(collector)  # type: ignore
+            collector = lambda: (method() or (lambda: None))()
+        with self.__lock:
+            self.__collectors.append(collector)
+
+    def add_stats(self, prefix: str, source: Any, gauges: Iterable[str] = ()):
+        """Exports the stats property of source, e.g. of a CacheMiddleware.
+
+        Each key becomes a metric named prefix_key, a counter unless it's
+        listed in gauges. Stats of several sources with the same prefix are
+        summed. source is held weakly.
+
+        Args:
+        prefix -- Prefix of the metric names.
+        source -- Object with a stats property returning a dict of numbers.
+        gauges -- Keys whose values can go down.
+        """
+        gauges = frozenset(gauges)
+        ref = weakref.ref(source)
+
+        def _collect() -> Optional[list[Sample]]:
+            if (obj := ref()) is None:
+                return None
+            return [
+                (
+                    f"{prefix}_{key}" if key in gauges else f"{prefix}_{key}_total",
+                    "gauge" if key in gauges else "counter",
+                    f"{key.replace('_', ' ').capitalize()} of {type(obj).__name__}",
+                    {},
+                    value,
+                )
+                for key, value in obj.stats.items()
+                if isinstance(value, (int, float))
+            ]
+
+        with self.__lock:
+            self.__collectors.append(_collect)
+
+    def __collect(self) -> Iterator[tuple[str, str, str, str, dict[str, str], float]]:
+        # Yields the family, type, help, name, labels and value of all samples
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+            collectors = self.__collectors.copy()
+
+        for metric in metrics:
+            for name, labels, value in metric._samples():
+                yield metric.name, metric.TYPE, metric.help, name, labels, value
+
+        dead = []
+        for collector in collectors:
+            result = collector()
+            if result is None:
+                dead.append(collector)
+                continue
+            for name, type_, help, labels, value in result:
+                family = name.removesuffix("_total") if type_ == "counter" else name
+                yield family, type_, help, name, labels, value
+
+        if dead:
+            with self.__lock:
+                self.__collectors = [x for x in self.__collectors if x not in dead]
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text format."""
+        # Samples with the same name and labels, e.g. of several sources, are summed
+        families: dict[str, tuple[str, str, dict[tuple, list]]] = {}
+        for family, type_, help, name, labels, value in self.__collect():
+            samples = families.setdefault(family, (type_, help, {}))[2]
+            key = (name, tuple(labels.items()))
+            if key in samples:
+                samples[key][1] += value
+            else:
+                samples[key] = [labels, value]
+
+        lines = []
+        for family, (type_, help, samples) in families.items():
+            lines.append(f"# HELP {family} {_escape(help)}")
+            lines.append(f"# TYPE {family} {type_}")
+            for (name, _), (labels, value) in samples.items():
+                if labels:
+                    label_str = ",".join(
+                        f'{key}="{_escape(val)}"' for key, val in labels.items()
+                    )
+                    lines.append(f"{name}{{{label_str}}} {_format(value)}")
+                else:
+                    lines.append(f"{name} {_format(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Registry of the built-in components
+REGISTRY = MetricsRegistry()
+
+_HANDLER_DURATION = REGISTRY.histogram(
+    "http_handler_duration_seconds",
+    "Time spent in a handler and the handlers it calls",
+    ["handler"],
+)
+_HANDLER_RESPONSES = REGISTRY.counter(
+    "http_handler_responses", "Responses returned by a handler", ["handler", "code"]
+)
+
+
+class _CurrentStages(threading.local):
+    # Profile of the request handled by the thread, set by a profiling.Profiler
+    profile: Any = None
+
+
+CURRENT_STAGES = _CurrentStages()
+
+
+def instrumented(call: Callable) -> Callable:
+    """Records the duration and the responses of a handler's __call__ in REGISTRY,
+    and as a stage of the request's profile if it's being profiled.
+    Subclasses are recorded under their own class name.
+    """
+    # Children of the metrics by handler class, saves the label lookups
+    children: dict[type, Any] = {}
+
+    @functools.wraps(call)
+    def _wrapper(self, conn_info, request):
+        cls = type(self)
+        try:
+            duration, responses = children[cls]
+        except KeyError:
+            name = cls.__name__
+            duration = _HANDLER_DURATION.labels(name)
+            responses = {}
+            children[cls] = (duration, responses)
+
+        profile = CURRENT_STAGES.profile
+        if profile is not None:
+            stage = profile.enter(cls.__name__)
+        start = time.perf_counter()
+        try:
+            resp = call(self, conn_info, request)
+        finally:
+            elapsed = time.perf_counter() - start
+            duration.observe(elapsed)
+            if profile is not None:
+                profile.exit(stage, elapsed)
+
+        code = resp.status_code
+        try:
+            responses[code].inc()
+        except KeyError:
+            responses[code] = _HANDLER_RESPONSES.labels(cls.__name__, code)
+            responses[code].inc()
+        return resp
+
+    return _wrapper
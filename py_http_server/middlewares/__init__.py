@@ -6,3 +6,4 @@ from .default import *
 from .virtual_host import *
 from .enforce_https import *
 from .rewrite_redirects import *
+from .cache import *
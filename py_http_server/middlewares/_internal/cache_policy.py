@@ -0,0 +1,70 @@
+from collections.abc import Callable
+from typing import Optional, Union
+import fnmatch
+import re
+import threading
+
+GLOB_CHARACTERS = set("*?[")
+
+
+class CachePolicyMatcher:
+    """Maps web paths to Cache-Control values.
+
+    Keys of the policy map can be:
+    - Extensions such as ".css", matched against the file suffix.
+    - Globs such as "/assets/*.js" or "*.html", matched against the full web path.
+    - Compiled regular expressions, searched in the full web path.
+
+    Globs and regular expressions take precedence over extensions and are
+    tried in the given order. Results are memoized per path.
+    """
+
+    def __init__(
+        self,
+        policies: dict[Union[str, re.Pattern], str],
+        default: Optional[str] = None,
+        memo_size: int = 4096,
+    ):
+        self.__default = default
+        self.__extensions: dict[str, str] = {}
+        self.__memo: dict[str, Optional[str]] = {}
+        self.__memo_size = memo_size
+        self.__memo_lock = threading.Lock()
+
+        # Patterns are matched one by one, which keeps the groups and flags
+        # of regular expressions intact, the first match wins
+        self.__patterns: list[tuple[Callable[[str], Optional[re.Match]], str]] = []
+        for key, value in policies.items():
+            if isinstance(key, re.Pattern):
+                # Regular expressions may match anywhere in the path
+                self.__patterns.append((key.search, value))
+            elif key.startswith(".") and not GLOB_CHARACTERS & set(key):
+                self.__extensions[key.lower()] = value
+            else:
+                self.__patterns.append(
+                    (re.compile(fnmatch.translate(key)).match, value)
+                )
+
+    def __match(self, path: str) -> Optional[str]:
+        for match, value in self.__patterns:
+            if match(path):
+                return value
+
+        _, dot, suffix = path.rpartition("/")[2].rpartition(".")
+        if dot and (value := self.__extensions.get(f".{suffix.lower()}")):
+            return value
+
+        return self.__default
+
+    def __call__(self, path: str) -> Optional[str]:
+        try:
+            return self.__memo[path]
+        except KeyError:
+            pass
+
+        value = self.__match(path)
+        with self.__memo_lock:
+            if len(self.__memo) >= self.__memo_size:
+                self.__memo.clear()
+            self.__memo[path] = value
+        return value
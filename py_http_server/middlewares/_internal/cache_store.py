@@ -0,0 +1,296 @@
+from ...common import HeaderContainer
+from ...http.request import HTTPRequest
+from ... import log
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Optional, Union
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+
+LOG = log.getLogger("middlewares.cache")
+
+# Maximum number of Vary variants kept per key
+MAX_VARIANTS = 16
+
+
+@dataclass(slots=True, eq=False)
+class CacheEntry:
+    key: str
+    vary: dict[str, str]
+    status_code: int
+    headers: HeaderContainer
+    size: int
+    # Seconds the response is fresh for, and its age when it was stored
+    lifetime: float
+    initial_age: float
+    stored_at: float = field(default_factory=time.monotonic)
+    body: Optional[bytes] = None
+    disk_path: Optional[Path] = None
+
+    @property
+    def age(self) -> float:
+        return self.initial_age + time.monotonic() - self.stored_at
+
+    def matches(self, request: HTTPRequest) -> bool:
+        return all(
+            request.headers.get(name, "").strip() == value
+            for name, value in self.vary.items()
+        )
+
+
+class CacheStore:
+    """Two-tier response store.
+
+    Bodies are kept in a memory LRU bounded by memory_size bytes. Entries
+    evicted from memory, and bodies larger than max_memory_object_size, are
+    written to cache_dir so they can be served with sendfile. The disk tier
+    is an LRU bounded by disk_size bytes. Metadata is always kept in memory,
+    so each store writes to its own subdirectory of cache_dir, which is removed
+    with the store.
+    """
+
+    def __init__(
+        self,
+        memory_size: int,
+        max_memory_object_size: int,
+        cache_dir: Optional[str],
+        disk_size: int,
+    ):
+        self.__memory_size = memory_size
+        self.__max_memory_object_size = max_memory_object_size
+        self.__disk_size = disk_size if cache_dir else 0
+        self.__cache_dir: Optional[Path] = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.__cache_dir = Path(
+                tempfile.mkdtemp(prefix="py_http_server-cache-", dir=cache_dir)
+            )
+            # Files are unreachable without their metadata, removed at exit too
+            weakref.finalize(self, shutil.rmtree, self.__cache_dir, True)
+
+        self.__lock = threading.Lock()
+        self.__index: dict[str, list[CacheEntry]] = {}
+        self.__memory: OrderedDict[int, CacheEntry] = OrderedDict()
+        self.__disk: OrderedDict[int, CacheEntry] = OrderedDict()
+        self.__memory_bytes = 0
+        self.__disk_bytes = 0
+        self.__file_counter = itertools.count()
+
+        self.__evictions = 0
+
+    @property
+    def memory_bytes(self) -> int:
+        return self.__memory_bytes
+
+    @property
+    def disk_bytes(self) -> int:
+        return self.__disk_bytes
+
+    @property
+    def evictions(self) -> int:
+        return self.__evictions
+
+    @property
+    def entries(self) -> int:
+        return len(self.__memory) + len(self.__disk)
+
+    def get(self, key: str, request: HTTPRequest) -> Optional[CacheEntry]:
+        with self.__lock:
+            for entry in self.__index.get(key, ()):
+                if entry.matches(request):
+                    # Mark as recently used in its tier
+                    if id(entry) in self.__memory:
+                        self.__memory.move_to_end(id(entry))
+                    elif id(entry) in self.__disk:
+                        self.__disk.move_to_end(id(entry))
+                    return entry
+        return None
+
+    def put(self, entry: CacheEntry, body: Union[bytes, Path]) -> bool:
+        """Stores entry with its body, replacing the entry with the same variant.
+        Bodies can be given as the path of a file of entry.size bytes, which is
+        copied to the disk tier or read if the body is kept in memory.
+        Returns False if the body fits in neither tier.
+        """
+        to_disk = entry.size > self.__max_memory_object_size
+        if to_disk and entry.size > self.__disk_size:
+            return False
+        if not to_disk and entry.size > self.__memory_size:
+            return False
+
+        if not to_disk and isinstance(body, Path):
+            try:
+                body = body.read_bytes()
+            except OSError:
+                return False
+            # The file may have changed since its size was taken
+            if len(body) != entry.size:
+                return False
+
+        # Disk writes happen outside of the lock
+        if to_disk and not self.__write(entry, body):
+            return False
+        if not to_disk:
+            entry.body = body
+
+        with self.__lock:
+            variants = self.__index.setdefault(entry.key, [])
+            for old in [x for x in variants if x.vary == entry.vary]:
+                self.__remove(old)
+            if len(variants) >= MAX_VARIANTS:
+                self.__remove(variants[0])
+            self.__index.setdefault(entry.key, []).append(entry)
+
+            if to_disk:
+                self.__disk[id(entry)] = entry
+                self.__disk_bytes += entry.size
+            else:
+                self.__memory[id(entry)] = entry
+                self.__memory_bytes += entry.size
+            evicted = self.__evict_memory()
+            self.__evict_disk()
+
+        self.__demote(evicted)
+        return True
+
+    def update_headers(
+        self,
+        entry: CacheEntry,
+        headers: HeaderContainer,
+        lifetime: float,
+        initial_age: float,
+    ):
+        """Refreshes a revalidated entry with the headers of a 304 response."""
+        with self.__lock:
+            entry.headers = entry.headers | headers
+            entry.lifetime = lifetime
+            entry.initial_age = initial_age
+            entry.stored_at = time.monotonic()
+
+    def open(self, entry: CacheEntry) -> Optional[BinaryIO]:
+        """Opens the file of an entry in the disk tier, None if it isn't on disk.
+        The file stays readable when the entry is evicted before it's sent.
+        """
+        with self.__lock:
+            # Files are only unlinked while holding the lock
+            if self.__disk.get(id(entry)) is not entry or not entry.disk_path:
+                return None
+            try:
+                return entry.disk_path.open("rb")
+            except OSError:
+                return None
+
+    def purge(self, key: str) -> int:
+        with self.__lock:
+            entries = list(self.__index.get(key, ()))
+            for entry in entries:
+                self.__remove(entry)
+        return len(entries)
+
+    def purge_prefix(self, prefix: str) -> int:
+        with self.__lock:
+            entries = [
+                entry
+                for key, variants in self.__index.items()
+                if key.startswith(prefix)
+                for entry in variants
+            ]
+            for entry in entries:
+                self.__remove(entry)
+        return len(entries)
+
+    def __unindex(self, entry: CacheEntry):
+        # Must be called while holding the lock
+        variants = self.__index.get(entry.key)
+        if variants and entry in variants:
+            variants.remove(entry)
+            if not variants:
+                del self.__index[entry.key]
+
+    def __remove(self, entry: CacheEntry):
+        # Must be called while holding the lock
+        self.__unindex(entry)
+        if self.__memory.pop(id(entry), None):
+            self.__memory_bytes -= entry.size
+        if self.__disk.pop(id(entry), None):
+            self.__disk_bytes -= entry.size
+            if entry.disk_path:
+                entry.disk_path.unlink(missing_ok=True)
+
+    def __evict_memory(self) -> list[CacheEntry]:
+        # Must be called while holding the lock
+        # Returns entries evicted from memory that may be moved to disk
+        evicted = []
+        while self.__memory_bytes > self.__memory_size and self.__memory:
+            _, entry = self.__memory.popitem(last=False)
+            self.__memory_bytes -= entry.size
+            evicted.append(entry)
+        return evicted
+
+    def __evict_disk(self):
+        # Must be called while holding the lock
+        while self.__disk_bytes > self.__disk_size and self.__disk:
+            _, entry = self.__disk.popitem(last=False)
+            self.__disk_bytes -= entry.size
+            self.__evictions += 1
+            self.__unindex(entry)
+            if entry.disk_path:
+                entry.disk_path.unlink(missing_ok=True)
+
+    def __demote(self, entries: list[CacheEntry]):
+        # Moves entries evicted from memory to the disk tier if possible
+        for entry in entries:
+            body = entry.body
+            if (
+                self.__cache_dir
+                and body is not None
+                and entry.size <= self.__disk_size
+                and self.__write(entry, body)
+            ):
+                with self.__lock:
+                    # Entry may have been replaced or purged in the meantime
+                    if entry in self.__index.get(entry.key, ()):
+                        entry.body = None
+                        self.__disk[id(entry)] = entry
+                        self.__disk_bytes += entry.size
+                        self.__evict_disk()
+                        continue
+                if entry.disk_path:
+                    entry.disk_path.unlink(missing_ok=True)
+                continue
+
+            with self.__lock:
+                self.__evictions += 1
+                self.__unindex(entry)
+
+    def __write(self, entry: CacheEntry, body: Union[bytes, Path]) -> bool:
+        assert self.__cache_dir
+        path = self.__cache_dir / f"{os.getpid()}-{next(self.__file_counter)}.cache"
+
+        # Write to a temporary file first so that readers never see partial output
+        fd, tmp_path = tempfile.mkstemp(dir=self.__cache_dir, suffix=".tmp")
+        try:
+            if isinstance(body, Path):
+                os.close(fd)
+                # Copied in the kernel where possible, without reading it into memory
+                shutil.copyfile(body, tmp_path)
+            else:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(body)
+            if os.path.getsize(tmp_path) != entry.size:
+                # The file changed since its size was taken
+                Path(tmp_path).unlink(missing_ok=True)
+                return False
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            LOG.warning("Couldn't write cache entry to disk", exc_info=exc)
+            Path(tmp_path).unlink(missing_ok=True)
+            return False
+        entry.disk_path = path
+        return True
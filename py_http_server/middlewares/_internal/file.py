@@ -1,9 +1,24 @@
 from py_http_server.common.utils import from_http_date
-from ...http.response import HTTPResponseFactory
-from ...http.response_body import EmptyBody
+from ...http.response import HTTPResponse, HTTPResponseFactory
 from ...networking import ConnectionInfo
 from ...http.request import HTTPRequest
-from ...common import RequestHandlerABC, RequestHandler, NO_CACHE_HEADERS
+from ...common import (
+    RequestHandlerABC,
+    RequestHandler,
+    HeaderContainer,
+    NO_CACHE_HEADERS,
+)
+from collections.abc import Callable
+from typing import Optional
+import re
+
+CONDITIONAL_HEADERS = (
+    "If-Match",
+    "If-None-Match",
+    "If-Modified-Since",
+    "If-Unmodified-Since",
+)
+ETAG_PATTERN = re.compile(r'(?:W/)?"[^"]*"')
 
 
 class _HEADToGETMiddleware(RequestHandlerABC):
@@ -11,84 +26,139 @@ class _HEADToGETMiddleware(RequestHandlerABC):
         self.next = next
 
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
-        # Convert HEAD requests to GET
-        original_method = request.method
-        if original_method == "HEAD":
+        # Convert HEAD requests to GET, the body is kept so outer middlewares
+        # set the same headers as for GET. It's never sent for HEAD requests.
+        if request.method == "HEAD":
             request.method = "GET"
-
-        resp = self.next(conn_info, request)
-
-        # Omit the body if it was a HEAD request
-        if original_method == "HEAD":
-            resp.body = EmptyBody()
-
-        return resp
+        return self.next(conn_info, request)
+
+
+def _parse_etags(value: str) -> list[str]:
+    # Entity tags are quoted and may contain commas, so they can't be split
+    return ETAG_PATTERN.findall(value)
+
+
+def _strong_match(etag: Optional[str], value: str) -> bool:
+    if not etag or etag.startswith("W/"):
+        return False
+    return etag in _parse_etags(value)
+
+
+def _weak_match(etag: Optional[str], value: str) -> bool:
+    if not etag:
+        return False
+    etag = etag.removeprefix("W/")
+    return any(x.removeprefix("W/") == etag for x in _parse_etags(value))
+
+
+def evaluate_preconditions(
+    request: HTTPRequest, headers: HeaderContainer, exists: bool = True
+) -> Optional[int]:
+    """Evaluates the conditional request headers against the validators
+    (ETag and Last-Modified) in headers as described in RFC9110 section 13.2.2.
+
+    Returns 304 or 412 if the precondition fails, otherwise None.
+    """
+
+    # Set variables for condition evaluation
+    is_get_head = request.method in {"GET", "HEAD"}
+    last_modified = (
+        from_http_date(headers["Last-Modified"]) if "Last-Modified" in headers else None
+    )
+    etag = headers.get("ETag", None)
+
+    if "If-Match" in request.headers:
+        """
+        RFC9110: When recipient is the origin server and If-Match is present,
+        evaluate the If-Match precondition
+        """
+
+        if_match = request.headers["If-Match"].strip()
+        if if_match == "*":
+            if not exists:
+                return 412
+        elif not _strong_match(etag, if_match):
+            return 412
+    elif "If-Unmodified-Since" in request.headers:
+        """
+        RFC9110: When recipient is the origin server, If-Match is not present,
+        and If-Unmodified-Since is present, evaluate the If-Unmodified-Since precondition
+        """
+
+        if_unmodified_since = from_http_date(request.headers["If-Unmodified-Since"])
+        if (
+            last_modified
+            and if_unmodified_since
+            and last_modified > if_unmodified_since
+        ):
+            return 412
+
+    if "If-None-Match" in request.headers:
+        """
+        RFC9110: When If-None-Match is present, evaluate the If-None-Match precondition
+        """
+
+        # Return 304 if "ETag" matches "If-None-Match" and request is GET or HEAD, otherwise 412
+        if_none_match = request.headers["If-None-Match"].strip()
+        if (exists and if_none_match == "*") or _weak_match(etag, if_none_match):
+            return 304 if is_get_head else 412
+    elif "If-Modified-Since" in request.headers and is_get_head:
+        """
+        RFC9110: When the method is GET or HEAD, If-None-Match is not present,
+        and If-Modified-Since is present, evaluate the If-Modified-Since precondition
+        """
+        # Return 304 if "Last-Modified" is older than "If-Modified-Since"
+        if_modified_since = from_http_date(request.headers["If-Modified-Since"])
+        if last_modified and if_modified_since and last_modified <= if_modified_since:
+            return 304
+
+    # If-Range is not implemented
+
+    return None
 
 
 class _PreconditionEvalMiddleware(RequestHandlerABC):
-    def __init__(self, next: RequestHandler):
+    def __init__(
+        self,
+        next: RequestHandler,
+        validators: Optional[
+            Callable[[ConnectionInfo, HTTPRequest], Optional[HeaderContainer]]
+        ] = None,
+    ):
+        """Inits _PreconditionEvalMiddleware.
+
+        Args:
+        next -- Next handler.
+        validators -- Optional cheap lookup of the headers a 304 response would have
+            (ETag, Last-Modified, Cache-Control etc.) without building the body.
+            Returning None defers the evaluation to the response of next.
+        """
         self.next = next
+        self.__validators = validators
         self.http = HTTPResponseFactory(NO_CACHE_HEADERS)
 
-    def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
-        resp = self.next(conn_info, request)
+    def __failed(self, status_code: int, headers: HeaderContainer):
+        # Keep the caching policy of the response instead of the no-cache defaults
+        if status_code == 304 and "Cache-Control" in headers:
+            return HTTPResponse(304, headers)
+        return self.http.status(status_code, headers)
 
-        # Set variables for condition evaluation
-        is_get_head = request.method in {"GET", "HEAD"}
-        last_modified = (
-            from_http_date(resp.headers["Last-Modified"])
-            if "Last-Modified" in resp.headers
-            else None
-        )
-        etag = resp.headers["ETag"] if "ETag" in resp.headers else None
-
-        if "If-Match" in request.headers:
-            """
-            RFC9110: When recipient is the origin server and If-Match is present,
-            evaluate the If-Match precondition
-            """
-
-            if not etag or etag.startswith("W/") or etag != request.headers["If-Match"]:
-                return self.http.status(412, resp.headers)
-        elif "If-Unmodified-Since" in request.headers:
-            """
-            RFC9110: When recipient is the origin server, If-Match is not present,
-            and If-Unmodified-Since is present, evaluate the If-Unmodified-Since precondition
-            """
-
-            if_unmodified_since = from_http_date(request.headers["If-Unmodified-Since"])
-            if (
-                last_modified
-                and if_unmodified_since
-                and last_modified > if_unmodified_since
-            ):
-                return self.http.status(412, resp.headers)
-
-        if "If-None-Match" in request.headers:
-            """
-            RFC9110: When If-None-Match is present, evaluate the If-None-Match precondition
-            """
-
-            # Return 304 if "ETag" matches "If-None-Match" and request is GET or HEAD, otherwise 412
-            if etag and etag == request.headers["If-None-Match"]:
-                if is_get_head:
-                    return self.http.status(304, resp.headers)
-                else:
-                    return self.http.status(412, resp.headers)
-        elif "If-Modified-Since" in request.headers and is_get_head:
-            """
-            RFC9110: When the method is GET or HEAD, If-None-Match is not present,
-            and If-Modified-Since is present, evaluate the If-Modified-Since precondition
-            """
-            # Return 304 if "Last-Modified" is older than "If-Modified-Since"
-            if_modified_since = from_http_date(request.headers["If-Modified-Since"])
-            if (
-                last_modified
-                and if_modified_since
-                and last_modified <= if_modified_since
-            ):
-                return self.http.status(304, resp.headers)
-
-        # If-Range is not implemented
+    def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
+        # Skip the evaluation entirely for unconditional requests
+        if not any(x in request.headers for x in CONDITIONAL_HEADERS):
+            return self.next(conn_info, request)
+
+        # Try to answer from the validators before the body is built
+        if self.__validators:
+            headers = self.__validators(conn_info, request)
+            if headers is not None:
+                if status_code := evaluate_preconditions(request, headers):
+                    return self.__failed(status_code, headers)
+                return self.next(conn_info, request)
 
+        resp = self.next(conn_info, request)
+        if status_code := evaluate_preconditions(
+            request, resp.headers, 200 <= resp.status_code < 300
+        ):
+            return self.__failed(status_code, resp.headers)
         return resp
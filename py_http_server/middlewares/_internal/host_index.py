@@ -0,0 +1,85 @@
+from typing import Optional
+
+
+def split_host(host: str) -> tuple[str, str]:
+    """Returns the normalized host name and the port of a Host header or URL authority.
+    The port is an empty string if there's none.
+    """
+    host = host.strip().rpartition("@")[2].lower()
+
+    # IPv6 addresses are enclosed in brackets
+    if host.startswith("["):
+        name, _, rest = host.partition("]")
+        return name + "]", rest.removeprefix(":")
+
+    name, _, port = host.partition(":")
+    return name.rstrip("."), port
+
+
+class HostIndex[V_T]:
+    """Maps host names to values.
+
+    Keys are exact host names optionally with a port ("example.com",
+    "example.com:8080"), wildcards matching any subdomain ("*.example.com")
+    or suffixes matching the domain and its subdomains (".example.com").
+    None is the default. Keys and looked up hosts are normalized: case,
+    trailing dots and userinfo are ignored, and keys without a port match
+    any port.
+
+    Lookups try, in order: exact host and port, exact host, the longest
+    matching wildcard or suffix, then the default. Exact matches take one
+    dict lookup, wildcards one per label of the host.
+    """
+
+    def __init__(self, entries: dict[Optional[str], V_T]):
+        self.__exact: dict[str, V_T] = {}
+        self.__wildcards: dict[str, V_T] = {}
+        self.__suffixes: dict[str, V_T] = {}
+        self.__default: Optional[V_T] = None
+
+        for key, value in entries.items():
+            if key is None:
+                self.__default = value
+                continue
+
+            if key.startswith("*."):
+                table, key = self.__wildcards, key[2:]
+            elif key.startswith("."):
+                table, key = self.__suffixes, key[1:]
+            else:
+                name, port = split_host(key)
+                self.__exact[f"{name}:{port}" if port else name] = value
+                continue
+
+            name, port = split_host(key)
+            if not name or port or "*" in name:
+                raise ValueError(f'Invalid host pattern "{key}"')
+            table[name] = value
+
+    def get(self, host: Optional[str]) -> Optional[V_T]:
+        """Returns the value of the best match for host, the default if nothing matches."""
+        if not host:
+            return self.__default
+
+        name, port = split_host(host)
+        if port and (value := self.__exact.get(f"{name}:{port}")) is not None:
+            return value
+        if (value := self.__exact.get(name)) is not None:
+            return value
+
+        if self.__wildcards or self.__suffixes:
+            # Suffix keys also match the domain itself
+            if (value := self.__suffixes.get(name)) is not None:
+                return value
+
+            # Try the parent domains, most specific first
+            index = name.find(".")
+            while index >= 0:
+                parent = name[index + 1 :]
+                if (value := self.__wildcards.get(parent)) is not None:
+                    return value
+                if (value := self.__suffixes.get(parent)) is not None:
+                    return value
+                index = name.find(".", index + 1)
+
+        return self.__default
@@ -8,7 +8,8 @@ IGNORED_RESPONSE_HEADERS = {"Connection", "Transfer-Encoding"}
 
 # ReverseProxyRouter will control upstream Connection lifetime
 # TE is disallowed because urllib3 does not support it
-IGNORED_REQUEST_HEADERS = {"Connection", "TE"}
+# Transfer-Encoding is set by urllib3 when the body is streamed
+IGNORED_REQUEST_HEADERS = {"Connection", "TE", "Transfer-Encoding"}
 
 # CONNECT is disallowed because urllib3 does not support it
 DISALLOWED_METHODS = {"CONNECT"}
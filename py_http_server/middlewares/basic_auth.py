@@ -1,4 +1,5 @@
 from ..common import RequestHandlerABC, RequestHandler, HeaderContainer, NO_CACHE_HEADERS
+from ..metrics import instrumented
 from ..http.request import HTTPRequest
 from ..http.response import HTTPResponseFactory
 from ..networking import ConnectionInfo
@@ -29,6 +30,7 @@ class BasicAuthMiddleware(RequestHandlerABC):
         LOG.warning(f"Basic authentication incorrect credentials.")
         return False
 
+    @instrumented
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
         if "Authorization" in request.headers and self.__verify_authorization(
             request.headers["Authorization"]
@@ -0,0 +1,533 @@
+from ..networking import ConnectionInfo
+from ..http.request import HTTPRequest
+from ..http.response import HTTPResponse, HTTPResponseFactory
+from ..http.response_body import BytesBody, FileBody, LazyBody, ResponseBody
+from ..common import (
+    RequestHandlerABC,
+    RequestHandler,
+    HeaderContainer,
+    NO_CACHE_HEADERS,
+    from_http_date,
+    parse_cache_control,
+)
+from ..metrics import REGISTRY, instrumented
+from ._internal.cache_store import CacheEntry, CacheStore
+from ._internal.file import evaluate_preconditions
+from ._internal.cache_policy import CachePolicyMatcher
+from .. import log
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Optional, Union
+import re
+import threading
+
+LOG = log.getLogger("middlewares.cache")
+
+# RFC9110: Status codes that are cacheable by default
+CACHEABLE_STATUS_CODES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+
+# RFC9110: Methods that invalidate stored responses on success
+UNSAFE_METHODS = {"POST", "PUT", "DELETE", "PATCH"}
+
+# Hop-by-hop headers are not stored, Content-Length is set by the body
+UNSTORED_HEADERS = {
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+    "te",
+    "trailer",
+    "upgrade",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "content-length",
+}
+
+
+class CacheMiddleware(RequestHandlerABC):
+    def __init__(
+        self,
+        next: RequestHandler,
+        memory_size: int = 67108864,  # 64 MiB
+        max_memory_object_size: int = 1048576,  # 1 MiB
+        cache_dir: Optional[str] = None,
+        disk_size: int = 1073741824,  # 1 GiB
+        max_object_size: int = 104857600,  # 100 MiB
+        stale_policies: dict[Union[str, re.Pattern], str] = {},
+        default_stale_policy: Optional[str] = None,
+        collapse_timeout: float = 30.0,
+    ):
+        """Inits CacheMiddleware, a shared HTTP cache as described in RFC9111.
+
+        Responses to GET requests are stored if their Cache-Control or Expires
+        headers make them fresh, or if they have validators (ETag, Last-Modified)
+        to revalidate them with. Stale responses are revalidated with conditional
+        requests. Vary is honored; "Vary: *", "no-store" and "private" responses
+        are not stored.
+
+        Concurrent misses and revalidations of the same URL are collapsed into a
+        single request to the next handler, other requests wait for its response.
+
+        Stale responses can be served while they are revalidated in the background
+        ("stale-while-revalidate=<seconds>") or when the next handler fails with
+        a 5xx status ("stale-if-error=<seconds>"), as described in RFC5861.
+        These directives are read from the stored response's Cache-Control
+        header, unless the path has a stale policy.
+
+        Args:
+        next -- Next handler.
+        memory_size -- Total size of bodies kept in memory.
+        max_memory_object_size -- Bodies larger than this are stored on disk.
+        cache_dir -- Directory of the disk tier, bodies are written to a new subdirectory of it. If None, only memory is used.
+        disk_size -- Total size of bodies kept on disk.
+        max_object_size -- Responses larger than this are not stored.
+        stale_policies -- Map of web paths to stale directives, e.g. {"/api/*": "stale-while-revalidate=10, stale-if-error=300"}. Keys can be extensions, globs or compiled regular expressions.
+        default_stale_policy -- Stale directives of paths without a stale policy, overrides the response's directives.
+        collapse_timeout -- Seconds a request waits for a collapsed request before making its own.
+        """
+        self.next = next
+        self.http = HTTPResponseFactory(NO_CACHE_HEADERS)
+        self.__max_object_size = max_object_size
+        self.__collapse_timeout = collapse_timeout
+        self.__store = CacheStore(
+            memory_size, max_memory_object_size, cache_dir, disk_size
+        )
+        self.__stale_policies = (
+            CachePolicyMatcher(stale_policies, default_stale_policy)
+            if stale_policies or default_stale_policy
+            else None
+        )
+
+        # Events of the in-flight requests to the next handler per key
+        self.__in_flight: dict[str, threading.Event] = {}
+        self.__in_flight_lock = threading.Lock()
+
+        self.__stats_lock = threading.Lock()
+        self.__hits = 0
+        self.__stale_hits = 0
+        self.__misses = 0
+        self.__collapsed = 0
+        self.__revalidations = 0
+        self.__stores = 0
+        self.__bytes_served = 0
+        REGISTRY.add_stats(
+            "http_cache", self, ["entries", "memory_bytes", "disk_bytes"]
+        )
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.__hits,
+            "stale_hits": self.__stale_hits,
+            "misses": self.__misses,
+            "collapsed": self.__collapsed,
+            "revalidations": self.__revalidations,
+            "stores": self.__stores,
+            "evictions": self.__store.evictions,
+            "bytes_served": self.__bytes_served,
+            "entries": self.__store.entries,
+            "memory_bytes": self.__store.memory_bytes,
+            "disk_bytes": self.__store.disk_bytes,
+        }
+
+    def purge(self, key: str) -> int:
+        """Removes all variants stored for a key, e.g. "https://example.com/index.html".
+        Returns the number of removed responses.
+        """
+        return self.__store.purge(key)
+
+    def purge_prefix(self, prefix: str) -> int:
+        """Removes all responses whose key starts with prefix, e.g. "https://example.com/static/".
+        Returns the number of removed responses.
+        """
+        return self.__store.purge_prefix(prefix)
+
+    @staticmethod
+    def make_key(conn_info: ConnectionInfo, request: HTTPRequest) -> str:
+        return request.to_url(
+            request.headers.get("Host", ""), "https" if conn_info.secure else "http"
+        )
+
+    def __count(
+        self,
+        hits=0,
+        stale_hits=0,
+        misses=0,
+        collapsed=0,
+        revalidations=0,
+        stores=0,
+        bytes_served=0,
+    ):
+        with self.__stats_lock:
+            self.__hits += hits
+            self.__stale_hits += stale_hits
+            self.__misses += misses
+            self.__collapsed += collapsed
+            self.__revalidations += revalidations
+            self.__stores += stores
+            self.__bytes_served += bytes_served
+
+    @instrumented
+    def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
+        key = self.make_key(conn_info, request)
+
+        if request.method not in {"GET", "HEAD"}:
+            resp = self.next(conn_info, request)
+            # RFC9111: Unsafe requests invalidate the stored responses of their URI
+            if request.method in UNSAFE_METHODS and resp.status_code < 400:
+                self.__store.purge(key)
+            return resp
+
+        request_cc = parse_cache_control(request.headers.get("Cache-Control", ""))
+        entry = self.__store.get(key, request)
+
+        if entry:
+            if self.__is_usable(entry, request_cc):
+                if resp := self.__serve(entry, request):
+                    self.__count(hits=1)
+                    return resp
+            else:
+                return self.__serve_stale(conn_info, request, request_cc, entry)
+
+        if "only-if-cached" in request_cc:
+            # 504 Gateway Timeout
+            return self.http.status(504)
+
+        return self.__collapse(
+            conn_info,
+            request,
+            request_cc,
+            key,
+            lambda: self.__fetch(conn_info, request, request_cc, key),
+        )
+
+    def __is_usable(self, entry: CacheEntry, request_cc: dict[str, Optional[str]]):
+        if "no-cache" in request_cc:
+            return False
+
+        age = entry.age
+        if "max-age" in request_cc and age > _parse_seconds(request_cc["max-age"]):
+            return False
+        return entry.lifetime > age
+
+    def __get_stale_limits(
+        self, request: HTTPRequest, entry: CacheEntry
+    ) -> tuple[float, float]:
+        # Returns the stale-while-revalidate and stale-if-error limits in seconds
+        cc = parse_cache_control(entry.headers.get("Cache-Control", ""))
+        if {"no-cache", "must-revalidate", "proxy-revalidate"} & cc.keys():
+            return 0.0, 0.0
+
+        if self.__stale_policies and (policy := self.__stale_policies(request.path)):
+            cc = parse_cache_control(policy)
+        return (
+            _parse_seconds(cc.get("stale-while-revalidate")),
+            _parse_seconds(cc.get("stale-if-error")),
+        )
+
+    def __serve(
+        self, entry: CacheEntry, request: HTTPRequest
+    ) -> Optional[HTTPResponse]:
+        headers = entry.headers | {"Age": str(int(entry.age))}
+
+        # Answer the client's own conditional request from the stored validators
+        if status_code := evaluate_preconditions(request, headers):
+            if status_code == 304:
+                return HTTPResponse(304, headers)
+            return self.http.status(status_code, headers)
+
+        # The body may have been moved to disk or evicted in the meantime
+        body: Optional[ResponseBody] = None
+        if entry.body is not None:
+            body = BytesBody(entry.body)
+        elif file := self.__store.open(entry):
+            body = FileBody(entry.disk_path, entry.size, file)
+        if body is None:
+            return None
+
+        self.__count(bytes_served=entry.size)
+        return HTTPResponse(entry.status_code, headers, body)
+
+    def __serve_stale(
+        self,
+        conn_info: ConnectionInfo,
+        request: HTTPRequest,
+        request_cc: dict[str, Optional[str]],
+        entry: CacheEntry,
+    ):
+        swr, sie = self.__get_stale_limits(request, entry)
+        staleness = entry.age - entry.lifetime
+
+        # Serve the stale response and revalidate it in the background
+        if "no-cache" not in request_cc and 0 <= staleness <= swr:
+            self.__revalidate_in_background(conn_info, request, request_cc, entry)
+            if resp := self.__serve(entry, request):
+                self.__count(stale_hits=1)
+                return resp
+
+        try:
+            resp = self.__collapse(
+                conn_info,
+                request,
+                request_cc,
+                entry.key,
+                lambda: self.__revalidate(conn_info, request, request_cc, entry),
+            )
+        except Exception as exc:
+            # Exceptions of the next handler are errors too (RFC5861)
+            if entry.age - entry.lifetime <= sie:
+                LOG.warning(f'Serving stale "{entry.key}" after exception: {exc!r}')
+                if stale := self.__serve(entry, request):
+                    self.__count(stale_hits=1)
+                    return stale
+            raise
+
+        # Serve the stale response if the next handler failed
+        if resp.status_code >= 500 and entry.age - entry.lifetime <= sie:
+            LOG.warning(
+                f'Serving stale "{entry.key}" after status code {resp.status_code}'
+            )
+            if stale := self.__serve(entry, request):
+                self.__count(stale_hits=1)
+                return stale
+        return resp
+
+    def __collapse(
+        self,
+        conn_info: ConnectionInfo,
+        request: HTTPRequest,
+        request_cc: dict[str, Optional[str]],
+        key: str,
+        fetch: Callable[[], HTTPResponse],
+    ) -> HTTPResponse:
+        with self.__in_flight_lock:
+            event = self.__in_flight.get(key)
+            if event is None:
+                event = self.__in_flight[key] = threading.Event()
+                leader = True
+            else:
+                leader = False
+
+        if leader:
+            try:
+                return fetch()
+            finally:
+                with self.__in_flight_lock:
+                    del self.__in_flight[key]
+                event.set()
+
+        # Wait for the leader and use its stored response if it fits this request
+        event.wait(self.__collapse_timeout)
+        entry = self.__store.get(key, request)
+        if entry and self.__is_usable(entry, request_cc):
+            if resp := self.__serve(entry, request):
+                self.__count(hits=1, collapsed=1)
+                return resp
+
+        # Response wasn't storable or doesn't match, fetch it separately
+        return self.__fetch(conn_info, request, request_cc, key)
+
+    def __fetch(
+        self,
+        conn_info: ConnectionInfo,
+        request: HTTPRequest,
+        request_cc: dict[str, Optional[str]],
+        key: str,
+    ):
+        self.__count(misses=1)
+        resp = self.next(conn_info, request)
+        if request.method == "GET":
+            self.__store_response(key, request, request_cc, resp)
+        return resp
+
+    def __revalidate_in_background(
+        self,
+        conn_info: ConnectionInfo,
+        request: HTTPRequest,
+        request_cc: dict[str, Optional[str]],
+        entry: CacheEntry,
+    ):
+        with self.__in_flight_lock:
+            if entry.key in self.__in_flight:
+                return
+            event = self.__in_flight[entry.key] = threading.Event()
+
+        # The request is copied because the connection may reuse or modify it
+        request = HTTPRequest(
+            "GET",
+            request.path,
+            request.query,
+            request.headers.copy(),
+            request.version,
+            request.body,
+        )
+
+        def revalidate():
+            try:
+                self.__revalidate(conn_info, request, request_cc, entry)
+            except Exception as exc:
+                LOG.warning(f'Couldn\'t revalidate "{entry.key}"', exc_info=exc)
+            finally:
+                with self.__in_flight_lock:
+                    del self.__in_flight[entry.key]
+                event.set()
+
+        threading.Thread(
+            target=revalidate, name="CacheRevalidation", daemon=True
+        ).start()
+
+    def __revalidate(
+        self,
+        conn_info: ConnectionInfo,
+        request: HTTPRequest,
+        request_cc: dict[str, Optional[str]],
+        entry: CacheEntry,
+    ):
+        # Conditional request with the stored validators instead of the client's
+        headers = request.headers.copy()
+        for name in (
+            "If-Match",
+            "If-None-Match",
+            "If-Modified-Since",
+            "If-Unmodified-Since",
+        ):
+            headers.pop(name, None)
+        if "ETag" in entry.headers:
+            headers["If-None-Match"] = entry.headers["ETag"]
+        if "Last-Modified" in entry.headers:
+            headers["If-Modified-Since"] = entry.headers["Last-Modified"]
+
+        conditional_request = HTTPRequest(
+            "GET", request.path, request.query, headers, request.version, request.body
+        )
+        resp = self.next(conn_info, conditional_request)
+        self.__count(revalidations=1)
+
+        if resp.status_code == 304:
+            headers = entry.headers | _filter_headers(resp.headers)
+            cc = parse_cache_control(headers.get("Cache-Control", ""))
+            self.__store.update_headers(
+                entry,
+                headers,
+                _get_lifetime(headers, cc) or 0.0,
+                _get_initial_age(resp.headers),
+            )
+            if served := self.__serve(entry, request):
+                self.__count(hits=1)
+                return served
+
+            # Stored body is gone, fetch it unconditionally
+            resp = self.next(conn_info, request)
+
+        if request.method == "GET" and resp.status_code < 500:
+            self.__store_response(entry.key, request, request_cc, resp)
+        return resp
+
+    def __store_response(
+        self,
+        key: str,
+        request: HTTPRequest,
+        request_cc: dict[str, Optional[str]],
+        resp: HTTPResponse,
+    ):
+        if "no-store" in request_cc or resp.status_code not in CACHEABLE_STATUS_CODES:
+            return
+
+        cc = parse_cache_control(resp.headers.get("Cache-Control", ""))
+        if "no-store" in cc or "private" in cc:
+            return
+
+        # RFC9111: Shared caches only store authorized responses if explicitly allowed
+        if "Authorization" in request.headers and not (
+            {"public", "s-maxage", "must-revalidate"} & cc.keys()
+        ):
+            return
+
+        vary_names = [
+            x.strip() for x in resp.headers.get("Vary", "").split(",") if x.strip()
+        ]
+        if "*" in vary_names:
+            return
+
+        lifetime = _get_lifetime(resp.headers, cc)
+        if lifetime is None:
+            # Responses without explicit freshness are only kept for revalidation
+            if "ETag" not in resp.headers and "Last-Modified" not in resp.headers:
+                return
+            lifetime = 0.0
+        if "no-cache" in cc:
+            lifetime = 0.0
+
+        # Only sized bodies are stored, streams are passed through
+        body = resp.body
+        content: Union[bytes, Path]
+        if body is None:
+            content, size = b"", 0
+        elif isinstance(body, (BytesBody, FileBody, LazyBody)):
+            if isinstance(body, LazyBody):
+                if (
+                    body.size_hint is not None
+                    and body.size_hint > self.__max_object_size
+                ):
+                    return
+                body = body.materialize()
+            size = len(body)
+            if size > self.__max_object_size:
+                return
+            # Files are copied by the store instead of being read into memory
+            content = (
+                body.file_path if isinstance(body, FileBody) else body.read_bytes()
+            )
+        else:
+            return
+
+        entry = CacheEntry(
+            key,
+            {x: request.headers.get(x, "").strip() for x in vary_names},
+            resp.status_code,
+            _filter_headers(resp.headers),
+            size,
+            lifetime,
+            _get_initial_age(resp.headers),
+        )
+        if self.__store.put(entry, content):
+            self.__count(stores=1)
+            LOG.debug('Stored "%s" for %s seconds', key, lifetime)
+
+
+def _parse_seconds(value: Optional[str]) -> float:
+    try:
+        return max(0.0, float(int(value or "0")))
+    except ValueError:
+        return 0.0
+
+
+def _filter_headers(headers: HeaderContainer) -> HeaderContainer:
+    return HeaderContainer(
+        [(k, v) for k, v in headers.multi_items() if k.lower() not in UNSTORED_HEADERS]
+    )
+
+
+def _get_lifetime(
+    headers: HeaderContainer, cc: dict[str, Optional[str]]
+) -> Optional[float]:
+    # RFC9111: s-maxage takes precedence over max-age in shared caches, then Expires
+    if "s-maxage" in cc:
+        return _parse_seconds(cc["s-maxage"])
+    if "max-age" in cc:
+        return _parse_seconds(cc["max-age"])
+    if "Expires" in headers:
+        expires = from_http_date(headers["Expires"])
+        if not expires:
+            # Invalid dates like "0" mean already expired
+            return 0.0
+        date = from_http_date(headers.get("Date", "")) or datetime.now(timezone.utc)
+        return max(0.0, (expires - date).total_seconds())
+    return None
+
+
+def _get_initial_age(headers: HeaderContainer) -> float:
+    # RFC9111: The larger of the Age header and the apparent age from Date
+    age = _parse_seconds(headers.get("Age", "0"))
+    if date := from_http_date(headers.get("Date", "")):
+        age = max(age, (datetime.now(timezone.utc) - date).total_seconds())
+    return age
@@ -1,7 +1,8 @@
 from ..networking import ConnectionInfo
-from ..http.response_body import BytesBody, FileBody, ResponseBody
+from ..http.response_body import BytesBody, FileBody, LazyBody, ResponseBody
 from ..http.request import HTTPRequest
-from ..common import RequestHandlerABC, RequestHandler
+from ..common import RequestHandlerABC, RequestHandler, accepted_encodings
+from ..metrics import instrumented
 from .. import log
 
 LOG = log.getLogger("middlewares.compress")
@@ -51,19 +52,16 @@ class CompressMiddleware(RequestHandlerABC):
         self.__max_response_size = max_response_size
 
     def __get_best_encoding(self, request: HTTPRequest):
-        mutual_encodings = []
-
-        if "Accept-Encoding" in request.headers:
-            for encoding in request.headers["Accept-Encoding"].split(","):
-                encoding = encoding.lower().strip()
-                if encoding in ENCODINGS:
-                    mutual_encodings.append(encoding)
+        mutual_encodings = accepted_encodings(
+            request.headers.get("Accept-Encoding", "")
+        ).intersection(ENCODINGS)
 
         # Pick the most preferred mutual encoding or None
         return next(
             (x for x in self.__compression_preferences if x in mutual_encodings), None
         )
 
+    @instrumented
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
         resp = self.next(conn_info, request)
 
@@ -75,21 +73,38 @@ class CompressMiddleware(RequestHandlerABC):
         if "Content-Encoding" in resp.headers:
             return resp
 
+        # Only sized bodies can be compressed, lazy bodies are sized by their hint
+        body = resp.body
+        if isinstance(body, LazyBody) and body.size_hint is not None:
+            size = body.size_hint
+        elif isinstance(body, (BytesBody, FileBody, LazyBody)):
+            size = len(body)
+        else:
+            return resp
+
         # Return if response size is below min or above max threshold for compression
-        if not (self.__min_response_size <= len(resp.body) <= self.__max_response_size):
+        if not (self.__min_response_size <= size <= self.__max_response_size):
             return resp
 
+        # The representation depends on Accept-Encoding, caches must know it
+        vary = resp.headers.get("Vary", "")
+        if "accept-encoding" not in vary.lower():
+            resp.headers["Vary"] = (
+                f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"
+            )
+
         if encoding := self.__get_best_encoding(request):
             resp.headers["Content-Encoding"] = encoding
-            if isinstance(resp.body, BytesBody):
-                # Directly compress bytes bodies
-                resp.body.content = ENCODINGS[encoding](resp.body.content)
-            elif isinstance(resp.body, FileBody):
-                # Convert file bodies to bytes bodies for compression
-                with resp.body.file_path.open("rb") as f:
-                    resp.body = ResponseBody.from_bytes(ENCODINGS[encoding](f.read()))
-            else:
-                # No encoding was applied because the body type is unsupported
-                del resp.headers["Content-Encoding"]
+
+            # Compression is deferred until the body is sent, HEAD requests skip it
+            compress = ENCODINGS[encoding]
+            resp.body = ResponseBody.from_factory(
+                lambda: BytesBody(compress(body.read_bytes()), "compression"), size
+            )
+
+            # Strong ETags identify the unencoded representation
+            etag = resp.headers.get("ETag", "")
+            if etag and not etag.startswith("W/"):
+                resp.headers["ETag"] = f"W/{etag}"
 
         return resp
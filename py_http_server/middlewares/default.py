@@ -1,17 +1,17 @@
 from ..networking import ConnectionInfo
 from ..http.request import HTTPRequest
-from ..common import RequestHandlerABC, HeaderContainer, RequestHandler, to_http_date
-from datetime import datetime, timezone
+from ..common import RequestHandlerABC, RequestHandler, http_date_now
+from ..metrics import instrumented
 
 
 class DefaultMiddleware(RequestHandlerABC):
     def __init__(self, next: RequestHandler):
         self.next = next
 
+    @instrumented
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
         resp = self.next(conn_info, request)
-        resp.headers = HeaderContainer({
-            "Server": "Tan's HTTP Server",
-            "Date": to_http_date(datetime.now(timezone.utc))
-        }) | resp.headers
+        # Set in place, headers of the response take precedence
+        resp.headers.setdefault("Server", "Tan's HTTP Server")
+        resp.headers.setdefault("Date", http_date_now())
         return resp
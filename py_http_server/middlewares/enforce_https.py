@@ -3,6 +3,7 @@ from ..http.response import HTTPResponseFactory
 from ..networking import ConnectionInfo
 from ..http.request import HTTPRequest
 from ..common import RequestHandlerABC, RequestHandler, HeaderContainer
+from ..metrics import instrumented
 
 
 class EnforceHTTPSMiddleware(RequestHandlerABC):
@@ -11,16 +12,15 @@ class EnforceHTTPSMiddleware(RequestHandlerABC):
         self.next = next
         self.http = HTTPResponseFactory()
 
+    @instrumented
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
-        resp = self.next(conn_info, request)
-
         hsts_header = {}
         if self.__hsts_max_age is not None:
             hsts_header = {
                 "Strict-Transport-Security": f"max-age={self.__hsts_max_age}"
             }
 
-        # Only redirect if the host value is known
+        # Only redirect if the host value is known, next is never called for redirects
         if not conn_info.secure and "Host" in request.headers:
             return self.http.redirect(
                 request.to_url(request.headers["Host"], "https"),
@@ -28,6 +28,8 @@ class EnforceHTTPSMiddleware(RequestHandlerABC):
                 HeaderContainer(hsts_header),
             )
 
+        resp = self.next(conn_info, request)
+
         # Set the HSTS header
         resp.headers |= hsts_header
         return resp
@@ -1,8 +1,10 @@
 from ..networking import ConnectionInfo
-from ..http.response_body import BytesBody, FileBody, ResponseBody
+from ..http.response_body import BytesBody, FileBody, LazyBody, ResponseBody
 from ..http.request import HTTPRequest
 from ..common import RequestHandlerABC, RequestHandler
+from ..metrics import instrumented
 from .. import log
+from collections.abc import Callable
 import json
 
 LOG = log.getLogger("middlewares.minimize")
@@ -23,6 +25,20 @@ class MinimizeMiddleware(RequestHandlerABC):
         self.next = next
         LOG.info(f"Enabled { ', '.join(MINIMIZERS.keys())}")
 
+    def __minimize(
+        self,
+        body: BytesBody | FileBody | LazyBody,
+        minimizer: Callable[[str], str],
+        encoding: str,
+    ):
+        content = body.read_bytes()
+        try:
+            return BytesBody(minimizer(content.decode(encoding)).encode(encoding))
+        except Exception as exc:
+            LOG.warning("Skipping minimizer due to exception", exc_info=exc)
+            return BytesBody(content)
+
+    @instrumented
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
         resp = self.next(conn_info, request)
 
@@ -52,20 +68,16 @@ class MinimizeMiddleware(RequestHandlerABC):
         if not minimizer:
             return resp
 
-        try:
-            if isinstance(resp.body, BytesBody):
-                # Directly minimize bytes bodies
-                resp.body.content = minimizer(
-                    resp.body.content.decode(encoding)
-                ).encode(encoding)
-            elif isinstance(resp.body, FileBody):
-                # Convert file bodies to bytes bodies for minimization
-                with resp.body.file_path.open("rb") as f:
-                    resp.body = ResponseBody.from_bytes(
-                        minimizer(f.read().decode(encoding)).encode(encoding)
-                    )
-        except Exception as exc:
-            LOG.warning("Skipping minimizer due to exception", exc_info=exc)
-            pass
+        # Minimization is deferred until the body is sent, HEAD requests skip it
+        body = resp.body
+        if isinstance(body, (BytesBody, FileBody)):
+            size_hint = len(body)
+        elif isinstance(body, LazyBody):
+            size_hint = body.size_hint
+        else:
+            return resp
 
+        resp.body = ResponseBody.from_factory(
+            lambda: self.__minimize(body, minimizer, encoding), size_hint
+        )
         return resp
@@ -1,8 +1,9 @@
-from urllib.parse import urlparse
 from ..http.response import HTTPResponseFactory
 from ..networking import ConnectionInfo
 from ..http.request import HTTPRequest
 from ..common import RequestHandlerABC, RequestHandler
+from ..metrics import instrumented
+from ._internal.host_index import HostIndex
 
 REWRITE_STATUS_CODES = {201, 301, 302, 303, 307, 308}
 REWRITE_HEADERS = {"Location", "Content-Location", "URI"}
@@ -10,10 +11,18 @@ REWRITE_HEADERS = {"Location", "Content-Location", "URI"}
 
 class RewriteRedirectsMiddleware(RequestHandlerABC):
     def __init__(self, next: RequestHandler, alias_map: dict[str, str]):
-        self.__alias_map = alias_map
+        """Inits RewriteRedirectsMiddleware.
+
+        Args:
+        next -- The next handler in the chain.
+        alias_map -- Replacement authorities by the authority of redirect URLs. Keys are
+            matched like the hosts of VirtualHostMiddleware.
+        """
+        self.__alias_index = HostIndex(alias_map)
         self.next = next
         self.http = HTTPResponseFactory()
 
+    @instrumented
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
         resp = self.next(conn_info, request)
 
@@ -29,11 +38,19 @@ class RewriteRedirectsMiddleware(RequestHandlerABC):
         return resp
 
     def __rewrite(self, url: str) -> str:
-        try:
-            result = urlparse(url)
-            for alias, target in self.__alias_map.items():
-                if result.netloc == alias:
-                    return result._replace(netloc=target).geturl()
-        except:
-            pass
-        return url
+        # Find the authority of absolute and scheme-relative URLs
+        if url.startswith("//"):
+            start = 2
+        elif (start := url.find("://")) >= 0:
+            start += 3
+        else:
+            return url
+
+        end = len(url)
+        for delimiter in "/?#":
+            index = url.find(delimiter, start)
+            if 0 <= index < end:
+                end = index
+
+        target = self.__alias_index.get(url[start:end])
+        return url if target is None else url[:start] + target + url[end:]
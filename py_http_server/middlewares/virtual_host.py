@@ -3,23 +3,37 @@ from ..networking import ConnectionInfo
 from ..http.response import HTTPResponseFactory
 from ..http.request import HTTPRequest
 from ..common import RequestHandlerABC, RequestHandler, NO_CACHE_HEADERS
+from ..metrics import instrumented
+from ._internal.host_index import HostIndex
 
 
 class VirtualHostMiddleware(RequestHandlerABC):
     def __init__(self, next_map: dict[Union[str, None], RequestHandler]):
+        """Inits VirtualHostMiddleware.
+
+        Args:
+        next_map -- Handlers by host. Hosts may have a port ("example.com:8080") or be
+            wildcards ("*.example.com") or suffixes (".example.com"), None is the default.
+            Hosts without a port match any port, case is ignored.
+        """
         self.next_map = next_map
         self.http = HTTPResponseFactory(NO_CACHE_HEADERS)
 
-    def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
-        # Forward the request to correct host if host header is present and is a match
-        if "Host" in request.headers:
-            host = request.headers["Host"]
-            if host in self.next_map:
-                return self.next_map[host](conn_info, request)
+    @property
+    def next_map(self) -> dict[Union[str, None], RequestHandler]:
+        return self.__next_map
 
-        # Forward the request to default virtual host if there is one
-        if None in self.next_map:
-            return self.next_map[None](conn_info, request)
+    @next_map.setter
+    def next_map(self, value: dict[Union[str, None], RequestHandler]):
+        self.__next_map = value
+        self.__index = HostIndex(value)
+
+    @instrumented
+    def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
+        # Forward the request to the matching host or the default virtual host
+        next = self.__index.get(request.headers.get("Host"))
+        if next is not None:
+            return next(conn_info, request)
 
         # No match
         return self.http.status(404)
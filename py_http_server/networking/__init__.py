@@ -1,3 +1,4 @@
-# Public API should have TCPAddress and ConnectionInfo
+# Public API should have TCPAddress, ConnectionInfo and the lifecycle hooks
 from .address import TCPAddress
 from .connection_info import ConnectionInfo
+from .hooks import HOOKS, HookRegistry, LifecycleHooks, ConnectionEvent, RequestEvent
@@ -3,6 +3,8 @@ from typing import Literal
 
 
 class TCPAddress:
+    __slots__ = ("__ip", "__port", "__ipversion")
+
     def __init__(self, ip: str, port: int):
         if not isinstance(port, int) or port < 0 or port > 65535:
             raise ValueError("Invalid port")
@@ -14,6 +16,15 @@ class TCPAddress:
         self.__ip = ip
         self.__port = port
 
+    @classmethod
+    def from_sockaddr(cls, sockaddr: tuple) -> "TCPAddress":
+        """Creates a TCPAddress from an address returned by the socket module, skipping validation."""
+        address = cls.__new__(cls)
+        address.__ip = sockaddr[0]
+        address.__port = sockaddr[1]
+        address.__ipversion = 6 if ":" in sockaddr[0] else 4
+        return address
+
     @property
     def ip(self) -> str:
         return self.__ip
@@ -1,22 +1,53 @@
 from ..networking.connection_info import ConnectionInfo
 from ..networking.connection_socket import ConnectionSocket, GracefulDisconnectException
-from ..common import RequestHandler
+from ..networking.hooks import HOOKS, ConnectionEvent, HookRegistry, RequestEvent
+from ..common import RequestHandler, NO_CACHE_HEADERS
 from ..http.request import HTTPRequest
+from ..http.response import HTTPResponseFactory
+from ..access_log import AccessLog
+from ..metrics import REGISTRY
+from ..memory import MEMORY, REQUEST_KINDS, MemoryLimitError
 from .. import log
+from typing import Optional
 import threading
+import time
 
 LOG = log.getLogger("connection")
 
+# Unread request bodies up to this size are skipped to keep the connection alive
+MAX_UNREAD_BODY_SIZE = 1048576
+
+# Methods counted by name, others are counted as "OTHER" to bound the label values
+_METHODS = {
+    "GET", "HEAD", "POST", "PUT", "DELETE", "CONNECT", "OPTIONS", "TRACE", "PATCH"
+}
+
+_CONNECTIONS_OPEN = REGISTRY.gauge("http_connections_open", "Open client connections")
+_REQUESTS = REGISTRY.counter("http_requests", "Requests received", ["method"])
+_REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "http_requests_in_flight", "Requests being handled or sent"
+)
+_REQUEST_DURATION = REGISTRY.histogram(
+    "http_request_duration_seconds", "Time from a parsed request to its sent response"
+)
+
+# Builds the responses to requests rejected by the memory limits
+_HTTP = HTTPResponseFactory(NO_CACHE_HEADERS)
+
 
 class ConnectionThread(threading.Thread):
     def __init__(
         self,
         conn: ConnectionSocket,
         handler: RequestHandler,
+        access_log: Optional[AccessLog] = None,
+        hooks: HookRegistry = HOOKS,
     ):
         super().__init__()
         self.__conn = conn
         self.__handler = handler
+        self.__access_log = access_log
+        self.__hooks = hooks
         self.__disposed = False
 
     @staticmethod
@@ -39,23 +70,114 @@ class ConnectionThread(threading.Thread):
             self.__conn.remote_address, self.__conn.remote_address, self.__conn.has_ssl
         )
 
+        # Bytes held for the connection, e.g. buffered request bodies
+        memory = self.__conn.memory = MEMORY.account(
+            str(self.__conn.remote_address)
+        )
+
+        hooks = self.__hooks
+        if hooks.on_accept:
+            hooks.emit(hooks.on_accept, self.__connection_event(conn_info))
+
+        _CONNECTIONS_OPEN.inc()
         try:
             while True:
+                # Events are only created if request hooks are registered
+                event = None
+                if hooks.request_hooks:
+                    self.__conn.mark_receive()
+                bytes_received = self.__conn.bytes_received
+
                 # Read request from socket
-                req = HTTPRequest.receive_from(self.__conn)
-                LOG.info(f"({self.__conn.remote_address}) {req}")
+                try:
+                    req = HTTPRequest.receive_from(self.__conn)
+                except ValueError as exc:
+                    # Bytes after a malformed header can't be framed, the connection is closed
+                    LOG.warning("(%s) %s", self.__conn.remote_address, exc)
+                    resp = _HTTP.status(400)
+                    resp.headers["Connection"] = "close"
+                    resp.send_to(self.__conn, "HTTP/1.1")
+                    break
+                LOG.debug("(%s) %s", self.__conn.remote_address, req)
+                start = time.perf_counter()
+                bytes_sent = self.__conn.bytes_sent
+
+                if hooks.request_hooks:
+                    parsed = time.monotonic()
+                    event = RequestEvent(
+                        conn_info,
+                        req,
+                        self.__conn.receive_time or parsed,
+                        parsed,
+                        bytes_received=self.__conn.bytes_received - bytes_received,
+                    )
+                    hooks.emit(hooks.on_request_parsed, event)
+                # Handlers may rewrite the request, log it as received
+                request_line = (req.method, req.path, req.query, req.version)
+                _REQUESTS.labels(
+                    req.method if req.method in _METHODS else "OTHER"
+                ).inc()
 
-                # Execute the handler chain
-                resp = self.__handler(conn_info, req)
-                conn_policy = self.__get_connection_policy(req)
-                resp.headers["Connection"] = conn_policy
+                # Handlers may rewrite the method, e.g. HEAD to GET
+                method = req.method
+                body_stream = req.body_stream
 
-                # Send the response
-                resp.send_to(self.__conn, req.version)
+                _REQUESTS_IN_FLIGHT.inc()
+                try:
+                    # Execute the handler chain
+                    try:
+                        resp = self.__handler(conn_info, req)
+                    except MemoryLimitError as exc:
+                        # The body is skipped or the connection closed like any unread body
+                        LOG.warning("(%s) %s", self.__conn.remote_address, exc)
+                        resp = _HTTP.status(
+                            exc.status_code,
+                            {"Retry-After": "1"} if exc.status_code == 503 else None,
+                        )
+                    conn_policy = self.__get_connection_policy(req)
+                    resp.headers["Connection"] = conn_policy
+
+                    if event:
+                        event.response = resp
+                        event.handler_done = time.monotonic()
+                        hooks.emit(hooks.on_handler_done, event)
+
+                    # Send the response, bodies of HEAD responses are never built
+                    resp.send_to(self.__conn, req.version, method != "HEAD")
+                finally:
+                    _REQUESTS_IN_FLIGHT.dec()
+                    _REQUEST_DURATION.observe(time.perf_counter() - start)
+                    # Tunnel buffers outlive the request, they are released by the relay
+                    memory.release(*REQUEST_KINDS)
+
+                if event:
+                    event.sent = time.monotonic()
+                    event.bytes_received = self.__conn.bytes_received - bytes_received
+                    event.bytes_sent = self.__conn.bytes_sent - bytes_sent
+                    hooks.emit(hooks.on_response_sent, event)
+
+                if self.__access_log:
+                    self.__access_log.log(
+                        self.__conn.remote_address.ip,
+                        *request_line,
+                        resp.status_code,
+                        self.__conn.bytes_sent - bytes_sent,
+                        req.headers.get("Referer"),
+                        req.headers.get("User-Agent"),
+                        time.perf_counter() - start,
+                    )
+
+                # The connection was handed over, e.g. to a TunnelRelay
+                if self.__conn.detached:
+                    break
 
                 # Close the connection if necessary
                 if conn_policy == "close":
                     break
+
+                # The next request starts after the body, close if it's too large to skip
+                if body_stream and not body_stream.discard(MAX_UNREAD_BODY_SIZE):
+                    break
         except (GracefulDisconnectException, ConnectionResetError, ConnectionAbortedError):
             # Disconnection is not an error
             pass
@@ -67,7 +189,18 @@ class ConnectionThread(threading.Thread):
                     exc_info=exc,
                 )
 
+        _CONNECTIONS_OPEN.dec()
         self.dispose()
+        if hooks.on_close:
+            hooks.emit(hooks.on_close, self.__connection_event(conn_info))
+
+    def __connection_event(self, conn_info: ConnectionInfo) -> ConnectionEvent:
+        return ConnectionEvent(
+            conn_info,
+            time.monotonic(),
+            self.__conn.bytes_received,
+            self.__conn.bytes_sent,
+        )
 
     @property
     def disposed(self):
@@ -77,4 +210,4 @@ class ConnectionThread(threading.Thread):
         if not self.__disposed:
             self.__disposed = True
             self.__conn.close()
-            LOG.debug(f"({self.__conn.remote_address}) Closed connection.")
+            LOG.debug("(%s) Closed connection.", self.__conn.remote_address)
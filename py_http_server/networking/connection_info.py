@@ -2,7 +2,7 @@ from dataclasses import dataclass
 from ..networking.address import TCPAddress
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ConnectionInfo:
     remote_address: TCPAddress
     local_address: TCPAddress
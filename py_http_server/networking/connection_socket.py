@@ -1,9 +1,14 @@
 import select
 import socket
 import ssl
+import time
 from platform import platform
+from typing import TYPE_CHECKING
 from py_http_server.networking.address import TCPAddress
 
+if TYPE_CHECKING:
+    from ..memory import MemoryAccount
+
 _PLATFORM = platform()
 _SOCKET_NOPUSH_OPTION = None
 if _PLATFORM.startswith("FreeBSD"):
@@ -42,23 +47,30 @@ class ConnectionSocket:
         enable_sendfile: bool = True,
         enable_nopush: bool = True,
         enable_nodelay: bool = False,
+        remote_address: tuple | None = None,
     ):
         """
         enable_sendfile: When set to True, an attempt will be made to use sendfile, enabled by default.
         enable_nopush: Behaves like Nginx's "tcp_nopush", enabled by default.
         enable_nodelay: Behaves like Nginx's "tcp_nodelay", disabled by default.
+        remote_address: The address returned by accept(), saves a getpeername() call.
         """
-        if _SOCKET_NOPUSH_OPTION != None:
-            sock.setsockopt(socket.IPPROTO_TCP, _SOCKET_NOPUSH_OPTION, enable_nopush)
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, enable_nodelay)
-
-        self.__enable_nodelay = enable_nodelay
         self.__socket = sock
         self.__enable_sendfile = enable_sendfile
+        self.set_options(enable_nopush, enable_nodelay)
 
         self.__has_ssl = isinstance(sock, ssl.SSLSocket)
-        self.__remote_address = None
+        self.__pending = b""
+        self.__detached = False
+        self.__bytes_sent = 0
+        self.__bytes_received = 0
+        self.__mark_receive = False
+        self.__receive_time: float | None = None
+        self.__remote_address = (
+            TCPAddress.from_sockaddr(remote_address) if remote_address else None
+        )
         self.__local_address = None
+        self.__memory: "MemoryAccount | None" = None
 
     @property
     def has_ssl(self) -> bool:
@@ -67,42 +79,142 @@ class ConnectionSocket:
     @property
     def local_address(self) -> TCPAddress:
         if self.__local_address == None:
-            addr = self.__socket.getsockname()
-            self.__local_address = TCPAddress(addr[0], addr[1])
+            self.__local_address = TCPAddress.from_sockaddr(self.__socket.getsockname())
         return self.__local_address
 
     @property
     def remote_address(self) -> TCPAddress:
         if self.__remote_address == None:
-            addr = self.__socket.getpeername()
-            self.__remote_address = TCPAddress(addr[0], addr[1])
+            self.__remote_address = TCPAddress.from_sockaddr(
+                self.__socket.getpeername()
+            )
         return self.__remote_address
 
+    @property
+    def bytes_sent(self) -> int:
+        """Total bytes sent on the connection, e.g. to measure responses."""
+        return self.__bytes_sent
+
+    @property
+    def bytes_received(self) -> int:
+        """Total bytes received on the connection."""
+        return self.__bytes_received
+
+    @property
+    def receive_time(self) -> float | None:
+        """time.monotonic() of the first receive since mark_receive(), None if none yet."""
+        return self.__receive_time
+
+    def mark_receive(self):
+        """Makes the next receive that returns data set receive_time."""
+        self.__mark_receive = True
+        self.__receive_time = None
+
+    @property
+    def memory(self) -> "MemoryAccount | None":
+        """Account of the bytes held for the connection, None if it isn't accounted."""
+        return self.__memory
+
+    @memory.setter
+    def memory(self, value: "MemoryAccount | None"):
+        self.__memory = value
+
+    @property
+    def detached(self) -> bool:
+        return self.__detached
+
+    def set_options(self, enable_nopush: bool, enable_nodelay: bool):
+        if _SOCKET_NOPUSH_OPTION != None:
+            self.__socket.setsockopt(
+                socket.IPPROTO_TCP, _SOCKET_NOPUSH_OPTION, enable_nopush
+            )
+        self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, enable_nodelay)
+        self.__enable_nodelay = enable_nodelay
+
+    def settimeout(self, value: float | None):
+        self.__socket.settimeout(value)
+
     def nonblocking(self):
         return _NonblockingContext(self.__socket)
 
     def recv(self, bufsize: int, flags: int = 0) -> bytes:
-        ret = self.__socket.recv(bufsize, flags)
-        if len(ret) == 0:
-            raise GracefulDisconnectException()
+        # Return bytes given back with unrecv() first
+        if self.__pending:
+            ret, self.__pending = self.__pending[:bufsize], self.__pending[bufsize:]
+        else:
+            ret = self.__socket.recv(bufsize, flags)
+            if len(ret) == 0:
+                raise GracefulDisconnectException()
+            self.__bytes_received += len(ret)
+
+        if self.__mark_receive:
+            self.__mark_receive = False
+            self.__receive_time = time.monotonic()
         return ret
 
+    def recv_into(self, buffer, nbytes: int = 0, flags: int = 0) -> int:
+        view = memoryview(buffer)
+        nbytes = nbytes or len(view)
+
+        # Return bytes given back with unrecv() first
+        if self.__pending:
+            count = min(nbytes, len(self.__pending))
+            view[:count] = self.__pending[:count]
+            self.__pending = self.__pending[count:]
+        else:
+            count = self.__socket.recv_into(buffer, nbytes, flags)
+            if count == 0:
+                raise GracefulDisconnectException()
+            self.__bytes_received += count
+
+        if self.__mark_receive:
+            self.__mark_receive = False
+            self.__receive_time = time.monotonic()
+        return count
+
+    def unrecv(self, data: bytes):
+        """
+        Gives back received bytes that belong to the next message, e.g. a pipelined request.
+        They will be returned by the next recv() calls.
+        """
+        self.__pending = data + self.__pending
+
     def send(self, data, flags: int = 0) -> int:
-        return self.__socket.send(data, flags)
+        sent = self.__socket.send(data, flags)
+        self.__bytes_sent += sent
+        return sent
+
+    def sendall(self, data, flags: int = 0) -> None:
+        self.__socket.sendall(data, flags)
+        self.__bytes_sent += len(data)
 
     def sendfile(self, file, offset=0, count=None):
         if self.__enable_sendfile:
-            return self.__socket.sendfile(file, offset, count)
+            sent = self.__socket.sendfile(file, offset, count)
         else:
-            return self.__socket._sendfile_use_send(file, offset, count)  # type: ignore
+            sent = self.__socket._sendfile_use_send(file, offset, count)  # type: ignore
+        self.__bytes_sent += sent
+        return sent
 
     def flush(self):
         # Force flush of the socket. Only tested on Linux.
-        if not self.__enable_nodelay:
+        if not self.__enable_nodelay and not self.__detached:
             self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
             self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, False)
 
+    def detach(self) -> tuple[socket.socket, bytes]:
+        """
+        Hands the underlying socket over to a new owner, e.g. a TunnelRelay.
+        Returns the socket and the bytes given back with unrecv(), later close() calls do nothing.
+        """
+        self.__detached = True
+        pending, self.__pending = self.__pending, b""
+        return self.__socket, pending
+
     def close(self):
+        if self.__detached:
+            return
+
         # Try to shutdown the socket, this is required on Linux
         # otherwise some socket functions won't return!
         try:
@@ -119,5 +231,17 @@ class ConnectionSocket:
         Wait for any of the given sockets to be readable.
         Returns a set of sockets that are readable.
         """
-        rlist, _, _ = select.select([x.__socket for x in sockets], [], [], timeout)
-        return {x for x in sockets if x.__socket in rlist}
+        if pending := {x for x in sockets if x.__pending}:
+            return pending
+
+        # select() can't wait on file descriptors past FD_SETSIZE (1024 on Linux)
+        if not hasattr(select, "poll"):
+            rlist, _, _ = select.select([x.__socket for x in sockets], [], [], timeout)
+            return {x for x in sockets if x.__socket in rlist}
+
+        poller = select.poll()
+        by_fd = {x.__socket.fileno(): x for x in sockets}
+        for fd in by_fd:
+            poller.register(fd, select.POLLIN)
+        events = poller.poll(None if timeout is None else timeout * 1000)
+        return {by_fd[fd] for fd, _ in events}
@@ -0,0 +1,141 @@
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+if TYPE_CHECKING:
+    from ..http.request import HTTPRequest
+    from ..http.response import HTTPResponse
+
+from dataclasses import dataclass, field
+from ..networking.connection_info import ConnectionInfo
+from .. import log
+import threading
+
+LOG = log.getLogger("hooks")
+
+EVENTS = (
+    "on_accept",
+    "on_request_parsed",
+    "on_handler_done",
+    "on_response_sent",
+    "on_close",
+)
+
+
+@dataclass(slots=True)
+class ConnectionEvent:
+    """Passed to on_accept and on_close. Times are from time.monotonic()."""
+
+    conn_info: ConnectionInfo
+    time: float
+    # Totals of the connection so far
+    bytes_received: int
+    bytes_sent: int
+
+
+@dataclass(slots=True)
+class RequestEvent:
+    """Passed to on_request_parsed, on_handler_done and on_response_sent.
+
+    The same event is updated and passed to each of them, so hooks can keep
+    per-request values in data. Times are from time.monotonic() and are None
+    until their stage is reached. Byte counts are those of this request so far,
+    pipelined requests received together are counted for the first of them.
+    """
+
+    conn_info: ConnectionInfo
+    request: "HTTPRequest"
+    # When the first bytes of the request were received and when its head was parsed
+    received: float
+    parsed: float
+    handler_done: Optional[float] = None
+    sent: Optional[float] = None
+    response: Optional["HTTPResponse"] = None
+    bytes_received: int = 0
+    bytes_sent: int = 0
+    data: dict[str, Any] = field(default_factory=dict)
+
+
+class LifecycleHooks:
+    """Base class of lifecycle hooks, override the events of interest.
+
+    Hooks run on the connection's thread and should be quick. Exceptions
+    are logged and don't affect the connection. Events that aren't
+    overridden are never called.
+    """
+
+    def on_accept(self, event: ConnectionEvent) -> None:
+        """A connection was accepted and its thread started."""
+
+    def on_request_parsed(self, event: RequestEvent) -> None:
+        """The head of a request was parsed, the body may still be unread."""
+
+    def on_handler_done(self, event: RequestEvent) -> None:
+        """The handler chain returned a response, nothing is sent yet."""
+
+    def on_response_sent(self, event: RequestEvent) -> None:
+        """The response was sent, including its body."""
+
+    def on_close(self, event: ConnectionEvent) -> None:
+        """The connection was closed or handed over, e.g. to a TunnelRelay."""
+
+
+class HookRegistry:
+    """Holds the callbacks of each event as tuples.
+
+    Registration replaces the tuples, so connection threads read them
+    without locking. With nothing registered an event costs a truth test.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__hooks: list[LifecycleHooks] = []
+        self.on_accept: tuple[Callable[[ConnectionEvent], None], ...] = ()
+        self.on_request_parsed: tuple[Callable[[RequestEvent], None], ...] = ()
+        self.on_handler_done: tuple[Callable[[RequestEvent], None], ...] = ()
+        self.on_response_sent: tuple[Callable[[RequestEvent], None], ...] = ()
+        self.on_close: tuple[Callable[[ConnectionEvent], None], ...] = ()
+        # True if any request event has callbacks, RequestEvents are only created then
+        self.request_hooks = False
+
+    def __update(self):
+        # Must be called while holding the lock
+        for name in EVENTS:
+            setattr(
+                self,
+                name,
+                tuple(
+                    getattr(hooks, name)
+                    for hooks in self.__hooks
+                    if getattr(type(hooks), name) is not getattr(LifecycleHooks, name)
+                ),
+            )
+        self.request_hooks = bool(
+            self.on_request_parsed or self.on_handler_done or self.on_response_sent
+        )
+
+    def register(self, hooks: LifecycleHooks):
+        """Adds hooks, they apply to connections from their next event on."""
+        with self.__lock:
+            if hooks not in self.__hooks:
+                self.__hooks.append(hooks)
+                self.__update()
+
+    def unregister(self, hooks: LifecycleHooks):
+        with self.__lock:
+            if hooks in self.__hooks:
+                self.__hooks.remove(hooks)
+                self.__update()
+
+    @staticmethod
+    def emit(callbacks: tuple[Callable[[Any], None], ...], event: Any):
+        """Calls each callback with event, logging exceptions."""
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as exc:
+                LOG.exception(
+                    f'Exception in hook "{callback.__qualname__}"', exc_info=exc
+                )
+
+
+# Hooks of all listeners unless they are given their own registry
+HOOKS = HookRegistry()
@@ -3,13 +3,21 @@ from ..networking import ConnectionInfo
 from ..networking.address import TCPAddress
 from ..networking.connection import ConnectionThread
 from ..networking.connection_socket import ConnectionSocket
+from ..networking.hooks import HOOKS, HookRegistry
+from ..access_log import AccessLog
+from ..metrics import REGISTRY
 from .. import log
+from typing import Optional
 import socket
 import threading
 import ssl
 
 LOG = log.getLogger("listener")
 
+_CONNECTIONS_ACCEPTED = REGISTRY.counter(
+    "http_connections_accepted", "Connections accepted by a listener", ["listener"]
+)
+
 
 class ListenerThread(threading.Thread):
     def __init__(
@@ -17,9 +25,13 @@ class ListenerThread(threading.Thread):
         socket: socket.socket,
         bind_address: TCPAddress,
         handler: RequestHandler,
+        access_log: Optional[AccessLog] = None,
+        hooks: HookRegistry = HOOKS,
     ):
         """
         Socket must already be in listening state.
+        access_log: Logs the requests of all connections.
+        hooks: Lifecycle hooks of all connections.
         """
         super().__init__()
         self.__disposed = False
@@ -27,6 +39,9 @@ class ListenerThread(threading.Thread):
         self.__socket = socket
         self.__bind_address = bind_address
         self.__handler = handler
+        self.__access_log = access_log
+        self.__hooks = hooks
+        self.__accepted = _CONNECTIONS_ACCEPTED.labels(str(bind_address))
 
     def run(self):
         if self.__disposed:
@@ -40,8 +55,9 @@ class ListenerThread(threading.Thread):
                 # Wait for a connection
                 try:
                     # Wrap connection in ConnectionSocket
-                    conn, _ = self.__socket.accept()
-                    conn = ConnectionSocket(conn)
+                    conn, address = self.__socket.accept()
+                    conn = ConnectionSocket(conn, remote_address=address)
+                    self.__accepted.inc()
                 except ssl.SSLError as exc:
                     # Ignore SSLErrors during handshake as logging them will be quite noisy
                     continue
@@ -49,7 +65,9 @@ class ListenerThread(threading.Thread):
                 try:
                     self.__add_connection(conn)
                     LOG.debug(
-                        f"({self.__bind_address}) Client connected from {conn.remote_address}"
+                        "(%s) Client connected from %s",
+                        self.__bind_address,
+                        conn.remote_address,
                     )
                 except Exception as exc:
                     conn.close()
@@ -69,7 +87,9 @@ class ListenerThread(threading.Thread):
 
     def __add_connection(self, conn: ConnectionSocket):
         # Connection has to be wrapped with ConnectionSocket
-        self.__connections.append(ConnectionThread(conn, self.__handler))
+        self.__connections.append(
+            ConnectionThread(conn, self.__handler, self.__access_log, self.__hooks)
+        )
         self.__connections[-1].start()
 
     def __clean_old_connections(self):
@@ -95,7 +115,12 @@ class ListenerThread(threading.Thread):
             LOG.info(f"({self.__bind_address}) Closed listener.")
 
     @staticmethod
-    def create(bind_address: TCPAddress, handler: RequestHandler):
+    def create(
+        bind_address: TCPAddress,
+        handler: RequestHandler,
+        access_log: Optional[AccessLog] = None,
+        hooks: HookRegistry = HOOKS,
+    ):
         """
         Will throw if the address can't be bound to.
         This method exists to avoid having a constructor that can throw.
@@ -109,7 +134,7 @@ class ListenerThread(threading.Thread):
         )
         sock.listen()
 
-        thread = ListenerThread(sock, bind_address, handler)
+        thread = ListenerThread(sock, bind_address, handler, access_log, hooks)
         thread.start()
         return thread
 
@@ -119,6 +144,8 @@ class ListenerThread(threading.Thread):
         handler: RequestHandler,
         keyfile,
         certfile,
+        access_log: Optional[AccessLog] = None,
+        hooks: HookRegistry = HOOKS,
     ):
         """
         Will throw if the address can't be bound to.
@@ -140,6 +167,6 @@ class ListenerThread(threading.Thread):
         sock = context.wrap_socket(sock, server_side=True)
         sock.listen()
 
-        thread = ListenerThread(sock, bind_address, handler)
+        thread = ListenerThread(sock, bind_address, handler, access_log, hooks)
         thread.start()
         return thread
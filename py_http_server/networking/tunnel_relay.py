@@ -0,0 +1,389 @@
+from .connection_socket import ConnectionSocket
+from ..metrics import REGISTRY
+from ..memory import MemoryAccount
+from .. import log
+from typing import Optional
+import os
+import selectors
+import socket
+import ssl
+import threading
+import time
+
+LOG = log.getLogger("tunnel_relay")
+
+# os.splice() is only available on Linux
+HAS_SPLICE = hasattr(os, "splice")
+_SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK if HAS_SPLICE else 0
+
+# Raised by non-blocking sockets when they aren't ready
+_NOT_READY_ERRORS = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+# Seconds between idle timeout checks
+SWEEP_INTERVAL = 1.0
+
+
+class _Direction:
+    # Relays the bytes of one direction of a tunnel, from src to dst
+
+    def __init__(
+        self,
+        src: socket.socket,
+        dst: socket.socket,
+        buffer: bytes,
+        buffer_size: int,
+        use_splice: bool,
+        memory: Optional[MemoryAccount] = None,
+    ):
+        self.src = src
+        self.dst = dst
+        self.buffer = memoryview(buffer)
+        self.buffer_size = buffer_size
+        self.eof = False
+        self.done = False
+
+        # Bytes of the buffer accounted in memory
+        self.memory = memory
+        self.accounted = 0
+
+        # Bytes are moved through a pipe with splice(), never entering userspace
+        self.pipe = os.pipe() if use_splice else None
+        self.piped = 0
+
+    @property
+    def empty(self) -> bool:
+        return not self.buffer and not self.piped
+
+    @property
+    def wants_read(self) -> bool:
+        return not self.eof and self.empty
+
+    def __flush(self):
+        while self.buffer:
+            self.buffer = self.buffer[self.dst.send(self.buffer) :]
+        while self.piped:
+            self.piped -= os.splice(
+                self.pipe[0], self.dst.fileno(), self.piped, flags=_SPLICE_FLAGS
+            )
+
+    def pump(self) -> int:
+        """Moves bytes from src to dst without blocking, returns the number of bytes received."""
+        received = 0
+        try:
+            self.__flush()
+            if self.wants_read:
+                if self.pipe:
+                    received = os.splice(
+                        self.src.fileno(),
+                        self.pipe[1],
+                        self.buffer_size,
+                        flags=_SPLICE_FLAGS,
+                    )
+                    self.piped = received
+                else:
+                    data = self.src.recv(self.buffer_size)
+                    self.buffer = memoryview(data)
+                    received = len(data)
+                self.eof = received == 0
+                self.__flush()
+        except _NOT_READY_ERRORS:
+            pass
+        finally:
+            self.__account()
+
+        if self.eof and self.empty and not self.done:
+            self.done = True
+
+            # Pass the half-close on. TLS connections can't be half-closed,
+            # they are closed once the other direction is done too.
+            if not isinstance(self.dst, ssl.SSLSocket):
+                self.dst.shutdown(socket.SHUT_WR)
+        return received
+
+    def __account(self):
+        if self.memory and len(self.buffer) != self.accounted:
+            self.memory.track("tunnel", len(self.buffer) - self.accounted)
+            self.accounted = len(self.buffer)
+
+    def close(self):
+        self.buffer = memoryview(b"")
+        self.__account()
+        if self.pipe:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+
+class _Tunnel:
+    def __init__(
+        self,
+        client: socket.socket,
+        remote: socket.socket,
+        pending: bytes,
+        buffer_size: int,
+        use_splice: bool,
+        memory: Optional[MemoryAccount] = None,
+    ):
+        self.client = client
+        self.remote = remote
+        # Buffers of both directions are accounted to the client connection
+        self.upstream = _Direction(
+            client, remote, pending, buffer_size, use_splice, memory
+        )
+        self.downstream = _Direction(
+            remote, client, b"", buffer_size, use_splice, memory
+        )
+        self.last_active = time.monotonic()
+
+        # Registered selector events of each socket
+        self.events = {client: 0, remote: 0}
+
+    @property
+    def done(self) -> bool:
+        return self.upstream.done and self.downstream.done
+
+    @property
+    def has_buffered_tls(self) -> bool:
+        # Decrypted bytes buffered by the SSL object don't make the socket readable
+        return any(
+            isinstance(d.src, ssl.SSLSocket) and d.wants_read and d.src.pending()
+            for d in (self.upstream, self.downstream)
+        )
+
+    def get_events(self, sock: socket.socket) -> int:
+        events = 0
+        for direction in (self.upstream, self.downstream):
+            if direction.src is sock and direction.wants_read:
+                events |= selectors.EVENT_READ
+            if direction.dst is sock and not direction.empty:
+                events |= selectors.EVENT_WRITE
+        return events
+
+    def close(self):
+        self.upstream.close()
+        self.downstream.close()
+        for sock in (self.client, self.remote):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+class TunnelRelay:
+    """Relays the bytes of many CONNECT tunnels on a single thread.
+
+    Sockets are multiplexed with the best selector of the platform (epoll on
+    Linux) and bytes are moved with splice() where available. A direction
+    that reaches EOF is half-closed while the other one keeps flowing, and
+    tunnels without traffic for idle_timeout seconds are closed.
+    """
+
+    def __init__(
+        self,
+        idle_timeout: Optional[float] = 300.0,
+        buffer_size: int = 65536,
+        use_splice: bool = True,
+    ):
+        """Inits TunnelRelay. The relay thread is started with the first tunnel.
+
+        Args:
+        idle_timeout -- Seconds a tunnel may go without traffic before it's closed, None to keep it open.
+        buffer_size -- Maximum number of bytes moved at once per direction.
+        use_splice -- If True, plain TCP tunnels are relayed with os.splice() when it's available.
+        """
+        self.__idle_timeout = idle_timeout
+        self.__buffer_size = buffer_size
+        self.__use_splice = use_splice and HAS_SPLICE
+
+        self.__lock = threading.Lock()
+        self.__thread: Optional[threading.Thread] = None
+        self.__selector: Optional[selectors.BaseSelector] = None
+        self.__waker: Optional[tuple[socket.socket, socket.socket]] = None
+        self.__new_tunnels: list[_Tunnel] = []
+        self.__tunnels: set[_Tunnel] = set()
+
+        # Tunnels that must be pumped again without waiting for events
+        self.__ready: set[_Tunnel] = set()
+        self.__closed = False
+
+        self.__total_tunnels = 0
+        self.__bytes_relayed = 0
+        self.__idle_closed = 0
+        REGISTRY.add_stats("tunnel_relay", self, ["tunnels"])
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "tunnels": len(self.__tunnels) + len(self.__new_tunnels),
+            "total_tunnels": self.__total_tunnels,
+            "bytes_relayed": self.__bytes_relayed,
+            "idle_closed": self.__idle_closed,
+        }
+
+    def add(self, client: ConnectionSocket, remote: ConnectionSocket):
+        """Takes over both connections and relays bytes between them until both directions are done."""
+        client.set_options(enable_nopush=False, enable_nodelay=True)
+        remote.set_options(enable_nopush=False, enable_nodelay=True)
+        memory = client.memory
+        client_sock, pending = client.detach()
+        remote_sock, remote_pending = remote.detach()
+        client_sock.setblocking(False)
+        remote_sock.setblocking(False)
+
+        # Client bytes that arrived with the CONNECT request are relayed first
+        tunnel = _Tunnel(
+            client_sock,
+            remote_sock,
+            pending,
+            self.__buffer_size,
+            self.__use_splice
+            and not isinstance(client_sock, ssl.SSLSocket)
+            and not isinstance(remote_sock, ssl.SSLSocket),
+            memory,
+        )
+        if remote_pending:
+            tunnel.downstream.buffer = memoryview(remote_pending)
+
+        with self.__lock:
+            if self.__closed:
+                tunnel.close()
+                raise RuntimeError("Cannot add a tunnel to a closed TunnelRelay")
+
+            if not self.__thread:
+                self.__selector = selectors.DefaultSelector()
+                self.__waker = socket.socketpair()
+                self.__waker[0].setblocking(False)
+                self.__waker[1].setblocking(False)
+                self.__selector.register(self.__waker[0], selectors.EVENT_READ)
+                self.__thread = threading.Thread(
+                    target=self.__run, name="TunnelRelay", daemon=True
+                )
+                self.__thread.start()
+
+            self.__new_tunnels.append(tunnel)
+            self.__total_tunnels += 1
+        self.__wake()
+
+    def close(self):
+        """Closes all tunnels and stops the relay thread."""
+        with self.__lock:
+            self.__closed = True
+        self.__wake()
+
+    def __wake(self):
+        if self.__waker:
+            try:
+                self.__waker[1].send(b"\0")
+            except OSError:
+                # A wake-up is pending already or the relay is stopped
+                pass
+
+    def __update(self, tunnel: _Tunnel):
+        # Must be called from the relay thread
+        for sock in (tunnel.client, tunnel.remote):
+            events = tunnel.get_events(sock)
+            if events == tunnel.events[sock]:
+                continue
+            if not events:
+                self.__selector.unregister(sock)
+            elif not tunnel.events[sock]:
+                self.__selector.register(sock, events, tunnel)
+            else:
+                self.__selector.modify(sock, events, tunnel)
+            tunnel.events[sock] = events
+
+    def __close_tunnel(self, tunnel: _Tunnel):
+        # Must be called from the relay thread
+        for sock, events in tunnel.events.items():
+            if events:
+                self.__selector.unregister(sock)
+        tunnel.close()
+        self.__tunnels.discard(tunnel)
+        self.__ready.discard(tunnel)
+
+    def __pump(self, tunnel: _Tunnel):
+        try:
+            received = tunnel.upstream.pump() + tunnel.downstream.pump()
+            if received:
+                tunnel.last_active = time.monotonic()
+                self.__bytes_relayed += received
+            if not tunnel.done:
+                self.__update(tunnel)
+        except OSError:
+            # Resets and broken pipes end the whole tunnel
+            self.__close_tunnel(tunnel)
+            return
+        except Exception as exc:
+            # Other errors end the tunnel too, but not the relay
+            LOG.exception("Error in tunnel", exc_info=exc)
+            self.__close_tunnel(tunnel)
+            return
+
+        if tunnel.done:
+            self.__close_tunnel(tunnel)
+            return
+        if tunnel.has_buffered_tls:
+            self.__ready.add(tunnel)
+
+    def __sweep(self):
+        if self.__idle_timeout is None:
+            return
+        now = time.monotonic()
+        for tunnel in [
+            x for x in self.__tunnels if now - x.last_active > self.__idle_timeout
+        ]:
+            self.__idle_closed += 1
+            self.__close_tunnel(tunnel)
+
+    def __run(self):
+        last_sweep = time.monotonic()
+
+        try:
+            while True:
+                # Decrypted TLS bytes don't make sockets readable, pump them without waiting
+                events = self.__selector.select(0 if self.__ready else SWEEP_INTERVAL)
+                ready, self.__ready = self.__ready, set()
+
+                with self.__lock:
+                    if self.__closed:
+                        break
+                    new_tunnels, self.__new_tunnels = self.__new_tunnels, []
+
+                for tunnel in new_tunnels:
+                    self.__tunnels.add(tunnel)
+                    self.__pump(tunnel)
+
+                pumped = set()
+                for key, _ in events:
+                    if key.data is None:
+                        # Drain the wake-up bytes
+                        try:
+                            while key.fileobj.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    elif key.data in self.__tunnels and key.data not in pumped:
+                        pumped.add(key.data)
+                        self.__pump(key.data)
+
+                for tunnel in ready - pumped:
+                    if tunnel in self.__tunnels:
+                        self.__pump(tunnel)
+
+                if time.monotonic() - last_sweep >= SWEEP_INTERVAL:
+                    last_sweep = time.monotonic()
+                    self.__sweep()
+        except Exception as exc:
+            LOG.exception("Error in TunnelRelay", exc_info=exc)
+
+        with self.__lock:
+            self.__closed = True
+            tunnels = list(self.__tunnels) + self.__new_tunnels
+            self.__new_tunnels = []
+        for tunnel in tunnels:
+            self.__close_tunnel(tunnel)
+        self.__selector.close()
+        for sock in self.__waker:
+            sock.close()
+        LOG.debug("Closed relay.")
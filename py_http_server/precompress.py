@@ -0,0 +1,306 @@
+"""Build-time precompression of a FileRouter document root.
+
+Writes ".br", ".zst" and ".gz" variants next to each compressible file at the
+maximum compression level so that FileRouter(serve_precompressed=True) can
+serve them without compressing in the request path. A manifest of the files
+that didn't pay is kept outside the document root, next to it by default.
+
+Usage: python -m py_http_server.precompress <document_root> [options]
+"""
+
+from .common import PRECOMPRESSED_SUFFIXES
+from . import log
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Optional
+import argparse
+import gzip
+import json
+import mimetypes
+import os
+
+LOG = log.getLogger("precompress")
+# Suffix of the default manifest, e.g. "/srv/www.precompress.json" for "/srv/www"
+MANIFEST_SUFFIX = ".precompress.json"
+COMPRESSORS: dict[str, Callable[[bytes], bytes]] = {}
+
+try:
+    import brotli  # type: ignore
+
+    COMPRESSORS["br"] = lambda data: brotli.compress(data, quality=11)
+except:
+    pass
+
+try:
+    import zstd  # type: ignore
+
+    COMPRESSORS["zstd"] = lambda data: zstd.compress(data, 22)
+except:
+    pass
+
+# Fixed mtime makes the output reproducible
+COMPRESSORS["gzip"] = lambda data: gzip.compress(data, 9, mtime=0)
+
+# MIME types that are already compressed
+INCOMPRESSIBLE_MIME_PREFIXES = ("image/", "audio/", "video/")
+COMPRESSIBLE_MIME_EXCEPTIONS = {"image/svg+xml", "image/bmp", "image/x-icon"}
+INCOMPRESSIBLE_MIME_TYPES = {
+    "application/gzip",
+    "application/x-gzip",
+    "application/zip",
+    "application/x-7z-compressed",
+    "application/x-bzip2",
+    "application/x-rar-compressed",
+    "application/x-xz",
+    "application/zstd",
+    "application/pdf",
+    "font/woff",
+    "font/woff2",
+}
+
+
+def is_compressible(path: Path) -> bool:
+    mime_type, encoding = mimetypes.guess_type(path, False)
+    if encoding:
+        # E.g. ".tar.gz"
+        return False
+    if not mime_type or mime_type in COMPRESSIBLE_MIME_EXCEPTIONS:
+        return True
+    if mime_type in INCOMPRESSIBLE_MIME_TYPES:
+        return False
+    return not mime_type.startswith(INCOMPRESSIBLE_MIME_PREFIXES)
+
+
+def variant_path(path: Path, encoding: str) -> Path:
+    return path.with_name(path.name + PRECOMPRESSED_SUFFIXES[encoding])
+
+
+def is_stale(source: os.stat_result, variant: Path, source_size: Optional[int]) -> bool:
+    # Variants carry the mtime of their source, see _write_variant, and the
+    # manifest the size, None if the source is new
+    if source_size != source.st_size:
+        return True
+    try:
+        return variant.stat().st_mtime_ns != source.st_mtime_ns
+    except FileNotFoundError:
+        return True
+
+
+def _write_variant(path: Path, stat: os.stat_result, data: bytes):
+    # Write to a temporary file first so that readers never see partial output
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with tmp_path.open("wb") as f:
+            f.write(data)
+        os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def precompress_file(
+    path: Path,
+    encodings: list[str],
+    min_ratio: float,
+    skip: Optional[list[str]] = None,
+    force: bool = False,
+    source_size: Optional[int] = None,
+) -> dict[str, Optional[int]]:
+    """Compresses a single file, runs in a worker process.
+
+    skip lists the variants dropped at the last run and source_size is the
+    size of the file then, see _Manifest.get. Returns the new size of each
+    rebuilt variant, or None if the variant was dropped because compression
+    didn't pay.
+    """
+    stat = path.stat()
+    results: dict[str, Optional[int]] = {}
+
+    stale = [
+        x
+        for x in encodings
+        if force
+        or (
+            x not in (skip or []) and is_stale(stat, variant_path(path, x), source_size)
+        )
+    ]
+    if not stale:
+        return results
+
+    data = path.read_bytes()
+    for encoding in stale:
+        out_path = variant_path(path, encoding)
+        compressed = COMPRESSORS[encoding](data)
+
+        if len(compressed) > len(data) * min_ratio:
+            # Remove the old variant so that it isn't served for new content
+            out_path.unlink(missing_ok=True)
+            results[encoding] = None
+            continue
+
+        _write_variant(out_path, stat, compressed)
+        results[encoding] = len(compressed)
+    return results
+
+
+def find_files(document_root: Path, min_size: int):
+    variant_suffixes = set(PRECOMPRESSED_SUFFIXES.values())
+    for dir_path, _, file_names in os.walk(document_root):
+        for file_name in file_names:
+            path = Path(dir_path, file_name)
+            if path.suffix in variant_suffixes or file_name.startswith("."):
+                continue
+            # Symlinks are skipped as FileRouter doesn't follow them by default
+            if path.is_symlink() or not path.is_file():
+                continue
+            stat = path.stat()
+            if stat.st_size < min_size or not is_compressible(path):
+                continue
+            yield path, stat
+
+
+class _Manifest:
+    """Remembers the size, mtime and the variants that didn't pay of each file,
+    so that resized files are rebuilt and incompressible files aren't compressed
+    again on every run. Only the files of the last run are kept.
+    """
+
+    def __init__(self, path: Path):
+        self.__path = path
+        self.__entries: dict[str, list] = {}
+        self.__new_entries: dict[str, list] = {}
+        try:
+            self.__entries = json.loads(path.read_text("utf-8"))
+        except (OSError, ValueError):
+            pass
+
+    def get(self, key: str, stat: os.stat_result) -> tuple[Optional[int], list[str]]:
+        """Returns the size of the file at the last run, None if it is new, and
+        the variants dropped then if its size and mtime are unchanged.
+        """
+        entry = self.__entries.get(key)
+        if not entry:
+            return None, []
+        if entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[0], entry[2]
+        return entry[0], []
+
+    def set(self, key: str, stat: os.stat_result, dropped: list[str]):
+        self.__new_entries[key] = [stat.st_size, stat.st_mtime_ns, dropped]
+
+    def save(self):
+        self.__path.write_text(json.dumps(self.__new_entries), "utf-8")
+
+
+def precompress(
+    document_root: str,
+    encodings: Optional[list[str]] = None,
+    workers: Optional[int] = None,
+    min_size: int = 256,
+    min_ratio: float = 0.95,
+    force: bool = False,
+    manifest_path: Optional[str] = None,
+):
+    """Precompresses a document root.
+
+    Args:
+    document_root -- Document root of the FileRouter.
+    encodings -- Encodings to generate, defaults to all available ones.
+    workers -- Number of worker processes, defaults to the number of CPUs.
+    min_size -- Files smaller than this many bytes are skipped.
+    min_ratio -- Variants larger than this fraction of the original are dropped.
+    force -- If True, rebuilds all variants regardless of their mtime.
+    manifest_path -- Manifest of the dropped variants, must be outside the document root
+        as it lists its files. Defaults to "<document_root>.precompress.json".
+    """
+    if encodings is None:
+        encodings = [x for x in PRECOMPRESSED_SUFFIXES if x in COMPRESSORS]
+    for encoding in encodings:
+        if encoding not in COMPRESSORS:
+            raise ValueError(f'Encoding "{encoding}" is not available')
+
+    root = Path(document_root).resolve()
+    if manifest_path is None:
+        path = root.parent / (root.name + MANIFEST_SUFFIX)
+    else:
+        path = Path(manifest_path).resolve()
+        if path.is_relative_to(root):
+            raise ValueError("The manifest must be outside the document root")
+    manifest = _Manifest(path)
+    written = dropped = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for path, stat in find_files(root, min_size):
+            key = path.relative_to(root).as_posix()
+            source_size, skip = manifest.get(key, stat)
+            future = executor.submit(
+                precompress_file, path, encodings, min_ratio, skip, force, source_size
+            )
+            futures[future] = (path, key, stat, skip)
+
+        for future in as_completed(futures):
+            path, key, stat, skip = futures[future]
+            try:
+                results = future.result()
+            except Exception as exc:
+                LOG.exception(f'Failed to precompress "{path}"', exc_info=exc)
+                continue
+
+            for encoding, size in results.items():
+                if size is None:
+                    dropped += 1
+                else:
+                    written += 1
+                    LOG.debug(f'Wrote {encoding} variant of "{path}" ({size} bytes)')
+
+            manifest.set(
+                key,
+                stat,
+                [x for x in encodings if results.get(x, 0) is None]
+                + [x for x in skip if x not in results],
+            )
+
+    manifest.save()
+    LOG.info(
+        f"Precompressed {len(futures)} files, wrote {written} variants and dropped {dropped}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m py_http_server.precompress",
+        description="Writes precompressed variants of the files in a document root.",
+    )
+    parser.add_argument("document_root")
+    parser.add_argument(
+        "-e",
+        "--encodings",
+        help=f"comma separated list, available: {', '.join(COMPRESSORS)}",
+    )
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--min-size", type=int, default=256)
+    parser.add_argument("--min-ratio", type=float, default=0.95)
+    parser.add_argument("-f", "--force", action="store_true")
+    parser.add_argument(
+        "-m", "--manifest", help="defaults to <document_root>.precompress.json"
+    )
+    args = parser.parse_args()
+
+    log.init()
+    try:
+        precompress(
+            args.document_root,
+            args.encodings.split(",") if args.encodings else None,
+            args.workers,
+            args.min_size,
+            args.min_ratio,
+            args.force,
+            args.manifest,
+        )
+    except Exception as exc:
+        LOG.fatal("Unrecoverable error", exc_info=exc)
+    log.shutdown()
+
+
+if __name__ == "__main__":
+    main()
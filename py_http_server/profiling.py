@@ -0,0 +1,298 @@
+from collections import Counter
+from typing import Optional
+from .networking.hooks import LifecycleHooks, RequestEvent, ConnectionEvent
+from .metrics import REGISTRY, CURRENT_STAGES
+from . import log
+import heapq
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+
+LOG = log.getLogger("profiling")
+
+
+class RequestProfile:
+    """Stages of one request, recorded by instrumented handlers.
+
+    Each stage is a [name, self time] pair in the order the handlers were
+    called. Self times exclude the nested handlers, so the stages of a chain
+    sum up to the time of its outermost handler.
+    """
+
+    __slots__ = ("request_line", "sampled", "stages", "stacks", "__children")
+
+    def __init__(self, request_line: str, sampled: bool):
+        self.request_line = request_line
+        self.sampled = sampled
+        self.stages: list[list] = []
+        # Folded stacks of the request's thread and their sample counts
+        self.stacks: Counter[str] = Counter()
+        # Time spent in the nested handlers of each handler being called
+        self.__children: list[float] = []
+
+    def enter(self, name: str) -> int:
+        self.stages.append([name, 0.0])
+        self.__children.append(0.0)
+        return len(self.stages) - 1
+
+    def exit(self, index: int, elapsed: float):
+        self.stages[index][1] = elapsed - self.__children.pop()
+        if self.__children:
+            self.__children[-1] += elapsed
+
+
+class Profiler(LifecycleHooks):
+    """Times each instrumented handler of a chain, register it with HOOKS.
+
+    All requests are timed, sampled and flagged requests get a Server-Timing
+    header and their stacks sampled. Stacks of the slowest sampled requests
+    are dumped periodically in the folded format of flame graph tools.
+    Handlers outside this package are timed if their __call__ is decorated
+    with metrics.instrumented.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.01,
+        flag_token: Optional[str] = None,
+        flag_header: str = "X-Profile",
+        slow_threshold: Optional[float] = 1.0,
+        server_timing: bool = True,
+        dump_dir: Optional[str] = None,
+        dump_interval: float = 60.0,
+        dump_count: int = 10,
+        sampling_interval: float = 0.005,
+    ):
+        """Inits Profiler.
+
+        Args:
+        sample_rate -- Fraction of the requests to sample.
+        flag_token -- Requests with flag_header set to this value are sampled, disabled if None.
+        flag_header -- Header that flags a request for sampling.
+        slow_threshold -- Requests slower than this many seconds are logged with their stages, disabled if None.
+        server_timing -- Whether sampled responses get a Server-Timing header.
+        dump_dir -- Directory of the stack dumps, stacks are not sampled if None.
+        dump_interval -- Seconds between the dumps.
+        dump_count -- Number of the slowest requests in each dump.
+        sampling_interval -- Seconds between the stack samples of sampled requests.
+        """
+        self.__sample_rate = sample_rate
+        self.__flag_token = flag_token
+        self.__flag_header = flag_header
+        self.__slow_threshold = slow_threshold
+        self.__server_timing = server_timing
+        self.__dump_dir = dump_dir
+        self.__dump_interval = dump_interval
+        self.__dump_count = dump_count
+        self.__sampling_interval = sampling_interval
+
+        self.__lock = threading.Lock()
+        # Profiles of the sampled requests in flight by thread ident
+        self.__in_flight: dict[int, RequestProfile] = {}
+        # Slowest sampled requests and all stacks since the last dump
+        self.__slowest: list[tuple[float, int, RequestProfile]] = []
+        self.__stacks: Counter[str] = Counter()
+        self.__seq = itertools.count()
+
+        self.__requests = 0
+        self.__sampled = 0
+        self.__slow = 0
+        self.__samples = 0
+        self.__dumps = 0
+
+        self.__closed = False
+        self.__wakeup = threading.Event()
+        self.__thread = None
+        if dump_dir is not None:
+            os.makedirs(dump_dir, exist_ok=True)
+            self.__thread = threading.Thread(
+                target=self.__run, name="Profiler", daemon=True
+            )
+            self.__thread.start()
+        REGISTRY.add_stats("http_profiler", self)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "requests": self.__requests,
+            "sampled": self.__sampled,
+            "slow": self.__slow,
+            "samples": self.__samples,
+            "dumps": self.__dumps,
+        }
+
+    def on_request_parsed(self, event: RequestEvent):
+        request = event.request
+        sampled = random.random() < self.__sample_rate or (
+            self.__flag_token is not None
+            and request.headers.get(self.__flag_header) == self.__flag_token
+        )
+        profile = RequestProfile(
+            f"{request.method} {request.path} {request.version}", sampled
+        )
+        event.data["profile"] = profile
+        CURRENT_STAGES.profile = profile
+
+        self.__requests += 1
+        if sampled:
+            self.__sampled += 1
+            if self.__thread:
+                with self.__lock:
+                    self.__in_flight[threading.get_ident()] = profile
+                self.__wakeup.set()
+
+    def on_handler_done(self, event: RequestEvent):
+        CURRENT_STAGES.profile = None
+        profile: RequestProfile = event.data["profile"]
+        if profile.sampled and self.__server_timing and event.response:
+            event.response.headers["Server-Timing"] = ", ".join(
+                f"{name};dur={seconds * 1000:.3f}"
+                for name, seconds in self.__breakdown(event, profile)
+            )
+
+    def on_response_sent(self, event: RequestEvent):
+        profile: RequestProfile = event.data["profile"]
+        if profile.sampled and self.__thread:
+            with self.__lock:
+                self.__in_flight.pop(threading.get_ident(), None)
+
+        total = event.sent - event.received
+        if self.__slow_threshold is not None and total >= self.__slow_threshold:
+            self.__slow += 1
+            LOG.warning(
+                "Slow request %s -> %d took %.1f ms: %s",
+                profile.request_line,
+                event.response.status_code,
+                total * 1000,
+                ", ".join(
+                    f"{name} {seconds * 1000:.1f} ms"
+                    for name, seconds in self.__breakdown(event, profile)
+                ),
+            )
+
+        if profile.stacks:
+            # Kept with the receive and send times for the dump
+            profile.stages = self.__breakdown(event, profile)
+            with self.__lock:
+                self.__stacks.update(profile.stacks)
+                item = (total, next(self.__seq), profile)
+                if len(self.__slowest) < self.__dump_count:
+                    heapq.heappush(self.__slowest, item)
+                else:
+                    heapq.heappushpop(self.__slowest, item)
+
+    def on_close(self, event: ConnectionEvent):
+        # Requests whose handler raised end here
+        CURRENT_STAGES.profile = None
+        if self.__thread:
+            with self.__lock:
+                self.__in_flight.pop(threading.get_ident(), None)
+
+    @staticmethod
+    def __breakdown(event: RequestEvent, profile: RequestProfile) -> list:
+        stages = [("receive", event.parsed - event.received)]
+        stages += [(name, seconds) for name, seconds in profile.stages]
+        if event.handler_done is not None and event.sent is not None:
+            stages.append(("send", event.sent - event.handler_done))
+        return stages
+
+    @staticmethod
+    def __fold(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def __sample(self):
+        with self.__lock:
+            in_flight = list(self.__in_flight.items())
+        frames = sys._current_frames()
+        stacks = [
+            (ident, profile, self.__fold(frame))
+            for ident, profile in in_flight
+            if (frame := frames.get(ident)) is not None
+        ]
+        # Only added to requests still in flight, finished ones are being read
+        with self.__lock:
+            for ident, profile, stack in stacks:
+                if self.__in_flight.get(ident) is profile:
+                    profile.stacks[stack] += 1
+                    self.__samples += 1
+
+    def __run(self):
+        next_dump = time.monotonic() + self.__dump_interval
+        while not self.__closed:
+            if self.__in_flight:
+                self.__sample()
+                time.sleep(self.__sampling_interval)
+            else:
+                # Cleared before the check, so a request starting meanwhile wakes it
+                self.__wakeup.clear()
+                if not self.__in_flight:
+                    self.__wakeup.wait(max(next_dump - time.monotonic(), 0))
+
+            if time.monotonic() >= next_dump:
+                next_dump = time.monotonic() + self.__dump_interval
+                self.dump()
+
+    def dump(self) -> Optional[str]:
+        """Writes the stacks sampled since the last dump and returns the path of
+        the summary, None if there were none. The stacks of all sampled requests
+        are written to a .folded file next to it.
+        """
+        if self.__dump_dir is None:
+            return None
+        with self.__lock:
+            slowest, self.__slowest = self.__slowest, []
+            stacks, self.__stacks = self.__stacks, Counter()
+        if not stacks:
+            return None
+
+        path = os.path.join(
+            self.__dump_dir, time.strftime("profile-%Y%m%d-%H%M%S") + f"-{self.__dumps}"
+        )
+        try:
+            with open(path + ".folded", "w", encoding="utf-8") as file:
+                file.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+
+            with open(path + ".txt", "w", encoding="utf-8") as file:
+                slowest.sort(reverse=True)
+                file.write(f"# Slowest {len(slowest)} sampled requests\n")
+                for total, _, profile in slowest:
+                    stages = ", ".join(
+                        f"{name} {seconds * 1000:.1f} ms"
+                        for name, seconds in profile.stages
+                    )
+                    file.write(
+                        f"{total * 1000:.1f} ms {profile.request_line} ({stages})\n"
+                    )
+                for total, _, profile in slowest:
+                    file.write(f"\n# {profile.request_line} {total * 1000:.1f} ms\n")
+                    file.writelines(
+                        f"{stack} {count}\n"
+                        for stack, count in profile.stacks.most_common()
+                    )
+        except OSError as exc:
+            LOG.exception(f'Failed to write profile "{path}"', exc_info=exc)
+            return None
+
+        self.__dumps += 1
+        LOG.info(f'Wrote profile "{path}.txt"')
+        return path + ".txt"
+
+    def close(self):
+        """Stops sampling and writes a last dump. Unregister it from HOOKS first."""
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__wakeup.set()
+        if self.__thread:
+            self.__thread.join()
+            self.dump()
@@ -4,3 +4,4 @@ from .debug import *
 from .file import *
 from .reverse_proxy import *
 from .forward_proxy import *
+from .metrics import *
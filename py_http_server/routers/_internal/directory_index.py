@@ -0,0 +1,279 @@
+from ...common import to_http_date
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+import html
+import json
+import os
+import pkgutil
+import threading
+import urllib.parse
+
+template_data = pkgutil.get_data(__name__, "../../templates/index.html")
+if not template_data:
+    raise RuntimeError("Couldn't load template from package.")
+INDEX_TEMPLATE = template_data.decode("utf-8")
+
+# Split once so that rows can be streamed between the two halves
+INDEX_TEMPLATE_HEAD, _, INDEX_TEMPLATE_TAIL = INDEX_TEMPLATE.partition("{table_items}")
+
+SORT_KEYS: dict[str, Callable[["_IndexEntry"], object]] = {
+    "name": lambda e: e.name,
+    "type": lambda e: (e.type, e.name),
+    "modified": lambda e: e.mtime,
+    "size": lambda e: -1 if e.size is None else e.size,
+}
+ORDERS = {"asc": False, "desc": True}
+FORMATS = {"html", "json"}
+
+# Number of rows sent per chunk
+ROWS_PER_CHUNK = 512
+
+
+@dataclass(slots=True)
+class _IndexEntry:
+    name: str
+    type: str
+    mtime: float
+    last_modified: str
+    size: Optional[int]
+    link: str
+    row: str
+
+
+def _make_row(link="", name="", type="", last_modified="", size=""):
+    # Escapes text for embedding within HTML
+    name, type, last_modified, size = (
+        html.escape(name),
+        html.escape(type),
+        html.escape(last_modified),
+        html.escape(size),
+    )
+    return f'<tr><td><a href="{link}">{name}</a></td><td>{type}</td><td>{last_modified}</td><td>{size}</td></tr>'
+
+
+class DirectoryIndex:
+    def __init__(
+        self,
+        document_root: Path,
+        is_path_allowed: Callable[[Path], bool],
+        page_size: Optional[int] = None,
+        cache_size: int = 0,
+    ):
+        """Inits DirectoryIndex.
+
+        Args:
+        document_root -- Resolved document root.
+        is_path_allowed -- Returns False for paths that must not be linked.
+        page_size -- Default number of entries per page. If None, all entries are listed.
+        cache_size -- Number of scanned directories to cache, keyed by the directory's mtime.
+        """
+        self.__document_root = document_root
+        self.__is_path_allowed = is_path_allowed
+        self.__page_size = page_size
+        self.__cache_size = cache_size
+        self.__cache: OrderedDict[tuple[str, str, bool], tuple[int, list]] = (
+            OrderedDict()
+        )
+        self.__cache_lock = threading.Lock()
+
+    def __web_path(self, path: Path) -> str:
+        # Turns any path into an absolute web path (relative to document root)
+        relative = path.relative_to(self.__document_root).as_posix()
+        return "/" if relative == "." else f"/{relative}"
+
+    def __scan(self, path: Path, sort: str, reverse: bool) -> list[_IndexEntry]:
+        base_link = urllib.parse.quote(self.__web_path(path).rstrip("/")) + "/"
+        entries = []
+
+        # DirEntry caches its type and stat, this avoids several syscalls per entry
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                size = None
+                try:
+                    stat = dir_entry.stat()
+                    if dir_entry.is_dir():
+                        type = "Folder"
+                    elif dir_entry.is_file():
+                        type = "File"
+                        size = stat.st_size
+                    else:
+                        continue
+                except OSError:
+                    # Broken symlinks can't be followed
+                    if not dir_entry.is_symlink():
+                        continue
+                    stat = dir_entry.stat(follow_symlinks=False)
+                    type = "Symlink"
+
+                last_modified = to_http_date(
+                    datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+                )
+                link = base_link + urllib.parse.quote(dir_entry.name)
+                row = _make_row(
+                    link,
+                    dir_entry.name,
+                    type,
+                    last_modified,
+                    "" if size is None else f"{size} bytes",
+                )
+                entries.append(
+                    _IndexEntry(
+                        dir_entry.name,
+                        type,
+                        stat.st_mtime,
+                        last_modified,
+                        size,
+                        link,
+                        row,
+                    )
+                )
+
+        entries.sort(key=SORT_KEYS[sort], reverse=reverse)
+        return entries
+
+    def __get_entries(self, path: Path, sort: str, reverse: bool):
+        if self.__cache_size <= 0:
+            return self.__scan(path, sort, reverse)
+
+        # Directory mtime changes whenever an entry is added, removed or renamed
+        mtime_ns = path.stat().st_mtime_ns
+        key = (str(path), sort, reverse)
+        with self.__cache_lock:
+            cached = self.__cache.get(key)
+            if cached and cached[0] == mtime_ns:
+                self.__cache.move_to_end(key)
+                return cached[1]
+
+        entries = self.__scan(path, sort, reverse)
+        with self.__cache_lock:
+            self.__cache[key] = (mtime_ns, entries)
+            self.__cache.move_to_end(key)
+            while len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+        return entries
+
+    def __parse_query(self, query: str):
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(query.lstrip("?")).items()}
+
+        sort = params.get("sort", "name")
+        order = params.get("order", "asc")
+        format = params.get("format", "html")
+        if sort not in SORT_KEYS or order not in ORDERS or format not in FORMATS:
+            raise ValueError("Invalid index query")
+
+        page = int(params.get("page", 1))
+        per_page = int(params["per_page"]) if "per_page" in params else self.__page_size
+        if page < 1 or (per_page is not None and per_page < 1):
+            raise ValueError("Invalid index query")
+
+        return sort, order, format, page, per_page
+
+    def render(
+        self, path: Path, query: str, footer: str
+    ) -> tuple[str, Iterator[bytes]]:
+        """Returns the content type and the body chunks of the index of path.
+        Raises ValueError if the query is invalid.
+        """
+        sort, order, format, page, per_page = self.__parse_query(query)
+        entries = self.__get_entries(path, sort, ORDERS[order])
+
+        total = len(entries)
+        if per_page is not None:
+            entries = entries[(page - 1) * per_page : page * per_page]
+
+        title = self.__web_path(path)
+        if format == "json":
+            return "application/json", self.__render_json(
+                title, entries, page, per_page, total
+            )
+
+        # Link pages with the same sorting and page size
+        def page_link(text: str, target: int):
+            params = {"sort": sort, "order": order, "page": target}
+            if per_page is not None:
+                params["per_page"] = per_page
+            return (
+                f'<a href="?{html.escape(urllib.parse.urlencode(params))}">{text}</a>'
+            )
+
+        pagination = ""
+        if per_page is not None and total > per_page:
+            last_page = (total + per_page - 1) // per_page
+            pagination = " ".join(
+                x
+                for x in (
+                    page_link("Previous", page - 1) if page > 1 else "",
+                    f"Page {page} of {last_page}",
+                    page_link("Next", page + 1) if page < last_page else "",
+                )
+                if x
+            )
+
+        parent_row = ""
+        if path.parent != path and self.__is_path_allowed(path.parent):
+            # Display the parent path if possible
+            parent_row = _make_row(
+                urllib.parse.quote(self.__web_path(path.parent)), "..", "Symlink"
+            )
+
+        return "text/html", self.__render_html(
+            title, parent_row, entries, pagination, footer
+        )
+
+    def __render_html(
+        self,
+        title: str,
+        parent_row: str,
+        entries: list[_IndexEntry],
+        pagination: str,
+        footer: str,
+    ):
+        title = html.escape(title)
+        yield (INDEX_TEMPLATE_HEAD.replace("{title}", title) + parent_row).encode(
+            "utf-8"
+        )
+
+        for i in range(0, len(entries), ROWS_PER_CHUNK):
+            yield "".join(e.row for e in entries[i : i + ROWS_PER_CHUNK]).encode(
+                "utf-8"
+            )
+
+        yield (
+            INDEX_TEMPLATE_TAIL.replace("{pagination}", pagination)
+            .replace("{footer}", html.escape(footer))
+            .encode("utf-8")
+        )
+
+    def __render_json(
+        self,
+        title: str,
+        entries: list[_IndexEntry],
+        page: int,
+        per_page: Optional[int],
+        total: int,
+    ):
+        header = json.dumps(
+            {"path": title, "page": page, "per_page": per_page, "total": total}
+        )
+        yield (header[:-1] + ', "entries": [').encode("utf-8")
+
+        for i in range(0, len(entries), ROWS_PER_CHUNK):
+            chunk = ", ".join(
+                json.dumps(
+                    {
+                        "name": e.name,
+                        "type": e.type,
+                        "last_modified": e.last_modified,
+                        "size": e.size,
+                        "link": e.link,
+                    }
+                )
+                for e in entries[i : i + ROWS_PER_CHUNK]
+            )
+            yield ((", " if i else "") + chunk).encode("utf-8")
+
+        yield b"]}"
@@ -0,0 +1,153 @@
+from ... import log
+from pathlib import Path
+from typing import Optional
+import hashlib
+import json
+import os
+import queue
+import threading
+
+LOG = log.getLogger("routers.file.etag")
+
+try:
+    import xxhash  # type: ignore
+
+    _new_hash = xxhash.xxh3_128
+except:
+    _new_hash = lambda: hashlib.blake2b(digest_size=16)
+
+HASH_BLOCK_SIZE = 1048576
+
+# (device, inode, size, mtime_ns)
+_IndexKey = tuple[int, int, int, int]
+
+
+def _make_key(stat: os.stat_result) -> _IndexKey:
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ContentETagIndex:
+    """Strong ETags from content hashes, computed once per file version.
+
+    Files are hashed on a background thread; until a file's hash is known
+    get() returns None and callers should fall back to a weak ETag.
+    Hashes are keyed by (device, inode, size, mtime_ns) and optionally
+    persisted to an append-only JSON lines file so that restarts don't
+    rehash the tree.
+    """
+
+    def __init__(self, index_file: Optional[str] = None, max_entries: int = 1000000):
+        """Inits ContentETagIndex.
+
+        Args:
+        index_file -- Path of the on-disk index. If None, hashes are only kept in memory.
+        max_entries -- Maximum number of hashes kept, oldest are dropped first.
+        """
+        self.__index_file = Path(index_file) if index_file else None
+        self.__max_entries = max_entries
+        self.__hashes: dict[_IndexKey, str] = {}
+        self.__pending: set[_IndexKey] = set()
+        self.__pending_lock = threading.Lock()
+        self.__queue: queue.Queue[tuple[Path, _IndexKey]] = queue.Queue()
+        self.__thread: Optional[threading.Thread] = None
+
+        if self.__index_file:
+            self.__load()
+
+    def __load(self):
+        assert self.__index_file
+        lines = 0
+        try:
+            with self.__index_file.open("r", encoding="ascii") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        dev, ino, size, mtime_ns, digest = json.loads(line)
+                        self.__hashes[(dev, ino, size, mtime_ns)] = digest
+                    except (ValueError, TypeError):
+                        continue
+        except FileNotFoundError:
+            return
+        except OSError as exc:
+            LOG.warning(
+                f'Couldn\'t load ETag index "{self.__index_file}"', exc_info=exc
+            )
+            return
+
+        # Compact the file if it has grown past the entry limit or has duplicates
+        if lines > len(self.__hashes) or len(self.__hashes) > self.__max_entries:
+            self.__trim()
+            try:
+                self.__rewrite()
+            except OSError as exc:
+                LOG.warning(
+                    f'Couldn\'t compact ETag index "{self.__index_file}"', exc_info=exc
+                )
+        LOG.debug(f"Loaded {len(self.__hashes)} ETags from {self.__index_file}")
+
+    def __trim(self):
+        # Dicts keep insertion order, so the oldest entries come first
+        # Trim an extra tenth to avoid trimming on every insert
+        excess = len(self.__hashes) - self.__max_entries
+        if excess > 0:
+            for key in list(self.__hashes)[: excess + self.__max_entries // 10]:
+                del self.__hashes[key]
+
+    def __rewrite(self):
+        assert self.__index_file
+        tmp_file = self.__index_file.with_name(self.__index_file.name + ".tmp")
+        with tmp_file.open("w", encoding="ascii") as f:
+            for key, digest in list(self.__hashes.items()):
+                f.write(json.dumps([*key, digest]) + "\n")
+        os.replace(tmp_file, self.__index_file)
+
+    def __append(self, key: _IndexKey, digest: str):
+        assert self.__index_file
+        with self.__index_file.open("a", encoding="ascii") as f:
+            f.write(json.dumps([*key, digest]) + "\n")
+
+    def get(self, path: Path, stat: os.stat_result) -> Optional[str]:
+        """Returns the strong ETag of path or schedules it for hashing."""
+        key = _make_key(stat)
+        digest = self.__hashes.get(key)
+        if digest:
+            return f'"{digest}"'
+
+        with self.__pending_lock:
+            if key in self.__pending:
+                return None
+            self.__pending.add(key)
+            if not self.__thread:
+                self.__thread = threading.Thread(
+                    target=self.__run, name="ContentETagIndex", daemon=True
+                )
+                self.__thread.start()
+        self.__queue.put((path, key))
+        return None
+
+    def __hash_file(self, path: Path) -> str:
+        hash = _new_hash()
+        with path.open("rb") as f:
+            while block := f.read(HASH_BLOCK_SIZE):
+                hash.update(block)
+        return hash.hexdigest()
+
+    def __run(self):
+        while True:
+            path, key = self.__queue.get()
+            try:
+                digest = self.__hash_file(path)
+
+                # Discard the hash if the file changed while it was being read
+                if _make_key(path.stat()) != key:
+                    continue
+
+                self.__hashes[key] = digest
+                self.__trim()
+                if self.__index_file:
+                    self.__append(key, digest)
+            except Exception as exc:
+                LOG.warning(f'Couldn\'t hash "{path}"', exc_info=exc)
+            finally:
+                with self.__pending_lock:
+                    self.__pending.discard(key)
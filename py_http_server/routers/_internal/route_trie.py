@@ -0,0 +1,203 @@
+from collections.abc import Callable
+from typing import Any, Optional
+import re
+import uuid
+
+_INT_RE = re.compile(r"-?[0-9]+")
+_FLOAT_RE = re.compile(r"-?[0-9]+(\.[0-9]+)?")
+_NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def _to_str(value: str) -> str:
+    return value
+
+
+def _to_int(value: str) -> int:
+    if not _INT_RE.fullmatch(value):
+        raise ValueError(f'"{value}" is not an integer')
+    return int(value)
+
+
+def _to_float(value: str) -> float:
+    if not _FLOAT_RE.fullmatch(value):
+        raise ValueError(f'"{value}" is not a number')
+    return float(value)
+
+
+# Converters of path parameters, they raise ValueError if a segment doesn't match.
+# "path" matches the rest of the path including slashes and must come last.
+CONVERTERS: dict[str, Callable[[str], Any]] = {
+    "str": _to_str,
+    "int": _to_int,
+    "float": _to_float,
+    "uuid": uuid.UUID,
+    "path": _to_str,
+}
+
+# Parameters with stricter converters are tried first, independent of registration order
+_CONVERTER_PRIORITY = {"int": 0, "float": 1, "uuid": 2}
+
+
+class _Node:
+    def __init__(self):
+        self.static: dict[str, _Node] = {}
+        # Parameter children as (name, converter name, converter, child) in matching order
+        self.params: list[tuple[str, str, Callable[[str], Any], _Node]] = []
+        # Name and handlers of a "path" parameter
+        self.catch_all: Optional[tuple[str, dict[Optional[str], Any]]] = None
+        # Handlers by method, None matches any method
+        self.handlers: dict[Optional[str], Any] = {}
+
+
+class RouteTrie:
+    """Maps path patterns to handlers by method.
+
+    Patterns are split into segments that are either static or a whole
+    parameter such as "{id}", "{id:int}" or "{rest:path}". Matching walks
+    one trie node per path segment with a dict lookup for static segments,
+    so its cost depends on the length of the path and not on the number of
+    routes. Static segments are preferred over typed parameters, then "str"
+    parameters and "path" parameters last. Patterns without a handler for
+    the method are skipped, so a less specific pattern may handle it.
+    """
+
+    def __init__(self):
+        self.__root = _Node()
+
+    @staticmethod
+    def __parse_segment(segment: str) -> Optional[tuple[str, str]]:
+        # Returns the name and converter of a parameter segment, None for static segments
+        if not (segment.startswith("{") and segment.endswith("}")):
+            if "{" in segment or "}" in segment:
+                raise ValueError(f'Parameters must span whole segments: "{segment}"')
+            return None
+
+        name, _, converter = segment[1:-1].partition(":")
+        converter = converter or "str"
+        if not _NAME_RE.fullmatch(name):
+            raise ValueError(f'Invalid parameter name "{name}"')
+        if converter not in CONVERTERS:
+            raise ValueError(f'Unknown converter "{converter}"')
+        return name, converter
+
+    def add(self, pattern: str, methods: Optional[list[str]], handler: Any):
+        """Adds handler for pattern, for all methods if methods is None.
+        Raises ValueError if the pattern is invalid or a method is already handled.
+        """
+        if not pattern.startswith("/"):
+            raise ValueError(f'Pattern "{pattern}" must start with "/"')
+
+        node = self.__root
+        names = set()
+        segments = pattern[1:].split("/")
+        handlers = None
+        for i, segment in enumerate(segments):
+            param = self.__parse_segment(segment)
+            if param is None:
+                node = node.static.setdefault(segment, _Node())
+                continue
+
+            name, converter = param
+            if name in names:
+                raise ValueError(f'Duplicate parameter "{name}" in "{pattern}"')
+            names.add(name)
+
+            if converter == "path":
+                if i != len(segments) - 1:
+                    raise ValueError(f'"path" parameter must be last in "{pattern}"')
+                if node.catch_all and node.catch_all[0] != name:
+                    raise ValueError(f'Conflicting "path" parameter in "{pattern}"')
+                if not node.catch_all:
+                    node.catch_all = (name, {})
+                handlers = node.catch_all[1]
+                break
+
+            for param_name, param_converter, _, child in node.params:
+                if (param_name, param_converter) == (name, converter):
+                    node = child
+                    break
+            else:
+                child = _Node()
+                node.params.append((name, converter, CONVERTERS[converter], child))
+                node.params.sort(key=lambda x: _CONVERTER_PRIORITY.get(x[1], 3))
+                node = child
+
+        if handlers is None:
+            handlers = node.handlers
+        for method in methods or [None]:
+            method = method.upper() if method else None
+            if method in handlers:
+                raise ValueError(
+                    f'Duplicate route "{pattern}" for {method or "any method"}'
+                )
+            handlers[method] = handler
+
+    def match(
+        self, path: str, method: str
+    ) -> Optional[tuple[Any, dict[str, Any], set[str]]]:
+        """Returns the handler of method for path with the converted parameters, None if no pattern matches path.
+
+        If patterns match path but none handles method, the handler is None
+        and the returned set holds the methods they handle, e.g. for a 405
+        response. HEAD requests are handled by GET handlers.
+        """
+        if not path.startswith("/"):
+            return None
+        params: dict[str, Any] = {}
+        allowed: set[str] = set()
+        handler = self.__match(
+            self.__root, path[1:].split("/"), 0, params, method.upper(), allowed
+        )
+        if handler is not None:
+            return handler, params, set()
+        return (None, {}, allowed) if allowed else None
+
+    @staticmethod
+    def __select(
+        handlers: dict[Optional[str], Any], method: str, allowed: set[str]
+    ) -> Optional[Any]:
+        handler = handlers.get(method) or handlers.get(None)
+        if handler is None and method == "HEAD":
+            handler = handlers.get("GET")
+        if handler is None:
+            allowed.update(x for x in handlers if x is not None)
+        return handler
+
+    def __match(
+        self,
+        node: _Node,
+        segments: list[str],
+        i: int,
+        params: dict[str, Any],
+        method: str,
+        allowed: set[str],
+    ) -> Optional[Any]:
+        if i == len(segments):
+            return self.__select(node.handlers, method, allowed)
+
+        segment = segments[i]
+        child = node.static.get(segment)
+        if child and (
+            handler := self.__match(child, segments, i + 1, params, method, allowed)
+        ):
+            return handler
+
+        # Parameters never match empty segments
+        if not segment:
+            return None
+
+        for name, _, converter, child in node.params:
+            try:
+                params[name] = converter(segment)
+            except ValueError:
+                continue
+            if handler := self.__match(child, segments, i + 1, params, method, allowed):
+                return handler
+            del params[name]
+
+        if node.catch_all:
+            name, handlers = node.catch_all
+            if handler := self.__select(handlers, method, allowed):
+                params[name] = "/".join(segments[i:])
+                return handler
+        return None
@@ -1,16 +1,32 @@
 from ..networking import ConnectionInfo
 from ..common import RequestHandlerABC, NO_CACHE_HEADERS
+from ..metrics import instrumented
+from ..memory import MemoryLimitError
 from ..http.request import HTTPRequest
 from ..http.response import HTTPResponse, HTTPResponseFactory
+from ._internal.route_trie import RouteTrie
 from .. import log
-from typing import Callable
+from typing import Callable, Optional
 
 LOG = log.getLogger("routers.code")
 
 
-def route(path):
+def route(path: str, methods: Optional[list[str]] = None):
+    """Marks a method of a CodeRouter as the handler of path, can be stacked.
+
+    Path parameters such as "/users/{id:int}" are passed to the handler as
+    keyword arguments. Supported converters are "str" (default), "int",
+    "float", "uuid" and "path", which matches the rest of the path.
+
+    Args:
+    path -- Path pattern of the route.
+    methods -- Methods handled by the handler, all methods if None.
+    """
+
     def _route_decorator(function):
-        function._route = {"path": path}
+        if not hasattr(function, "_routes"):
+            function._routes = []
+        function._routes.append({"path": path, "methods": methods})
         return function
 
     return _route_decorator
@@ -21,28 +37,37 @@ class CodeRouter(RequestHandlerABC):
         self.http = HTTPResponseFactory(NO_CACHE_HEADERS)
 
         # Discover @route methods
-        self.__handlers: dict[
-            str, Callable[[ConnectionInfo, HTTPRequest], HTTPResponse]
-        ] = {}
+        self.__routes = RouteTrie()
         for member in dir(self):
-            value: Callable[[ConnectionInfo, HTTPRequest], HTTPResponse] = getattr(
-                self, member
-            )
-            if callable(value) and hasattr(value, "_route"):
-                path = getattr(value, "_route")["path"]
-                LOG.debug(f'Discovered handler "{value.__qualname__}" for "{path}"')
-                self.__handlers[path] = value
+            value: Callable[..., HTTPResponse] = getattr(self, member)
+            if callable(value) and hasattr(value, "_routes"):
+                for params in getattr(value, "_routes"):
+                    LOG.debug(
+                        f'Discovered handler "{value.__qualname__}" for "{params["path"]}"'
+                    )
+                    self.__routes.add(params["path"], params["methods"], value)
 
+    @instrumented
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
-        if not request.path in self.__handlers:
+        match = self.__routes.match(request.path, request.method)
+        if not match:
             return self.default_route(conn_info, request)
 
-        handler = self.__handlers[request.path]
+        handler, params, allowed = match
+        if not handler:
+            # 405 Method Not Allowed, HEAD requests are handled by GET handlers
+            if "GET" in allowed:
+                allowed.add("HEAD")
+            return self.http.status(405, {"Allow": ", ".join(sorted(allowed))})
+
         try:
             LOG.debug(
-                f'Calling handler "{handler.__qualname__}" for path "{request.path}"'
+                'Calling handler "%s" for path "%s"', handler.__qualname__, request.path
             )
-            return handler(conn_info, request)
+            return handler(conn_info, request, **params)
+        except MemoryLimitError:
+            # Answered with 413 or 503 by the connection
+            raise
         except Exception as exc:
             LOG.exception(
                 f'Exception in handler for path "{request.path}"', exc_info=exc
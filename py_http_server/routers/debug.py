@@ -1,9 +1,25 @@
 from ..networking import ConnectionInfo
 from ..http.request import HTTPRequest
+from ..memory import MEMORY
 from ..routers.code import CodeRouter, route
+import tracemalloc
+import urllib.parse
 
 
 class DebugRouter(CodeRouter):
+    def __init__(self, tracemalloc_frames: int = 0):
+        """Inits DebugRouter.
+
+        Args:
+        tracemalloc_frames -- If above 0, starts tracemalloc with this many frames per allocation and enables /tracemalloc.
+                              Tracing slows down all allocations, don't keep it enabled in production.
+        """
+        self.__tracemalloc_frames = tracemalloc_frames
+        self.__snapshot = None
+        if tracemalloc_frames > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(tracemalloc_frames)
+        super().__init__()
+
     @route("/json")
     def json_page(self, conn_info: ConnectionInfo, request: HTTPRequest):
         return self.http.json(
@@ -39,6 +55,51 @@ class DebugRouter(CodeRouter):
 """
         )
 
+    @route("/memory")
+    def memory_page(self, conn_info: ConnectionInfo, request: HTTPRequest):
+        return self.http.json(
+            {
+                "limit": MEMORY.limit,
+                "connection_limit": MEMORY.connection_limit,
+                **MEMORY.stats,
+                "connections": [
+                    {"name": x.name, "held": x.held, **x.held_by_kind}
+                    for x in MEMORY.top_accounts()
+                ],
+            }
+        )
+
+    @route("/tracemalloc")
+    def tracemalloc_page(self, conn_info: ConnectionInfo, request: HTTPRequest):
+        # "?diff" compares with the previous snapshot, "?group=traceback" groups by stack
+        if self.__tracemalloc_frames <= 0 or not tracemalloc.is_tracing():
+            return self.http.status(404)
+        params = urllib.parse.parse_qs(request.query.lstrip("?"), keep_blank_values=True)
+        group = params.get("group", ["lineno"])[-1]
+        if group not in ("filename", "lineno", "traceback"):
+            return self.http.status(400)
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        if "diff" in params and self.__snapshot:
+            stats = snapshot.compare_to(self.__snapshot, group)
+        else:
+            stats = snapshot.statistics(group)
+        self.__snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        return self.http.json(
+            {
+                "traced": current,
+                "peak": peak,
+                "top": [
+                    x.traceback.format() if group == "traceback" else str(x)
+                    for x in stats[:50]
+                ],
+            }
+        )
+
     @route("/error")
     def error_page(self, conn_info: ConnectionInfo, request: HTTPRequest):
         raise RuntimeError("DebugRouter test exception")
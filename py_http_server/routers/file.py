@@ -5,25 +5,28 @@ from ..middlewares._internal.file import (
     _HEADToGETMiddleware,
     _PreconditionEvalMiddleware,
 )
+from ._internal.directory_index import DirectoryIndex
+from ..middlewares._internal.cache_policy import CachePolicyMatcher
+from ._internal.etag_index import ContentETagIndex
 from ..common import (
     RequestHandlerABC,
     HeaderContainer,
     NO_CACHE_HEADERS,
+    PRECOMPRESSED_SUFFIXES,
+    accepted_encodings,
     file_etag,
     to_http_date,
 )
+from ..metrics import instrumented
 from .. import log
 from pathlib import Path
 from datetime import datetime, timezone
-import html
+from stat import S_ISDIR, S_ISREG
+from typing import Optional, Union
 import mimetypes
-import urllib.parse
-import pkgutil
+import os
+import re
 
-template_data = pkgutil.get_data(__name__, "../templates/index.html")
-if not template_data:
-    raise RuntimeError("Couldn't load template from package.")
-INDEX_TEMPLATE = template_data.decode("utf-8")
 LOG = log.getLogger("routers.file")
 
 
@@ -35,6 +38,13 @@ class FileRouter(RequestHandlerABC):
         enable_etag: bool = True,
         enable_last_modified: bool = True,
         disable_symlinks: bool = True,
+        serve_precompressed: bool = False,
+        index_page_size: Optional[int] = None,
+        index_cache_size: int = 0,
+        cache_policies: dict[Union[str, re.Pattern], str] = {},
+        default_cache_control: Optional[str] = None,
+        strong_etag: bool = False,
+        etag_index_file: Optional[str] = None,
     ):
         """Inits FileRouter.
 
@@ -44,6 +54,21 @@ class FileRouter(RequestHandlerABC):
         enable_etag -- If True, ETag will be calculated and sent with every response.
         enable_last_modified -- If True, Last-Modified header will be sent with every response.
         disable_symlinks -- If True, symlinks won't be followed.
+        serve_precompressed -- If True, fresh ".br", ".zst" and ".gz" variants next to files will be
+            served to clients accepting them. See py_http_server.precompress.
+        index_page_size -- Default number of entries per index page. If None, all entries are listed.
+        index_cache_size -- Number of directory listings to cache, invalidated by the directory's mtime.
+        cache_policies -- Maps extensions (".css"), globs ("/assets/*") or compiled regexes to
+            Cache-Control values of files. Globs and regexes are matched against the web path
+            and take precedence over extensions, e.g.
+            {"/assets/*": "public, max-age=31536000, immutable", ".html": "max-age=60"}
+        default_cache_control -- Cache-Control value of files that match no policy.
+        strong_etag -- If True, ETags are content hashes computed on a background thread.
+            Weak ETags are sent until a file has been hashed.
+        etag_index_file -- File to persist content hashes to, keyed by (device, inode, size, mtime).
+
+        Index pages accept "sort" (name, type, modified, size), "order" (asc, desc),
+        "page", "per_page" and "format" (html, json) query parameters.
 
         WARNING: Enabling symlinks may lead to unexpected results with authentication middlewares.
         E.g. "/protected_folder" vs "/folder/../protected_folder"
@@ -54,11 +79,23 @@ class FileRouter(RequestHandlerABC):
         self.__enable_etag = enable_etag
         self.__enable_last_modified = enable_last_modified
         self.__disable_symlinks = disable_symlinks
+        self.__serve_precompressed = serve_precompressed
+        self.__index = DirectoryIndex(
+            self.__document_root,
+            self.__is_path_allowed,
+            index_page_size,
+            index_cache_size,
+        )
+        self.__cache_policy = CachePolicyMatcher(cache_policies, default_cache_control)
+        self.__etag_index = (
+            ContentETagIndex(etag_index_file) if enable_etag and strong_etag else None
+        )
 
         self.__chain = _PreconditionEvalMiddleware(
             _HEADToGETMiddleware(
                 lambda conn_info, request: self.__actual_call(conn_info, request)
-            )
+            ),
+            lambda conn_info, request: self.__get_validators(request),
         )
 
     def __is_path_allowed(self, path: Path):
@@ -79,87 +116,131 @@ class FileRouter(RequestHandlerABC):
         return f"{mime_type}; charset={encoding}"
 
     # Gets the file last_modified time with second resolution for comparison with HTTP dates
-    def __get_last_modified(self, path: Path) -> datetime:
-        value = datetime.fromtimestamp(path.stat().st_mtime, tz=timezone.utc)
+    def __get_last_modified(self, stat: os.stat_result) -> datetime:
+        value = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
         return value.replace(microsecond=0)
 
-    def __serve_file(self, path: Path):
-        """RFC9110: The server generating a 304 response MUST generate
+    def __get_etag(self, path: Path, stat: os.stat_result) -> str:
+        if self.__etag_index and (etag := self.__etag_index.get(path, stat)):
+            return etag
+        return file_etag(path, stat)
+
+    def __find_precompressed(
+        self, request: HTTPRequest, path: Path, stat: os.stat_result
+    ):
+        encodings = accepted_encodings(request.headers.get("Accept-Encoding", ""))
+        if not encodings:
+            return None
+
+        for encoding, suffix in PRECOMPRESSED_SUFFIXES.items():
+            if encoding not in encodings:
+                continue
+
+            # Variants are only fresh if they carry the mtime of their source
+            variant = path.with_name(path.name + suffix)
+            try:
+                variant_stat = variant.stat()
+                if (
+                    variant_stat.st_mtime_ns == stat.st_mtime_ns
+                    and S_ISREG(variant_stat.st_mode)
+                    and self.__is_path_allowed(variant)
+                ):
+                    return encoding, variant, variant_stat
+            except OSError:
+                pass
+        return None
+
+    def __find_file(self, path: Path) -> Optional[tuple[Path, os.stat_result]]:
+        # Returns the file to serve for path, directories are served by their index.html
+        try:
+            stat = path.stat()
+            if S_ISDIR(stat.st_mode):
+                path = path.joinpath("index.html")
+                stat = path.stat()
+        except OSError:
+            return None
+
+        if not S_ISREG(stat.st_mode):
+            return None
+        return path, stat
+
+    def __get_file_headers(
+        self, request: HTTPRequest, path: Path, stat: os.stat_result
+    ) -> tuple[HeaderContainer, Path, os.stat_result]:
+        """Returns the headers of the selected representation and its file.
+        Only uses stat calls so that conditional requests can be evaluated cheaply.
+
+        RFC9110: The server generating a 304 response MUST generate
         any of the following header fields that would have been sent
         in a 200 (OK) response to the same request:
             Content-Location, Date, ETag, and Vary
             Cache-Control and Expires (see [CACHING])
         """
-        LOG.debug(f'Reading file "{path}"')
-
         headers = HeaderContainer()
+        headers["Content-Type"] = self.__get_content_type(path)
+
+        web_path = "/" + path.relative_to(self.__document_root).as_posix()
+        if cache_control := self.__cache_policy(web_path):
+            headers["Cache-Control"] = cache_control
+
+        body_path, body_stat = path, stat
+        if self.__serve_precompressed:
+            # Representation depends on Accept-Encoding even if no variant exists
+            headers["Vary"] = "Accept-Encoding"
+            if variant := self.__find_precompressed(request, path, stat):
+                headers["Content-Encoding"], body_path, body_stat = variant
+
+        # Validators describe the selected representation
         if self.__enable_etag:
-            headers["ETag"] = file_etag(path)
+            headers["ETag"] = self.__get_etag(body_path, body_stat)
 
         if self.__enable_last_modified:
-            headers["Last-Modified"] = to_http_date(self.__get_last_modified(path))
+            headers["Last-Modified"] = to_http_date(self.__get_last_modified(stat))
 
-        headers["Content-Type"] = self.__get_content_type(path)
-        return HTTPResponse(200, headers, ResponseBody.from_file(path))
+        return headers, body_path, body_stat
 
-    def __serve_index(self, conn_info: ConnectionInfo, path: Path):
-        # Turns any path into an absolute web path (relative to document root)
-        make_link = lambda p: urllib.parse.quote(
-            "/" + p.relative_to(self.__document_root).as_posix()
-        )
-        # Escapes text for embedding within HTML
-        make_text = lambda x: html.escape(str(x))
+    def __get_validators(self, request: HTTPRequest) -> Optional[HeaderContainer]:
+        # Only GET and HEAD requests for existing files are evaluated early
+        if request.method not in {"GET", "HEAD"}:
+            return None
 
-        # Pretty path relative to document root
-        title = path.relative_to(self.__document_root).as_posix()
-        title = f"/{title}" if title != "." else "/"
+        path = self.__document_root.joinpath(request.path.lstrip("/"))
+        if not self.__is_path_allowed(path):
+            return None
 
-        table_items = []
+        if not (found := self.__find_file(path)):
+            return None
 
-        def add_table_item(link="", name="", type="", last_modified="", size=""):
-            name, type, last_modified, size = (
-                make_text(name),
-                make_text(type),
-                make_text(last_modified),
-                make_text(size),
-            )
-            table_items.append(
-                f'<tr><td><a href="{link}">{name}</a></td><td>{type}</td><td>{last_modified}</td><td>{size}</td></tr>'
-            )
+        headers, _, _ = self.__get_file_headers(request, *found)
+        return headers
 
-        if path.parent != path and self.__is_path_allowed(path.parent):
-            # Display the parent path if possible
-            add_table_item(make_link(path.parent), "..", "Symlink")
-
-        for sub_path in path.iterdir():
-            stat = sub_path.stat()
-            size = ""
-            if sub_path.is_dir():
-                type = "Folder"
-            elif sub_path.is_file():
-                type = "File"
-                size = f"{stat.st_size} bytes"
-            elif sub_path.is_symlink():
-                type = "Symlink"
-            else:
-                continue
+    def __serve_file(self, request: HTTPRequest, path: Path, stat: os.stat_result):
+        LOG.debug('Reading file "%s"', path)
+        headers, body_path, body_stat = self.__get_file_headers(request, path, stat)
+        return HTTPResponse(
+            200, headers, ResponseBody.from_file(body_path, body_stat.st_size)
+        )
 
-            last_mod = to_http_date(
-                datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
-            )
-            add_table_item(make_link(sub_path), sub_path.name, type, last_mod, size)
-
-        return self.http.html(
-            INDEX_TEMPLATE.replace("{table_items}", "".join(table_items))
-            .replace("{title}", make_text(title))
-            .replace(
-                "{footer}",
-                make_text(
-                    f"Generated on {to_http_date(datetime.now(timezone.utc))} for {conn_info.remote_address}"
-                ),
+    def __serve_index(
+        self, conn_info: ConnectionInfo, request: HTTPRequest, path: Path
+    ):
+        try:
+            content_type, chunks = self.__index.render(
+                path,
+                request.query,
+                f"Generated on {to_http_date(datetime.now(timezone.utc))} for {conn_info.remote_address}",
             )
+        except ValueError:
+            return self.http.status(400)
+
+        return HTTPResponse(
+            200,
+            self.http.default_headers
+            | {"Content-Type": f"{content_type}; charset=utf-8"},
+            ResponseBody.from_iterable(chunks),
         )
 
+    @instrumented
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest):
         return self.__chain(conn_info, request)
 
@@ -178,15 +259,11 @@ class FileRouter(RequestHandlerABC):
             return self.http.status(400)
 
         try:
-            if path.is_file():
-                return self.__serve_file(path)
-            elif path.is_dir():
-                index_html = path.joinpath("index.html")
-                if index_html.is_file():
-                    return self.__serve_file(index_html)
-                elif self.__generate_index:
-                    # Generate index if allowe and there is no index.html
-                    return self.__serve_index(conn_info, path)
+            if found := self.__find_file(path):
+                return self.__serve_file(request, *found)
+            elif self.__generate_index and path.is_dir():
+                # Generate index if allowed and there is no index.html
+                return self.__serve_index(conn_info, request, path)
         except Exception as exc:
             LOG.exception("Error while accesing path", exc_info=exc)
             return self.http.status(500)
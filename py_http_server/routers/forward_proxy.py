@@ -1,12 +1,17 @@
-import socket
+from collections import OrderedDict
 from urllib.parse import urlparse
 from ..common import RequestHandlerABC, NO_CACHE_HEADERS
+from ..metrics import instrumented
 from ..networking import ConnectionInfo
 from ..networking.connection_socket import ConnectionSocket
+from ..networking.tunnel_relay import TunnelRelay
 from ..http.request import HTTPRequest
 from ..http.response import HTTPResponse, HTTPResponseFactory
 from ..http.response_body import CONNECTTunnelBody
+from ..upstream import RetryBudget, DNSCache, create_connection
 from . import ReverseProxyRouter
+from typing import Optional
+import threading
 
 
 class ForwardProxyRouter(RequestHandlerABC):
@@ -15,24 +20,82 @@ class ForwardProxyRouter(RequestHandlerABC):
         stream_threshold: int = 1048576,
         set_proxy_headers: bool = True,
         allowed_hosts: list[str] | None = None,
+        connect_timeout: Optional[float] = 10.0,
+        read_timeout: Optional[float] = 60.0,
+        total_timeout: Optional[float] = None,
+        max_retries: int = 2,
+        retry_budget: Optional[RetryBudget] = None,
+        max_failures: int = 3,
+        ejection_time: float = 30.0,
+        tunnel_idle_timeout: Optional[float] = 300.0,
+        tunnel_relay: Optional[TunnelRelay] = None,
+        dns_cache: Optional[DNSCache] = None,
+        client: str = "urllib3",
+        max_proxy_routers: int = 256,
     ):
         """Inits ForwardProxyRouter.
 
         WARNING: This class is not secure by default.
-        It allows any destionation by default and will not garbage collect connections.
+        It allows any destionation by default.
 
         Args:
         stream_threshold -- Responses past this threshold will be streamed via chunked encoding.
         set_proxy_headers -- If True, adds X-Forwarded-{For, Proto, Host} and Forwarded headers.
         allowed_hosts -- A list of allowed destionation hosts without port numbers. If None, all hosts are allowed.
+        connect_timeout -- Seconds to wait for a connection to the destination, also used for CONNECT.
+        read_timeout -- Seconds to wait for each read from the destination, None to wait forever.
+        total_timeout -- Seconds each attempt may take to connect and receive the response header, None for no limit.
+        max_retries -- Retries of idempotent requests after connection errors and timeouts.
+        retry_budget -- Limits retries to a share of requests, shared by all destinations. If None, a RetryBudget with default values is used.
+        max_failures -- Consecutive 5xx responses or connection errors that open a destination's circuit breaker.
+        ejection_time -- Seconds an open circuit stays open before a trial request is let through.
+        tunnel_idle_timeout -- Seconds a CONNECT tunnel may go without traffic before it's closed, None to keep it open.
+        tunnel_relay -- Relays the bytes of CONNECT tunnels, may be shared by routers. If None, a TunnelRelay with tunnel_idle_timeout is used.
+        dns_cache -- Resolves destination hosts of CONNECT requests and of the native client. If None, a DNSCache with default values is used.
+        client -- Client of HTTP requests, "urllib3" or "native". See ReverseProxyRouter.
+        max_proxy_routers -- Maximum number of destinations whose HTTP connection pools are kept, least recently used first out.
         """
 
         self.http = HTTPResponseFactory(NO_CACHE_HEADERS)
         self.__stream_threshold = stream_threshold
         self.__set_proxy_headers = set_proxy_headers
         self.__allowed_hosts = allowed_hosts
-        self.__proxy_routers = {}
-
+        self.__connect_timeout = connect_timeout
+        self.__read_timeout = read_timeout
+        self.__total_timeout = total_timeout
+        self.__max_retries = max_retries
+        self.__retry_budget = retry_budget or RetryBudget()
+        self.__max_failures = max_failures
+        self.__ejection_time = ejection_time
+        self.__tunnel_relay = tunnel_relay or TunnelRelay(tunnel_idle_timeout)
+        self.__dns_cache = dns_cache or DNSCache()
+        self.__client = client
+        self.__max_proxy_routers = max_proxy_routers
+        self.__proxy_routers: OrderedDict[str, ReverseProxyRouter] = OrderedDict()
+        self.__proxy_routers_lock = threading.Lock()
+
+    @property
+    def upstream_states(self) -> dict[str, dict]:
+        """Health, outstanding requests and circuit breaker state of each destination."""
+        return {
+            url: state
+            for router in list(self.__proxy_routers.values())
+            for url, state in router.upstream_states.items()
+        }
+
+    @property
+    def retry_budget(self) -> RetryBudget:
+        return self.__retry_budget
+
+    @property
+    def tunnel_relay(self) -> TunnelRelay:
+        return self.__tunnel_relay
+
+    @property
+    def dns_cache(self) -> DNSCache:
+        return self.__dns_cache
+
+    @instrumented
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest) -> HTTPResponse:
         if request.method == "CONNECT":
             return self.__connect_proxy(conn_info, request)
@@ -41,8 +104,9 @@ class ForwardProxyRouter(RequestHandlerABC):
     def __connect_proxy(
         self, conn_info: ConnectionInfo, request: HTTPRequest
     ) -> HTTPResponse:
-        # CONNECT requests must specify a host:port
-        host, _, port = request.path.partition(":")
+        # CONNECT requests must specify a host:port, IPv6 addresses are in brackets
+        host, _, port = request.path.rpartition(":")
+        host = host.removeprefix("[").removesuffix("]")
 
         if not host or not port or not port.isdigit():
             # 400 Bad Request
@@ -52,11 +116,52 @@ class ForwardProxyRouter(RequestHandlerABC):
             # 403 Forbidden
             return self.http.status(403)
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((host, int(port)))
+        try:
+            sock = create_connection(
+                host, int(port), self.__connect_timeout, self.__dns_cache
+            )
+        except TimeoutError:
+            # 504 Gateway Timeout
+            return self.http.status(504)
+        except OSError:
+            # 502 Bad Gateway
+            return self.http.status(502)
+        except ValueError:
+            # 400 Bad Request, e.g. UnicodeError for host labels over 63 characters
+            return self.http.status(400)
+
+        conn = ConnectionSocket(sock, enable_nopush=False, enable_nodelay=True)
+        return HTTPResponse(200, body=CONNECTTunnelBody(conn, self.__tunnel_relay))
 
-        conn = ConnectionSocket(sock)
-        return HTTPResponse(200, body=CONNECTTunnelBody(conn, self.__stream_threshold))
+    def __get_proxy_router(self, scheme: str, netloc: str) -> ReverseProxyRouter:
+        with self.__proxy_routers_lock:
+            if netloc in self.__proxy_routers:
+                self.__proxy_routers.move_to_end(netloc)
+                return self.__proxy_routers[netloc]
+
+            router = self.__proxy_routers[netloc] = ReverseProxyRouter(
+                f"{scheme}://{netloc}",
+                stream_threshold=self.__stream_threshold,
+                set_proxy_headers=self.__set_proxy_headers,
+                max_failures=self.__max_failures,
+                ejection_time=self.__ejection_time,
+                client=self.__client,
+                connect_timeout=self.__connect_timeout,
+                read_timeout=self.__read_timeout,
+                total_timeout=self.__total_timeout,
+                max_retries=self.__max_retries,
+                retry_budget=self.__retry_budget,
+                dns_cache=self.__dns_cache,
+            )
+
+            # Requests in progress on evicted routers finish, their connections aren't reused
+            evicted = []
+            while len(self.__proxy_routers) > self.__max_proxy_routers:
+                evicted.append(self.__proxy_routers.popitem(last=False)[1])
+
+        for x in evicted:
+            x.close()
+        return router
 
     def __http_proxy(
         self, conn_info: ConnectionInfo, request: HTTPRequest
@@ -72,14 +177,7 @@ class ForwardProxyRouter(RequestHandlerABC):
             # 403 Forbidden
             return self.http.status(403)
 
-        if url.netloc in self.__proxy_routers:
-            next = self.__proxy_routers[url.netloc]
-        else:
-            next = self.__proxy_routers[url.netloc] = ReverseProxyRouter(
-                f"{url.scheme}://{url.netloc}",
-                stream_threshold=self.__stream_threshold,
-                set_proxy_headers=self.__set_proxy_headers,
-            )
+        next = self.__get_proxy_router(url.scheme, url.netloc)
 
         # Convert the request path to relative
         request.path = url.path
@@ -0,0 +1,29 @@
+from ..networking import ConnectionInfo
+from ..http.request import HTTPRequest
+from ..http.response import HTTPResponse
+from ..http.response_body import ResponseBody
+from ..metrics import CONTENT_TYPE, REGISTRY, MetricsRegistry
+from ..routers.code import CodeRouter, route
+
+
+class MetricsRouter(CodeRouter):
+    """Serves the metrics of a registry at /metrics in the Prometheus text format.
+    Mount it on an internal host with VirtualHostMiddleware to keep it private.
+    """
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY):
+        """Inits MetricsRouter.
+
+        Args:
+        registry -- Registry to render, the registry of the built-in components by default.
+        """
+        self.__registry = registry
+        super().__init__()
+
+    @route("/metrics", ["GET"])
+    def metrics_page(self, conn_info: ConnectionInfo, request: HTTPRequest):
+        return HTTPResponse(
+            200,
+            self.http.default_headers | {"Content-Type": CONTENT_TYPE},
+            ResponseBody.from_bytes(self.__registry.render().encode("utf-8")),
+        )
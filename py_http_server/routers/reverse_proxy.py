@@ -1,41 +1,152 @@
 from ..common import HeaderContainer, RequestHandlerABC, NO_CACHE_HEADERS
+from ..metrics import instrumented
 from ..networking import ConnectionInfo
 from ..http.request import HTTPRequest
 from ..http.response import HTTPResponse, HTTPResponseFactory
-from ..http.response_body import ResponseBody
+from ..http.response_body import ResponseBody, EmptyBody
+from ..http.parser import get_content_length
 from ..middlewares._internal.proxy import (
     _ProxyPostprocessMiddleware,
     _ProxyPreprocessMiddleware,
 )
-from urllib3 import PoolManager, BaseHTTPResponse
-from urllib3.exceptions import HTTPError
+from ..upstream import (
+    Upstream,
+    UpstreamGroup,
+    UpstreamResponse,
+    MalformedResponseError,
+    RetryBudget,
+    DNSCache,
+)
+from .. import log
+from typing import Callable, Optional, Union
+from urllib3 import BaseHTTPResponse, Timeout
+from urllib3.exceptions import (
+    HTTPError,
+    NewConnectionError,
+    TimeoutError as URLLib3TimeoutError,
+)
+import urllib.parse
+import weakref
+
+LOG = log.getLogger("routers.reverse_proxy")
+
+CLIENTS = {"urllib3", "native"}
+
+# Errors of both clients that mean the upstream couldn't be reached or misbehaved
+UPSTREAM_ERRORS = (HTTPError, OSError, MalformedResponseError)
+TIMEOUT_ERRORS = (TimeoutError, URLLib3TimeoutError)
+
+# RFC9110: Methods that can be retried without changing the outcome
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE"}
+
+
+class _UpstreamStream:
+    """Body of a streamed upstream response, releases the upstream once it's closed.
+    Bodies that are never sent release it when they are collected.
+    """
+
+    def __init__(
+        self,
+        response: Union[BaseHTTPResponse, UpstreamResponse],
+        release: Callable[[], None],
+    ):
+        self.__response = response
+        self.__release = weakref.finalize(self, release)
+
+    def read(self, size: int = -1) -> bytes:
+        return self.__response.read(size)
+
+    def readinto(self, buffer) -> int:
+        return self.__response.readinto(buffer)
+
+    def close(self):
+        try:
+            self.__response.close()
+        finally:
+            self.__release()
 
 
 class ReverseProxyRouter(RequestHandlerABC):
     def __init__(
         self,
-        proxy_host: str,
+        proxy_host: Union[str, list[Union[str, Upstream]]],
         stream_threshold: int = 1048576,
+        stream_buffer_size: int = 65536,
         set_proxy_headers: bool = True,
         preserve_host: bool = False,
         decode_content: bool = False,
+        strategy: str = "round_robin",
+        hash_key: str = "path",
+        health_check_path: Optional[str] = None,
+        health_check_interval: float = 10.0,
+        max_failures: int = 3,
+        ejection_time: float = 30.0,
+        client: str = "urllib3",
+        connect_timeout: Optional[float] = 10.0,
+        read_timeout: Optional[float] = 60.0,
+        total_timeout: Optional[float] = None,
+        max_retries: int = 2,
+        retry_budget: Optional[RetryBudget] = None,
+        dns_cache: Optional[DNSCache] = None,
     ):
         """Inits ReverseProxyRouter.
 
         Args:
-        proxy_host -- The base URL of the target server to proxy requests to.
-        stream_threshold -- Responses past this threshold will be streamed via chunked encoding.
+        proxy_host -- The base URL of the target server to proxy requests to,
+            or a list of base URLs and Upstream objects to balance requests across.
+        stream_threshold -- Responses past this threshold will be streamed. Responses with a
+            Content-Length keep it, others are streamed via chunked encoding.
+        stream_buffer_size -- Size of the buffer streamed responses are relayed through.
         set_proxy_headers -- If True, adds X-Forwarded-{For, Proto, Host} and Forwarded headers.
         preserve_host -- If True, preserves the Host header in the request.
         decode_content -- If True, decodes the response content based on the Content-Encoding header.
+        strategy -- "round_robin" (weighted), "least_outstanding" or "consistent_hash".
+        hash_key -- Key of "consistent_hash", "path" or "header:<name>".
+        health_check_path -- If set, upstreams are checked with GET requests to this path on a background thread.
+        health_check_interval -- Seconds between health checks.
+        max_failures -- Consecutive 5xx responses or connection errors that open an upstream's circuit breaker.
+            Requests fail fast with 503 while no upstream has a closed or half-open circuit.
+        ejection_time -- Seconds an open circuit stays open before a trial request is let through.
+        client -- "urllib3", or "native" to use the built-in UpstreamConnectionPool. The native client doesn't support decode_content.
+        connect_timeout -- Seconds to wait for a connection to the upstream, None to wait forever.
+        read_timeout -- Seconds to wait for each read from the upstream, None to wait forever.
+        total_timeout -- Seconds each attempt may take to connect and receive the response header, None for no limit.
+        max_retries -- Retries of idempotent requests after connection errors and timeouts, on any upstream.
+        retry_budget -- Limits retries to a share of requests. If None, a RetryBudget with default values is used.
+        dns_cache -- Resolves the hosts of upstreams given as URLs for the native client.
         """
+        if client not in CLIENTS:
+            raise ValueError(f'Invalid client "{client}"')
+        if client == "native" and decode_content:
+            raise ValueError("The native client doesn't support decode_content")
 
-        # Remove trailing slashes because the path will always start with /
-        self.__proxy_host = proxy_host.rstrip("/")
+        if isinstance(proxy_host, str):
+            proxy_host = [proxy_host]
+        self.__upstreams = UpstreamGroup(
+            [
+                x if isinstance(x, Upstream) else Upstream(x, dns_cache=dns_cache)
+                for x in proxy_host
+            ],
+            strategy=strategy,
+            hash_key=hash_key,
+            health_check_path=health_check_path,
+            health_check_interval=health_check_interval,
+            max_failures=max_failures,
+            ejection_time=ejection_time,
+        )
         self.__stream_threshold = stream_threshold
+        self.__stream_buffer_size = stream_buffer_size
         self.__decode_content = decode_content
+        self.__client = client
+        self.__connect_timeout = connect_timeout
+        self.__read_timeout = read_timeout
+        self.__total_timeout = total_timeout
+        self.__timeout = Timeout(
+            connect=connect_timeout, read=read_timeout, total=total_timeout
+        )
+        self.__max_retries = max_retries
+        self.__retry_budget = retry_budget or RetryBudget()
 
-        self.__pool = PoolManager()
         self.http = HTTPResponseFactory(NO_CACHE_HEADERS)
 
         self.__chain = _ProxyPostprocessMiddleware(
@@ -46,41 +157,167 @@ class ReverseProxyRouter(RequestHandlerABC):
             )
         )
 
+    @instrumented
     def __call__(self, conn_info: ConnectionInfo, request: HTTPRequest) -> HTTPResponse:
         return self.__chain(conn_info, request)
 
+    @property
+    def upstream_states(self) -> dict[str, dict]:
+        """Health, outstanding requests and circuit breaker state of each upstream."""
+        return self.__upstreams.states
+
+    @property
+    def retry_budget(self) -> RetryBudget:
+        return self.__retry_budget
+
+    def close(self):
+        """Stops health checks and closes idle upstream connections."""
+        self.__upstreams.close()
+
     def __actual_call(
         self, conn_info: ConnectionInfo, request: HTTPRequest
     ) -> HTTPResponse:
-        # Forward the request
-        try:
-            response = self.__pool.request(
+        # Unread bodies are streamed as they arrive
+        body_stream = request.body_stream
+        self.__retry_budget.deposit()
+
+        attempt = 0
+        while True:
+            upstream = self.__upstreams.acquire(request)
+            if not upstream:
+                # 503 Service Unavailable
+                return self.http.status(503)
+
+            # Other errors, e.g. of the client's body, aren't the upstream's fault
+            success: Optional[bool] = None
+            streamed = False
+            try:
+                response, streamed = self.__forward(upstream, request)
+                success = response.status_code < 500
+                return response
+            except UPSTREAM_ERRORS as exc:
+                success = False
+                # Streamed bodies can't be replayed once they are partially sent
+                if (
+                    attempt < self.__max_retries
+                    and request.method in IDEMPOTENT_METHODS
+                    and not (body_stream and body_stream.started)
+                    and self.__retry_budget.withdraw()
+                ):
+                    attempt += 1
+                    LOG.debug(f"Retrying {request} after {type(exc).__name__}")
+                    continue
+
+                # urllib3's NewConnectionError subclasses its TimeoutError
+                if isinstance(exc, TIMEOUT_ERRORS) and not isinstance(
+                    exc, NewConnectionError
+                ):
+                    # 504 Gateway Timeout
+                    return self.http.status(504)
+
+                # 502 Bad Gateway
+                return self.http.status(502)
+            finally:
+                # Streamed bodies release the upstream once they are relayed
+                if not streamed:
+                    self.__upstreams.release(upstream, success)
+
+    def __forward(
+        self, upstream: Upstream, request: HTTPRequest
+    ) -> tuple[HTTPResponse, bool]:
+        # Returns the response and whether its body releases the upstream
+        body_stream = request.body_stream
+
+        response: Union[BaseHTTPResponse, UpstreamResponse]
+        if self.__client == "native":
+            # Headers are parsed once, straight into the container of our response
+            response = upstream.connection_pool.request(
+                request.method,
+                urllib.parse.quote(request.path) + request.query,
+                request.headers,
+                body_stream or request.body,
+                connect_timeout=self.__connect_timeout,
+                read_timeout=self.__read_timeout,
+                total_timeout=self.__total_timeout,
+            )
+            headers = response.headers
+        else:
+            response = upstream.pool.request(
                 method=request.method,
-                url=f"{self.__proxy_host}{request.path}{request.query}",
-                body=request.body,
+                url=f"{upstream.url}{request.path}{request.query}",
+                body=body_stream or request.body,
                 headers=request.headers,
+                chunked=body_stream is not None and body_stream.length is None,
+                timeout=self.__timeout,
+                retries=False,
                 preload_content=False,
                 redirect=False,
                 decode_content=self.__decode_content,
             )
+            headers = HeaderContainer(response.headers)
 
-            if self.__stream_required(response):
-                return HTTPResponse(
-                    status_code=response.status,
-                    headers=HeaderContainer(response.headers),
-                    body=ResponseBody.from_stream(response),
+        try:
+            if self.__client != "native":
+                # The native client rejects these already (RFC9112 section 6.3)
+                try:
+                    get_content_length(headers)
+                except ValueError as exc:
+                    raise MalformedResponseError(str(exc))
+
+            if self.__stream_required(request, response):
+                length = self.__get_passthrough_length(response)
+                if length is None:
+                    # Chunked encoding replaces the upstream's framing
+                    headers.pop("Content-Length", None)
+
+                success = response.status < 500
+                stream = _UpstreamStream(
+                    response, lambda: self.__upstreams.release(upstream, success)
+                )
+                return (
+                    HTTPResponse(
+                        status_code=response.status,
+                        headers=headers,
+                        body=ResponseBody.from_stream(
+                            stream, length, self.__stream_buffer_size
+                        ),
+                    ),
+                    True,
                 )
 
-            return HTTPResponse(
-                status_code=response.status,
-                headers=HeaderContainer(response.headers),
-                body=ResponseBody.from_bytes(response.data),
+            if request.method == "HEAD":
+                # Releases the connection, the upstream's Content-Length is kept
+                # as it describes the body of a GET
+                response.data
+                return (
+                    HTTPResponse(
+                        status_code=response.status, headers=headers, body=EmptyBody()
+                    ),
+                    False,
+                )
+
+            return (
+                HTTPResponse(
+                    status_code=response.status,
+                    headers=headers,
+                    body=ResponseBody.from_bytes(response.data),
+                ),
+                False,
             )
-        except HTTPError:
-            # 502 Bad Gateway
-            return self.http.status(502)
+        except BaseException:
+            # The connection can't be reused with an unread body
+            response.close()
+            raise
+
+    def __stream_required(
+        self,
+        request: HTTPRequest,
+        response: Union[BaseHTTPResponse, UpstreamResponse],
+    ) -> bool:
+        # Responses to HEAD requests, 204 and 304 responses have no body
+        if request.method == "HEAD" or response.status in {204, 304}:
+            return False
 
-    def __stream_required(self, response: BaseHTTPResponse) -> bool:
         # Stream responses if Transfer-Encoding is chunked
         if "Transfer-Encoding" in response.headers:
             if "chunked" in [
@@ -94,3 +331,17 @@ class ReverseProxyRouter(RequestHandlerABC):
             return int(response.headers["Content-Length"]) > self.__stream_threshold
 
         return False
+
+    def __get_passthrough_length(
+        self, response: Union[BaseHTTPResponse, UpstreamResponse]
+    ) -> Optional[int]:
+        # Returns the length of bodies that can be relayed as is, None if they need chunked encoding
+        if "Transfer-Encoding" in response.headers:
+            return None
+        if not response.headers.get("Content-Length", "").isdigit():
+            return None
+
+        # Decoding changes the length of the body
+        if self.__decode_content and "Content-Encoding" in response.headers:
+            return None
+        return int(response.headers["Content-Length"])
@@ -0,0 +1,5 @@
+# Public API should have Upstream, UpstreamGroup, the native client, resilience policies and the DNS cache
+from .balancer import Upstream, UpstreamGroup
+from .client import UpstreamConnectionPool, UpstreamResponse, MalformedResponseError
+from .resilience import CircuitBreaker, RetryBudget
+from .dns import DNSCache, create_connection
@@ -0,0 +1,292 @@
+from ..http.request import HTTPRequest
+from .client import UpstreamConnectionPool
+from .dns import DNSCache
+from .resilience import CircuitBreaker
+from .. import log
+from typing import Optional
+from urllib3 import PoolManager
+from urllib3.exceptions import HTTPError
+import bisect
+import hashlib
+import logging
+import threading
+
+LOG = log.getLogger("upstream.balancer")
+
+STRATEGIES = {"round_robin", "least_outstanding", "consistent_hash"}
+
+# Points per unit of weight on the consistent hash ring
+HASH_RING_REPLICAS = 100
+
+
+class Upstream:
+    def __init__(
+        self,
+        url: str,
+        weight: int = 1,
+        pool_size: int = 10,
+        dns_cache: Optional[DNSCache] = None,
+    ):
+        """Inits Upstream.
+
+        Args:
+        url -- The base URL of the upstream server.
+        weight -- Relative share of requests the upstream receives.
+        pool_size -- Number of connections kept alive in each of the upstream's connection pools.
+        dns_cache -- Resolves the host of the upstream for the native client.
+        """
+        if weight < 1:
+            raise ValueError("Invalid weight")
+
+        # Remove trailing slashes because the path will always start with /
+        self.__url = url.rstrip("/")
+        self.__weight = weight
+        self.__pool_size = pool_size
+        self.__dns_cache = dns_cache
+        self.__pool = PoolManager(maxsize=pool_size)
+        self.__connection_pool: Optional[UpstreamConnectionPool] = None
+        self.__connection_pool_lock = threading.Lock()
+
+        self.__outstanding = 0
+        self.__healthy = True
+
+    @property
+    def url(self) -> str:
+        return self.__url
+
+    @property
+    def weight(self) -> int:
+        return self.__weight
+
+    @property
+    def pool(self) -> PoolManager:
+        return self.__pool
+
+    @property
+    def connection_pool(self) -> UpstreamConnectionPool:
+        # Created on first use, only the native client needs it
+        if not self.__connection_pool:
+            with self.__connection_pool_lock:
+                if not self.__connection_pool:
+                    self.__connection_pool = UpstreamConnectionPool(
+                        self.__url, self.__pool_size, dns_cache=self.__dns_cache
+                    )
+        return self.__connection_pool
+
+    @property
+    def outstanding(self) -> int:
+        return self.__outstanding
+
+    @property
+    def healthy(self) -> bool:
+        return self.__healthy
+
+    def __str__(self):
+        return self.__url
+
+    def close(self):
+        """Closes the idle connections of both connection pools."""
+        self.__pool.clear()
+        if self.__connection_pool:
+            self.__connection_pool.close()
+
+    # State changes are made by UpstreamGroup while holding its lock
+    def _set_outstanding(self, value: int):
+        self.__outstanding = value
+
+    def _set_healthy(self, value: bool):
+        self.__healthy = value
+
+
+class UpstreamGroup:
+    def __init__(
+        self,
+        upstreams: list[Upstream],
+        strategy: str = "round_robin",
+        hash_key: str = "path",
+        health_check_path: Optional[str] = None,
+        health_check_interval: float = 10.0,
+        max_failures: int = 3,
+        ejection_time: float = 30.0,
+    ):
+        """Inits UpstreamGroup.
+
+        Args:
+        upstreams -- Upstreams to balance requests across.
+        strategy -- "round_robin" (weighted), "least_outstanding" or "consistent_hash".
+        hash_key -- Key of "consistent_hash", "path" or "header:<name>".
+        health_check_path -- If set, upstreams are checked with GET requests to this path on a background thread.
+        health_check_interval -- Seconds between health checks.
+        max_failures -- Consecutive 5xx responses or connection errors that open an upstream's circuit breaker.
+        ejection_time -- Seconds an open circuit stays open before a trial request is let through.
+        """
+        if not upstreams:
+            raise ValueError("At least one upstream is required")
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Invalid strategy "{strategy}"')
+        if hash_key != "path" and not hash_key.lower().startswith("header:"):
+            raise ValueError(f'Invalid hash key "{hash_key}"')
+
+        self.__upstreams = upstreams
+        self.__strategy = strategy
+        self.__hash_header = (
+            hash_key.partition(":")[2].strip() if hash_key != "path" else None
+        )
+        self.__breakers = [
+            CircuitBreaker(max_failures, ejection_time) for _ in upstreams
+        ]
+        self.__lock = threading.Lock()
+
+        # Smooth weighted round robin state, as used by Nginx
+        self.__current_weights = [0] * len(upstreams)
+
+        # Consistent hash ring of (point, upstream index)
+        self.__ring: list[tuple[int, int]] = sorted(
+            (self.__hash(f"{upstream.url}#{replica}"), i)
+            for i, upstream in enumerate(upstreams)
+            for replica in range(upstream.weight * HASH_RING_REPLICAS)
+        )
+        self.__ring_points = [x[0] for x in self.__ring]
+
+        self.__health_check_path = health_check_path
+        self.__health_check_interval = health_check_interval
+        self.__stop_event = threading.Event()
+        if health_check_path:
+            threading.Thread(
+                target=self.__health_check_loop, name="UpstreamHealthCheck", daemon=True
+            ).start()
+
+    @property
+    def upstreams(self) -> list[Upstream]:
+        return self.__upstreams
+
+    @property
+    def states(self) -> dict[str, dict]:
+        """State of each upstream for monitoring, keyed by URL."""
+        return {
+            upstream.url: {
+                "healthy": upstream.healthy,
+                "outstanding": upstream.outstanding,
+                "circuit": breaker.stats,
+            }
+            for upstream, breaker in zip(self.__upstreams, self.__breakers)
+        }
+
+    @staticmethod
+    def __hash(value: str) -> int:
+        return int.from_bytes(
+            hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+        )
+
+    def __select_round_robin(self, candidates: list[int]) -> int:
+        total = 0
+        best = candidates[0]
+        for i in candidates:
+            self.__current_weights[i] += self.__upstreams[i].weight
+            total += self.__upstreams[i].weight
+            if self.__current_weights[i] > self.__current_weights[best]:
+                best = i
+        self.__current_weights[best] -= total
+        return best
+
+    def __select_least_outstanding(self, candidates: list[int]) -> int:
+        return min(
+            candidates,
+            key=lambda i: self.__upstreams[i].outstanding / self.__upstreams[i].weight,
+        )
+
+    def __select_consistent_hash(
+        self, candidates: list[int], request: HTTPRequest
+    ) -> int:
+        if self.__hash_header:
+            key = request.headers.get(self.__hash_header, "")
+        else:
+            key = request.path
+
+        # Walk the ring clockwise until an available upstream is found
+        start = bisect.bisect(self.__ring_points, self.__hash(key))
+        allowed = set(candidates)
+        for offset in range(len(self.__ring)):
+            index = self.__ring[(start + offset) % len(self.__ring)][1]
+            if index in allowed:
+                return index
+        return candidates[0]
+
+    def acquire(self, request: HTTPRequest) -> Optional[Upstream]:
+        """Selects an upstream for the request and counts it as outstanding.
+        Returns None if no upstream is healthy with a closed or half-open circuit.
+        Must be followed by release().
+        """
+        with self.__lock:
+            candidates = [
+                i
+                for i, x in enumerate(self.__upstreams)
+                if x.healthy and self.__breakers[i].available
+            ]
+            if not candidates:
+                return None
+
+            if self.__strategy == "round_robin":
+                index = self.__select_round_robin(candidates)
+            elif self.__strategy == "least_outstanding":
+                index = self.__select_least_outstanding(candidates)
+            else:
+                index = self.__select_consistent_hash(candidates, request)
+
+            # Reserves a trial request if the circuit is half-open
+            if not self.__breakers[index].allow():
+                return None
+
+            upstream = self.__upstreams[index]
+            upstream._set_outstanding(upstream.outstanding + 1)
+        return upstream
+
+    def release(self, upstream: Upstream, success: Optional[bool]):
+        """Records the result of a request.
+        Failures are 5xx responses and connection errors, None is no result,
+        e.g. for requests that failed because of the client.
+        """
+        breaker = self.__breakers[self.__upstreams.index(upstream)]
+        with self.__lock:
+            upstream._set_outstanding(upstream.outstanding - 1)
+        if breaker.record(success):
+            LOG.warning(f"Opened circuit of upstream {upstream}")
+
+    def __check(self, upstream: Upstream):
+        try:
+            response = upstream.pool.request(
+                "GET",
+                f"{upstream.url}{self.__health_check_path}",
+                redirect=False,
+                retries=False,
+                timeout=self.__health_check_interval,
+            )
+            healthy = response.status < 500
+        except HTTPError:
+            healthy = False
+        except Exception as exc:
+            # Any other error marks the upstream unhealthy too, the checks go on
+            # Repeated failures are only logged at debug level
+            LOG.log(
+                logging.WARNING if upstream.healthy else logging.DEBUG,
+                f"Health check of upstream {upstream} failed",
+                exc_info=exc,
+            )
+            healthy = False
+
+        if healthy != upstream.healthy:
+            LOG.info(f"Upstream {upstream} is {'healthy' if healthy else 'unhealthy'}")
+        with self.__lock:
+            upstream._set_healthy(healthy)
+
+    def __health_check_loop(self):
+        while not self.__stop_event.is_set():
+            for upstream in self.__upstreams:
+                self.__check(upstream)
+            self.__stop_event.wait(self.__health_check_interval)
+
+    def close(self):
+        """Stops health checks and closes the connections of the upstreams."""
+        self.__stop_event.set()
+        for upstream in self.__upstreams:
+            upstream.close()
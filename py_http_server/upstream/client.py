@@ -0,0 +1,388 @@
+from ..common import HeaderContainer
+from ..networking.connection_socket import ConnectionSocket, GracefulDisconnectException
+from ..http.parser import (
+    receive_head,
+    parse_header_lines,
+    get_content_length,
+    is_chunked,
+)
+from ..http.request_body import RequestBody
+from .dns import DNSCache, create_connection
+from .. import log
+from typing import Optional, Union
+from urllib.parse import urlparse
+import ssl
+import threading
+import time
+
+LOG = log.getLogger("upstream.client")
+
+# Request headers that are set by the client
+FRAMING_HEADERS = {"content-length", "transfer-encoding", "connection"}
+
+# Maximum number of bytes sent at once for streamed bodies
+SEND_CHUNK_SIZE = 65536
+
+
+class MalformedResponseError(ValueError):
+    """Raised when the header or body of an upstream's response can't be parsed."""
+
+
+class _CloseDelimitedBody:
+    # Body of a response without Content-Length or chunked encoding, ends when the connection closes
+
+    def __init__(self, conn: ConnectionSocket, buffer: bytes):
+        self.__conn = conn
+        if buffer:
+            conn.unrecv(buffer)
+        self.__consumed = False
+
+    @property
+    def consumed(self) -> bool:
+        return self.__consumed
+
+    def read(self, size: int) -> bytes:
+        if self.__consumed:
+            return b""
+        try:
+            return self.__conn.recv(size)
+        except GracefulDisconnectException:
+            self.__consumed = True
+            return b""
+
+    def readinto(self, buffer) -> int:
+        if self.__consumed:
+            return 0
+        try:
+            return self.__conn.recv_into(buffer)
+        except GracefulDisconnectException:
+            self.__consumed = True
+            return 0
+
+
+class UpstreamResponse:
+    """Response of UpstreamConnectionPool.request().
+
+    The body is read from the connection on demand. The connection is returned
+    to the pool by close() if the body was read to its end, otherwise it is closed.
+    """
+
+    def __init__(
+        self,
+        pool: "UpstreamConnectionPool",
+        conn: ConnectionSocket,
+        status: int,
+        reason: str,
+        headers: HeaderContainer,
+        body: Union[RequestBody, _CloseDelimitedBody, None],
+        keep_alive: bool,
+    ):
+        self.__pool = pool
+        self.__conn: Optional[ConnectionSocket] = conn
+        self.__status = status
+        self.__reason = reason
+        self.__headers = headers
+        self.__body = body
+        self.__keep_alive = keep_alive and not isinstance(body, _CloseDelimitedBody)
+
+        # Responses without a body are complete already
+        if body is None:
+            self.close()
+
+    @property
+    def status(self) -> int:
+        return self.__status
+
+    @property
+    def reason(self) -> str:
+        return self.__reason
+
+    @property
+    def headers(self) -> HeaderContainer:
+        return self.__headers
+
+    @property
+    def length(self) -> Optional[int]:
+        return self.__body.length if isinstance(self.__body, RequestBody) else None
+
+    @property
+    def consumed(self) -> bool:
+        return self.__body is None or self.__body.consumed
+
+    def read(self, size: int = -1) -> bytes:
+        if self.__body is None:
+            return b""
+        if size < 0:
+            return self.data
+        try:
+            return self.__body.read(size)
+        except ValueError as exc:
+            # Malformed chunks
+            raise MalformedResponseError(f"Response body is malformed: {exc}")
+
+    def readinto(self, buffer) -> int:
+        if self.__body is None:
+            return 0
+        try:
+            return self.__body.readinto(buffer)
+        except ValueError as exc:
+            raise MalformedResponseError(f"Response body is malformed: {exc}")
+
+    @property
+    def data(self) -> bytes:
+        """Reads the rest of the body and releases the connection."""
+        data = bytearray()
+        try:
+            while chunk := self.read(SEND_CHUNK_SIZE):
+                data += chunk
+        finally:
+            self.close()
+        return bytes(data)
+
+    def close(self):
+        if not self.__conn:
+            return
+        conn, self.__conn = self.__conn, None
+
+        if self.__keep_alive and self.consumed:
+            self.__pool._put_connection(conn)
+        else:
+            conn.close()
+
+
+class UpstreamConnectionPool:
+    """HTTP/1.1 client for a single upstream with keep-alive connection pooling.
+
+    Connections are only reused after the previous response was read to its
+    end, so requests are never pipelined. Idle connections that became
+    readable (closed or sent unexpected data) are discarded before reuse.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        maxsize: int = 10,
+        ssl_context: Optional[ssl.SSLContext] = None,
+        max_header_size: int = 32768,
+        recv_buffer_size: int = 65536,
+        dns_cache: Optional[DNSCache] = None,
+    ):
+        """Inits UpstreamConnectionPool.
+
+        Args:
+        url -- The base URL of the upstream server, "http" and "https" schemes are supported.
+        maxsize -- Number of idle connections kept alive.
+        ssl_context -- SSL context of "https" connections. If None, the default context is used.
+        max_header_size -- Maximum size of a response header section.
+        recv_buffer_size -- Maximum number of bytes received at once.
+        dns_cache -- Resolves the host of the upstream. If None, it's resolved for each new connection.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme not in {"http", "https"} or not parsed.hostname:
+            raise ValueError(f'Invalid upstream URL "{url}"')
+
+        self.__host = parsed.hostname
+        self.__port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.__netloc = parsed.netloc
+        self.__base_path = parsed.path.rstrip("/")
+        self.__ssl_context = (
+            (ssl_context or ssl.create_default_context())
+            if parsed.scheme == "https"
+            else None
+        )
+        self.__maxsize = maxsize
+        self.__max_header_size = max_header_size
+        self.__recv_buffer_size = recv_buffer_size
+        self.__dns_cache = dns_cache
+        self.__closed = False
+
+        # Idle connections, most recently used last
+        self.__idle: list[ConnectionSocket] = []
+        self.__lock = threading.Lock()
+
+    def __new_connection(self, timeout: Optional[float]) -> ConnectionSocket:
+        sock = create_connection(self.__host, self.__port, timeout, self.__dns_cache)
+        if self.__ssl_context:
+            sock = self.__ssl_context.wrap_socket(sock, server_hostname=self.__host)
+        return ConnectionSocket(sock, enable_nopush=False, enable_nodelay=True)
+
+    def __get_connection(
+        self, connect_timeout: Optional[float]
+    ) -> tuple[ConnectionSocket, bool]:
+        # Returns a connection and whether it's reused
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                conn = self.__idle.pop()
+
+            # Idle connections must not have anything to read
+            if ConnectionSocket.wait_any_readable({conn}, 0):
+                conn.close()
+                continue
+            return conn, True
+
+        return self.__new_connection(connect_timeout), False
+
+    def _put_connection(self, conn: ConnectionSocket):
+        with self.__lock:
+            if not self.__closed and len(self.__idle) < self.__maxsize:
+                self.__idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Closes idle connections, connections in use are closed when they are released."""
+        with self.__lock:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+        for conn in idle:
+            conn.close()
+
+    def __send_request(
+        self,
+        conn: ConnectionSocket,
+        method: str,
+        target: str,
+        headers: HeaderContainer,
+        body: Union[bytes, RequestBody],
+    ):
+        lines = [f"{method} {self.__base_path}{target} HTTP/1.1"]
+        if "Host" not in headers:
+            lines.append(f"Host: {self.__netloc}")
+        lines.extend(
+            f"{k}: {v}"
+            for k, v in headers.multi_items()
+            if k.lower() not in FRAMING_HEADERS
+        )
+
+        # Framing of the body is decided here, not by the incoming headers
+        chunked = False
+        if isinstance(body, RequestBody):
+            if body.length is None:
+                lines.append("Transfer-Encoding: chunked")
+                chunked = True
+            else:
+                lines.append(f"Content-Length: {body.length}")
+        elif body or method in {"POST", "PUT", "PATCH"}:
+            lines.append(f"Content-Length: {len(body)}")
+
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        if not isinstance(body, RequestBody):
+            conn.sendall(head + body)
+            return
+
+        conn.sendall(head)
+        while chunk := body.read(SEND_CHUNK_SIZE):
+            if chunked:
+                conn.sendall(b"%X\r\n%b\r\n" % (len(chunk), chunk))
+            else:
+                conn.sendall(chunk)
+        if chunked:
+            conn.sendall(b"0\r\n\r\n")
+
+    def __receive_response(
+        self, conn: ConnectionSocket, method: str
+    ) -> UpstreamResponse:
+        while True:
+            lines, rest = receive_head(
+                conn, self.__max_header_size, self.__recv_buffer_size
+            )
+            try:
+                version, _, status_reason = lines[0].partition(" ")
+                status, _, reason = status_reason.partition(" ")
+                status = int(status)
+                headers = parse_header_lines(lines[1:])
+                content_length = get_content_length(headers)
+            except (IndexError, ValueError) as exc:
+                raise MalformedResponseError(
+                    f"Response header is malformed. Exception: {exc}"
+                )
+
+            # Skip informational responses such as 100 Continue
+            if 100 <= status < 200 and status != 101:
+                conn.unrecv(rest)
+                continue
+            break
+
+        connection = headers.get("Connection", "").lower()
+        keep_alive = (
+            connection != "close"
+            if version == "HTTP/1.1"
+            else connection == "keep-alive"
+        )
+
+        # RFC9112 section 6.3: Message body length
+        body: Union[RequestBody, _CloseDelimitedBody, None]
+        if method == "HEAD" or status in {101, 204, 304}:
+            conn.unrecv(rest)
+            body = None
+        elif is_chunked(headers):
+            body = RequestBody(
+                conn, rest, None, recv_buffer_size=self.__recv_buffer_size
+            )
+        elif content_length is not None:
+            body = RequestBody(
+                conn, rest, content_length, recv_buffer_size=self.__recv_buffer_size
+            )
+        else:
+            body = _CloseDelimitedBody(conn, rest)
+
+        return UpstreamResponse(self, conn, status, reason, headers, body, keep_alive)
+
+    def request(
+        self,
+        method: str,
+        target: str,
+        headers: HeaderContainer,
+        body: Union[bytes, RequestBody] = b"",
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        total_timeout: Optional[float] = None,
+    ) -> UpstreamResponse:
+        """Sends a request and receives the response header.
+        Timeouts raise TimeoutError, None means no timeout.
+
+        Args:
+        method -- Request method.
+        target -- Percent-encoded path and query, appended to the path of the base URL.
+        headers -- Request headers, framing headers are replaced.
+        body -- Request body, RequestBody objects are streamed.
+        connect_timeout -- Seconds to wait for a new connection.
+        read_timeout -- Seconds to wait for each send and receive, including reads of the body.
+        total_timeout -- Seconds to wait for the response header, including connecting.
+        """
+        deadline = time.monotonic() + total_timeout if total_timeout else None
+
+        def get_timeout(timeout: Optional[float]) -> Optional[float]:
+            # Limits a timeout by the time left until the deadline
+            if deadline is None:
+                return timeout
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise TimeoutError("Total timeout exceeded")
+            return left if timeout is None else min(timeout, left)
+
+        while True:
+            conn, reused = self.__get_connection(get_timeout(connect_timeout))
+            try:
+                conn.settimeout(get_timeout(read_timeout))
+                self.__send_request(conn, method, target, headers, body)
+                response = self.__receive_response(conn, method)
+
+                # The total timeout doesn't apply to the body, responses
+                # without one have released the connection already
+                if not response.consumed:
+                    conn.settimeout(read_timeout)
+                return response
+            except (OSError, ValueError) as exc:
+                conn.close()
+
+                # Reused connections may have been closed by the upstream in the meantime
+                # Retry on a new connection unless a streamed body was partially sent
+                retryable = isinstance(exc, ConnectionError) and not (
+                    isinstance(body, RequestBody) and body.started
+                )
+                if not reused or not retryable:
+                    raise
+                LOG.debug(f"Retrying on a new connection to {self.__netloc}")
@@ -0,0 +1,247 @@
+from ..metrics import REGISTRY
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+import errno
+import ipaddress
+import os
+import selectors
+import socket
+import threading
+import time
+
+# Resolves a host name to IP addresses in order of preference and their TTL in seconds.
+# A TTL of None means the default TTL of the cache.
+Resolver = Callable[[str], tuple[list[str], Optional[float]]]
+
+# RFC8305 section 5: Connection Attempt Delay
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+
+def system_resolver(host: str) -> tuple[list[str], Optional[float]]:
+    """Resolves host with getaddrinfo(), which doesn't expose TTLs."""
+    addresses: list[str] = []
+    for _, _, _, _, sockaddr in socket.getaddrinfo(host, None, type=socket.SOCK_STREAM):
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return addresses, None
+
+
+class DNSCache:
+    """Caches the addresses of host names for their TTL.
+
+    Lookups run on a small thread pool so they can time out, and concurrent
+    lookups of the same host share a single resolver call. Failed lookups
+    are cached for negative_ttl seconds. At most maxsize hosts are kept,
+    least recently used first out.
+    """
+
+    def __init__(
+        self,
+        resolver: Resolver = system_resolver,
+        default_ttl: float = 60.0,
+        min_ttl: float = 1.0,
+        max_ttl: float = 3600.0,
+        negative_ttl: float = 5.0,
+        maxsize: int = 1024,
+        max_workers: int = 4,
+    ):
+        """Inits DNSCache.
+
+        Args:
+        resolver -- Returns the addresses of a host name and their TTL, may be replaced by a stub in tests.
+        default_ttl -- Seconds addresses are cached when the resolver doesn't return a TTL.
+        min_ttl -- Minimum seconds addresses are cached.
+        max_ttl -- Maximum seconds addresses are cached.
+        negative_ttl -- Seconds failed lookups are cached.
+        maxsize -- Maximum number of cached host names.
+        max_workers -- Maximum number of concurrent lookups.
+        """
+        self.__resolver = resolver
+        self.__default_ttl = default_ttl
+        self.__min_ttl = min_ttl
+        self.__max_ttl = max_ttl
+        self.__negative_ttl = negative_ttl
+        self.__maxsize = maxsize
+        self.__executor = ThreadPoolExecutor(max_workers, thread_name_prefix="DNS")
+
+        self.__lock = threading.Lock()
+        # Host name to (expiry time, addresses or lookup error)
+        self.__cache: OrderedDict[str, tuple[float, list[str] | Exception]] = (
+            OrderedDict()
+        )
+        self.__in_flight: dict[str, Future] = {}
+
+        self.__hits = 0
+        self.__misses = 0
+        REGISTRY.add_stats("dns_cache", self, ["entries"])
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.__hits,
+            "misses": self.__misses,
+            "entries": len(self.__cache),
+        }
+
+    def __lookup(self, host: str) -> list[str]:
+        try:
+            try:
+                addresses, ttl = self.__resolver(host)
+                if not addresses:
+                    raise socket.gaierror(socket.EAI_NONAME, f"No addresses for {host}")
+                result: list[str] | Exception = addresses
+                ttl = min(
+                    max(ttl if ttl is not None else self.__default_ttl, self.__min_ttl),
+                    self.__max_ttl,
+                )
+            except Exception as exc:
+                # Any error is cached, e.g. UnicodeError for labels over 63 characters
+                result = exc
+                ttl = self.__negative_ttl
+
+            with self.__lock:
+                self.__cache[host] = (time.monotonic() + ttl, result)
+                self.__cache.move_to_end(host)
+                while len(self.__cache) > self.__maxsize:
+                    self.__cache.popitem(last=False)
+        finally:
+            # Later lookups must not get the future of a finished one
+            with self.__lock:
+                self.__in_flight.pop(host, None)
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def resolve(self, host: str, timeout: Optional[float] = None) -> list[str]:
+        """Returns the addresses of host in order of preference.
+        Raises TimeoutError if the lookup takes longer than timeout seconds, OSError if it fails
+        and ValueError if host isn't a valid host name.
+        """
+        # IP literals need no lookup
+        try:
+            return [str(ipaddress.ip_address(host.strip("[]")))]
+        except ValueError:
+            pass
+
+        host = host.lower()
+        with self.__lock:
+            cached = self.__cache.get(host)
+            if cached and cached[0] > time.monotonic():
+                self.__cache.move_to_end(host)
+                self.__hits += 1
+                if isinstance(cached[1], Exception):
+                    raise cached[1]
+                return cached[1]
+
+            self.__misses += 1
+            future = self.__in_flight.get(host)
+            if not future:
+                future = self.__in_flight[host] = self.__executor.submit(
+                    self.__lookup, host
+                )
+
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            raise TimeoutError(f"Lookup of {host} timed out")
+
+    def purge(self, host: Optional[str] = None):
+        """Removes host, or all host names if None, from the cache."""
+        with self.__lock:
+            if host is None:
+                self.__cache.clear()
+            else:
+                self.__cache.pop(host.lower(), None)
+
+
+def _interleave(addresses: list[str]) -> list[str]:
+    # RFC8305 section 4: Alternate address families, starting with the preferred one
+    if not addresses:
+        return []
+    first_v6 = ":" in addresses[0]
+    preferred = [x for x in addresses if (":" in x) == first_v6]
+    other = [x for x in addresses if (":" in x) != first_v6]
+
+    result = []
+    for i in range(max(len(preferred), len(other))):
+        result.extend(preferred[i : i + 1] + other[i : i + 1])
+    return result
+
+
+def create_connection(
+    host: str,
+    port: int,
+    timeout: Optional[float] = None,
+    dns_cache: Optional[DNSCache] = None,
+    attempt_delay: float = CONNECTION_ATTEMPT_DELAY,
+) -> socket.socket:
+    """Connects to host with Happy Eyeballs (RFC8305).
+
+    Attempts to the resolved addresses are started attempt_delay seconds
+    apart, or as soon as the previous one fails, alternating between IPv6
+    and IPv4. The first established connection is returned in blocking
+    mode, the others are closed. timeout covers both the lookup and the
+    connection attempts, TimeoutError is raised when it expires.
+
+    Args:
+    host -- Host name or IP address.
+    port -- TCP port.
+    timeout -- Seconds to wait for a connection, None to wait forever.
+    dns_cache -- Resolves host. If None, host is resolved with getaddrinfo() without caching.
+    attempt_delay -- Seconds to wait for an attempt before starting the next one.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    if dns_cache:
+        addresses = dns_cache.resolve(host, timeout)
+    else:
+        addresses = system_resolver(host)[0]
+    pending = _interleave(addresses)
+
+    selector = selectors.DefaultSelector()
+    errors: list[OSError] = []
+    next_attempt = time.monotonic()
+    try:
+        while pending or selector.get_map():
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise TimeoutError(f"Connection to {host}:{port} timed out")
+
+            # Start the next attempt when it's due or nothing else is in progress
+            if pending and (now >= next_attempt or not selector.get_map()):
+                address = pending.pop(0)
+                family = socket.AF_INET6 if ":" in address else socket.AF_INET
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                code = sock.connect_ex((address, port))
+                if code in {0, errno.EINPROGRESS, errno.EWOULDBLOCK}:
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    next_attempt = now + attempt_delay
+                else:
+                    sock.close()
+                    errors.append(OSError(code, os.strerror(code)))
+                continue
+
+            wait = next_attempt - now if pending else None
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+            for key, _ in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    sock.setblocking(True)
+                    return sock
+
+                # A failed attempt lets the next one start right away
+                sock.close()
+                errors.append(OSError(code, os.strerror(code)))
+                next_attempt = time.monotonic()
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+    raise errors[0] if errors else OSError(f"No addresses for {host}")
@@ -0,0 +1,193 @@
+from typing import Optional
+import threading
+import time
+
+
+class RetryBudget:
+    """Limits retries to a share of recent requests.
+
+    Retries are allowed while the retries made in the last ttl seconds stay
+    below ratio times the requests made in the same window, plus
+    min_per_second retries per second so that low traffic can still retry.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 10.0, ttl: int = 10):
+        """Inits RetryBudget.
+
+        Args:
+        ratio -- Maximum ratio of retries to requests.
+        min_per_second -- Retries per second allowed regardless of the ratio.
+        ttl -- Length of the window in seconds.
+        """
+        if ratio < 0 or min_per_second < 0 or ttl < 1:
+            raise ValueError("Invalid retry budget")
+
+        self.__ratio = ratio
+        self.__min_retries = min_per_second * ttl
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+
+        # One bucket of [second, requests, retries] per second of the window
+        self.__buckets = [[0, 0, 0] for _ in range(ttl)]
+
+    def __bucket(self, now: int) -> list[int]:
+        # Must be called while holding the lock
+        bucket = self.__buckets[now % self.__ttl]
+        if bucket[0] != now:
+            bucket[:] = [now, 0, 0]
+        return bucket
+
+    def __totals(self, now: int) -> tuple[int, int]:
+        requests = retries = 0
+        for second, bucket_requests, bucket_retries in self.__buckets:
+            if now - second < self.__ttl:
+                requests += bucket_requests
+                retries += bucket_retries
+        return requests, retries
+
+    def deposit(self):
+        """Records a request."""
+        now = int(time.monotonic())
+        with self.__lock:
+            self.__bucket(now)[1] += 1
+
+    def withdraw(self) -> bool:
+        """Records a retry if the budget allows it, returns False otherwise."""
+        now = int(time.monotonic())
+        with self.__lock:
+            requests, retries = self.__totals(now)
+            if retries >= self.__min_retries + self.__ratio * requests:
+                return False
+            self.__bucket(now)[2] += 1
+            return True
+
+    @property
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            requests, retries = self.__totals(int(time.monotonic()))
+        return {"requests": requests, "retries": retries}
+
+
+class CircuitBreaker:
+    """Stops requests to a failing upstream.
+
+    The circuit opens after failure_threshold consecutive failures. After
+    recovery_time seconds it becomes half-open and lets up to
+    half_open_requests trial requests through: a success closes it, a
+    failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 3,
+        recovery_time: float = 30.0,
+        half_open_requests: int = 1,
+    ):
+        """Inits CircuitBreaker.
+
+        Args:
+        failure_threshold -- Consecutive failures that open the circuit.
+        recovery_time -- Seconds the circuit stays open.
+        half_open_requests -- Concurrent trial requests allowed while half-open.
+        """
+        self.__failure_threshold = failure_threshold
+        self.__recovery_time = recovery_time
+        self.__half_open_requests = half_open_requests
+        self.__lock = threading.Lock()
+
+        self.__state = self.CLOSED
+        self.__failures = 0
+        self.__opened_at = 0.0
+        self.__trials = 0
+        self.__opened_count = 0
+
+    def __update(self):
+        # Must be called while holding the lock
+        if (
+            self.__state == self.OPEN
+            and time.monotonic() - self.__opened_at >= self.__recovery_time
+        ):
+            self.__state = self.HALF_OPEN
+            self.__trials = 0
+
+    def __open(self):
+        # Must be called while holding the lock
+        self.__state = self.OPEN
+        self.__opened_at = time.monotonic()
+        self.__failures = 0
+        self.__opened_count += 1
+
+    @property
+    def state(self) -> str:
+        with self.__lock:
+            self.__update()
+            return self.__state
+
+    @property
+    def available(self) -> bool:
+        """True if a request would be allowed, without reserving it."""
+        with self.__lock:
+            self.__update()
+            if self.__state == self.HALF_OPEN:
+                return self.__trials < self.__half_open_requests
+            return self.__state == self.CLOSED
+
+    def allow(self) -> bool:
+        """Returns True if a request may be made, must be followed by record()."""
+        with self.__lock:
+            self.__update()
+            if self.__state == self.CLOSED:
+                return True
+            if (
+                self.__state == self.HALF_OPEN
+                and self.__trials < self.__half_open_requests
+            ):
+                self.__trials += 1
+                return True
+            return False
+
+    def record(self, success: Optional[bool]) -> bool:
+        """Records the result of an allowed request, returns True if the circuit opened.
+        None ends the request without a result, e.g. if the client caused it to fail.
+        """
+        with self.__lock:
+            if success is None:
+                if self.__state == self.HALF_OPEN:
+                    self.__trials = max(0, self.__trials - 1)
+                return False
+
+            if self.__state == self.HALF_OPEN:
+                self.__trials = max(0, self.__trials - 1)
+                if success:
+                    self.__state = self.CLOSED
+                    self.__failures = 0
+                    return False
+                self.__open()
+                return True
+
+            if success:
+                self.__failures = 0
+                return False
+
+            self.__failures += 1
+            if (
+                self.__state == self.CLOSED
+                and self.__failures >= self.__failure_threshold
+            ):
+                self.__open()
+                return True
+            return False
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            self.__update()
+            return {
+                "state": self.__state,
+                "failures": self.__failures,
+                "opened_count": self.__opened_count,
+            }